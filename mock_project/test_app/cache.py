@@ -0,0 +1,48 @@
+import threading
+import time
+
+from django.core.cache.backends.locmem import LocMemCache
+
+
+_local = threading.local()
+
+
+class CacheFault(Exception):
+    pass
+
+
+class CountingCache(LocMemCache):
+    """
+    A local memory cache that counts its round trips, as if it were across a
+    network: every call is one trip, however many keys it involves. (LocMem
+    implements get_many and friends by calling get and so on, so only the
+    outermost call counts.)
+
+    Tests can also make it misbehave: set `delay` to slow every call down by
+    that many seconds, or `fail` to make every call raise CacheFault.
+    """
+    round_trips = 0
+    delay = 0
+    fail = False
+
+    def count(name):
+        def method(self, *args, **kwargs):
+            depth = getattr(_local, 'depth', 0)
+            if not depth:
+                CountingCache.round_trips += 1
+                if CountingCache.delay:
+                    time.sleep(CountingCache.delay)
+                if CountingCache.fail:
+                    raise CacheFault("The cache is down (on purpose).")
+            _local.depth = depth + 1
+            try:
+                return getattr(LocMemCache, name)(self, *args, **kwargs)
+            finally:
+                _local.depth = depth
+        method.__name__ = name
+        return method
+
+    for name in ('add', 'get', 'set', 'delete', 'has_key', 'incr',
+                 'get_many', 'set_many', 'delete_many', 'clear'):
+        locals()[name] = count(name)
+    del count, name
@@ -27,6 +27,14 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "mock_project.settings")
 from django.core.wsgi import get_wsgi_application
 application = get_wsgi_application()
 
+# Import the views used by pages now, so the first request doesn't have to.
+from pages.warmup import warm_page_views
+warm_page_views()
+
+# Serve cached pages to anonymous visitors without running the middleware.
+from pages.wsgi import PageCacheApplication
+application = PageCacheApplication(application)
+
 # Apply WSGI middleware here.
 # from helloworld.wsgi import HelloWorldApplication
 # application = HelloWorldApplication(application)
@@ -1,9 +1,15 @@
+from django.conf.urls import patterns, url
 from django.contrib import admin
+from django.http import HttpResponse
 
 from flexible_content.admin import ContentAreaAdmin
 
-from .admin_utils import get_preview_link
-from .models import Page
+from . import timing
+from .breaker import breaker
+from .admin_utils import (EstimatedCountPaginator, PageChangeList,
+                          SectionListFilter, get_preview_link)
+from .models import Page, content_changed
+from .prerender import deferred_prerendering
 
 
 class PageAdmin(ContentAreaAdmin):
@@ -12,16 +18,23 @@ class PageAdmin(ContentAreaAdmin):
         get_preview_link,
         'summary_preview',
     )
+    list_filter = ('site', SectionListFilter)
+    # Start a search with a slash to find URLs beginning with it; otherwise,
+    # it's a search for words in the page (see PageChangeList).
+    search_fields = ('url', 'title')
+    paginator = EstimatedCountPaginator
     fieldsets = (
         (None, {
             'fields': (
                 'title',
+                'site',
                 'url',
                 'summary',
             ),
         }),
         (u"Advanced", {
             'fields': (
+                'match_prefix',
                 'view',
                 'template',
             ),
@@ -36,4 +49,40 @@ class PageAdmin(ContentAreaAdmin):
             return obj.summary
     summary_preview.short_description = "Summary"
 
+    def add_view(self, request, *args, **kwargs):
+        with deferred_prerendering():
+            response = super(PageAdmin, self).add_view(request, *args,
+                                                       **kwargs)
+            # A new page's items are only moved onto it after it's saved,
+            # without any signals, so catch up on them now.
+            page = getattr(request, 'new_content_area_object', None)
+            if page is not None:
+                content_changed(Page.objects.filter(pk=page.pk))
+        return response
+
+    def change_view(self, request, *args, **kwargs):
+        # Items are saved one by one, then the page; render it once, after.
+        with deferred_prerendering():
+            return super(PageAdmin, self).change_view(request, *args,
+                                                      **kwargs)
+
+    def get_changelist(self, request, **kwargs):
+        return PageChangeList
+
+    def get_urls(self):
+        urls = super(PageAdmin, self).get_urls()
+        return patterns('',
+            url(r'^timings/$', self.admin_site.admin_view(self.timings_view),
+                name='pages_page_timings'),
+        ) + urls
+
+    def timings_view(self, request):
+        """
+        List the slowest pages this process has served, stage by stage, and
+        how the page cache's circuit breaker is doing.
+        """
+        report = '\n\n'.join([timing.stats.format_report(),
+                               breaker.format_report()])
+        return HttpResponse(report, content_type='text/plain')
+
 admin.site.register(Page, PageAdmin)
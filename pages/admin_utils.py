@@ -1,5 +1,15 @@
+import hashlib
+
+from django.contrib import admin, messages
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import ChangeList
+from django.core.paginator import InvalidPage, Paginator
+from django.db import connections, router
 from django.utils.timezone import localtime
 
+from . import validators
+from .breaker import page_cache
+
 
 def prettify_datetime(datetime):
     local_datetime = localtime(datetime)
@@ -13,3 +23,230 @@ def get_preview_link(obj):
                                         obj.get_absolute_url())
 get_preview_link.short_description = u"Preview Link"
 get_preview_link.allow_tags = True
+get_preview_link.admin_order_field = 'url'
+
+
+# LARGE CHANGELISTS -----------------------------------------------------------
+
+# Counting past this many rows is left to an estimate.
+EXACT_COUNT_LIMIT = 1000
+SECTION_CACHE_TIMEOUT = 300
+# The query parameter the admin's site filter (list_filter's 'site') sets.
+SITE_FILTER_PARAMETER = 'site__id__exact'
+# Sorts after any character a URL could contain.
+URL_UPPER_BOUND = u'\uffff'
+
+
+def get_table_estimate(model):
+    """
+    Return roughly how many rows a table has, without counting them.
+    """
+    connection = connections[router.db_for_read(model)]
+    table = model._meta.db_table
+    cursor = connection.cursor()
+    if connection.vendor == 'postgresql':
+        cursor.execute("SELECT reltuples FROM pg_class WHERE relname = %s",
+                       [table])
+    elif connection.vendor == 'mysql':
+        cursor.execute("SELECT table_rows FROM information_schema.tables "
+                       "WHERE table_schema = DATABASE() AND table_name = %s",
+                       [table])
+    else:
+        # The highest id is read straight off the primary key's index, and
+        # is close enough unless lots of rows were deleted.
+        cursor.execute("SELECT MAX({0}) FROM {1}".format(
+            connection.ops.quote_name(model._meta.pk.column),
+            connection.ops.quote_name(table)))
+    row = cursor.fetchone()
+    return int(row[0] or 0) if row else 0
+
+
+def estimate_count(queryset, limit=None, offset=0):
+    """
+    Count a queryset exactly if it doesn't go more than the limit past the
+    offset, or estimate it if it does. Returns the count, and whether it's an
+    estimate.
+
+    A filtered queryset that's too big to count is reported as going exactly
+    the limit past the offset. Pass the offset of the page being shown, and
+    there's always another limit's worth of rows to page on to.
+    """
+    if limit is None:
+        limit = EXACT_COUNT_LIMIT
+    ids = list(queryset.order_by().values_list('pk', flat=True)
+               [offset:offset + limit + 1])
+    if not ids and offset:
+        # We're past the end; count from the start instead.
+        return estimate_count(queryset, limit)
+    if len(ids) <= limit:
+        return offset + len(ids), False
+    if not queryset.query.where:
+        return max(get_table_estimate(queryset.model), offset + limit), True
+    return offset + limit, True
+
+
+class EstimatedCountPaginator(Paginator):
+    # Set to the offset of the page being shown, so the count reaches past
+    # it (see estimate_count).
+    count_from = 0
+    count_is_estimate = False
+
+    def _get_count(self):
+        if self._count is None:
+            self._count, self.count_is_estimate = estimate_count(
+                self.object_list, offset=self.count_from)
+        return self._count
+    count = property(_get_count)
+
+
+def get_url_range(prefix):
+    return {'url__gte': prefix, 'url__lt': prefix + URL_UPPER_BOUND}
+
+
+def get_child_sections(prefix=u'/', site_id=None):
+    """
+    Return the URLs one level beneath a prefix that have pages under them on
+    a site (or on any site, if none is given), like ['/about/', '/docs/'] for
+    '/'. These are cached for a few minutes, since they take a scan of every
+    URL beneath the prefix.
+    """
+    from .models import Page
+
+    key = 'flexible_page_sections_{}_{}'.format(
+        'all' if site_id is None else site_id,
+        hashlib.sha224(prefix.encode('utf-8')).hexdigest())
+    sections = page_cache.get(key)
+    if sections is None:
+        pages = Page.objects.filter(**get_url_range(prefix))
+        if site_id is not None:
+            pages = pages.filter(site=site_id)
+        sections = set()
+        for url in (pages.order_by().values_list('url', flat=True)
+                    .iterator()):
+            rest = url[len(prefix):]
+            if rest:
+                sections.add(prefix + rest.split('/', 1)[0] + '/')
+        sections = sorted(sections)
+        page_cache.set(key, sections, SECTION_CACHE_TIMEOUT)
+    return sections
+
+
+def get_selected_site_id(request):
+    """
+    Return the id of the site the changelist is filtered to, or None.
+    """
+    try:
+        return int(request.GET[SITE_FILTER_PARAMETER])
+    except (KeyError, ValueError):
+        return None
+
+
+class SectionListFilter(admin.SimpleListFilter):
+    """
+    Narrow the list to one part of the URL tree. Choosing a section lists
+    the sections within it, and so on down.
+    """
+    title = u"section"
+    parameter_name = 'section'
+
+    def lookups(self, request, model_admin):
+        # Only offer sections of the site the list is filtered to.
+        site_id = get_selected_site_id(request)
+        sections = set(get_child_sections(site_id=site_id))
+        selected = self.value()
+        if selected and validators.is_root_relative_url(selected):
+            # Show the way back up, and the next level down.
+            segments = selected.strip('/').split('/')
+            for depth in range(1, len(segments) + 1):
+                sections.add(u'/' + u'/'.join(segments[:depth]) + u'/')
+            sections.update(get_child_sections(selected, site_id))
+        return [(url, url) for url in sorted(sections)]
+
+    def queryset(self, request, queryset):
+        if self.value():
+            return queryset.filter(**get_url_range(self.value()))
+
+
+class PageChangeList(ChangeList):
+    """
+    A changelist that stays quick with a very large number of pages:
+
+      - searches starting with a slash find URLs by prefix, and other
+        searches use the search index (pages.search), not LIKE scans
+        (unless SEARCH_INDEX is off, when they search search_fields as
+        usual),
+      - counts reaching EXACT_COUNT_LIMIT past the page being shown are
+        estimated, and the list says so,
+      - rows only load the fields the list shows,
+      - ordering by URL orders by site and URL, which the database can
+        read in order off their unique index, rather than by URL and then
+        primary key, which it has to sort.
+    """
+    list_fields = ('title', 'url', 'summary')
+
+    def get_query_set(self, request):
+        from . import search
+
+        query = self.query.strip()
+        if not query.startswith('/') and not search.is_enabled():
+            qs = super(PageChangeList, self).get_query_set(request)
+            return qs.only(*self.list_fields)
+
+        # Stop the stock search from running its icontains queries.
+        original_query, self.query = self.query, ''
+        try:
+            qs = super(PageChangeList, self).get_query_set(request)
+        finally:
+            self.query = original_query
+
+        if query.startswith('/'):
+            qs = qs.filter(**get_url_range(query.lower()))
+        elif query:
+            for term in search.tokenize(query):
+                qs = qs.filter(pk__in=search.get_term_rows(term)
+                                      .values('page'))
+
+        return qs.only(*self.list_fields)
+
+    def get_ordering(self, request, queryset):
+        ordering = super(PageChangeList, self).get_ordering(request, queryset)
+        # Site and URL are unique together, so ordering by both is already
+        # a total ordering, and one their index can give without sorting.
+        if ordering and ordering[0].lstrip('-') == 'url':
+            direction = ordering[0][:-len('url')]
+            ordering = [direction + 'site', direction + 'url']
+        return ordering
+
+    def get_results(self, request):
+        # Like the stock version, except the total for a filtered list is
+        # estimated too, rather than counting the whole table.
+        paginator = self.model_admin.get_paginator(request, self.query_set,
+                                                   self.list_per_page)
+        paginator.count_from = self.page_num * self.list_per_page
+        result_count = paginator.count
+        if not self.query_set.query.where:
+            full_result_count = result_count
+        else:
+            full_result_count = estimate_count(self.root_query_set)[0]
+        if paginator.count_is_estimate and self.query_set.query.where:
+            messages.info(request, u"There are too many matching pages to "
+                          u"count, so the number of them is a rough guess. "
+                          u"Page on to see more.", fail_silently=True)
+
+        can_show_all = result_count <= self.list_max_show_all
+        multi_page = result_count > self.list_per_page
+
+        if (self.show_all and can_show_all) or not multi_page:
+            result_list = self.query_set._clone()
+        else:
+            try:
+                result_list = paginator.page(self.page_num + 1).object_list
+            except InvalidPage:
+                raise IncorrectLookupParameters
+
+        self.result_count = result_count
+        self.full_result_count = full_result_count
+        self.result_list = result_list
+        self.can_show_all = can_show_all
+        self.multi_page = multi_page
+        self.paginator = paginator
@@ -0,0 +1,218 @@
+"""
+Keep a slow or broken cache backend from slowing down every request.
+
+PageMiddleware looks in the cache on every request, so if memcached hangs,
+the whole site hangs with it. Page lookups, cached responses and fragments go
+through page_cache instead, which wraps the cache in a circuit breaker:
+
+  - A call that raises, or takes longer than CACHE_LATENCY_BUDGET seconds,
+    counts as a failure. (Python can't abandon a call that's already running,
+    so set your cache backend's own socket timeout too; the budget is what
+    decides that a backend is too slow to keep using.)
+  - After CACHE_FAILURE_THRESHOLD failures in a row, the breaker opens. Until
+    it closes, cache reads act as misses and writes are skipped, without
+    touching the backend, and database lookups for pages run at most
+    DEGRADED_DB_CONCURRENCY at a time, so the database isn't stampeded. (A
+    URL index, if there is one, still answers for missing pages first.)
+  - After CACHE_RETRY_AFTER seconds, one call is let through as a probe. If
+    it's quick and succeeds, the breaker closes; if not, it stays open.
+
+    FLEXIBLE_PAGES = {
+        'CACHE_LATENCY_BUDGET': 0.05,
+        'CACHE_FAILURE_THRESHOLD': 5,
+        'CACHE_RETRY_AFTER': 30,
+        'DEGRADED_DB_CONCURRENCY': 4,
+    }
+
+Invalidations always go to the backend (failures are only logged), since
+dropping one would leave a stale page behind once the cache recovers.
+The breaker's state and counters are shown at the "timings/" URL of the Page
+admin.
+"""
+import contextlib
+import logging
+import threading
+import time
+
+from django.core.cache import cache
+
+from .utils import get_app_settings
+
+
+log = logging.getLogger('pages.breaker')
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+LATENCY_BUDGET = 0.05
+FAILURE_THRESHOLD = 5
+RETRY_AFTER = 30
+DEGRADED_DB_CONCURRENCY = 4
+
+
+class CircuitBreaker(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.state = CLOSED
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+            self.stats = dict.fromkeys(('calls', 'errors', 'slow', 'rejected',
+                                        'opened', 'closed'), 0)
+
+    @property
+    def is_closed(self):
+        return self.state == CLOSED
+
+    def allow(self):
+        """
+        May a call go through to the backend right now?
+        """
+        with self.lock:
+            if self.state == CLOSED:
+                self.stats['calls'] += 1
+                return True
+            retry_after = get_app_settings().get('CACHE_RETRY_AFTER',
+                                                 RETRY_AFTER)
+            if (not self.probing and
+                    time.time() - self.opened_at >= retry_after):
+                # Half open: let this one call find out if it's better.
+                self.state = HALF_OPEN
+                self.probing = True
+                self.stats['calls'] += 1
+                return True
+            self.stats['rejected'] += 1
+            return False
+
+    def record(self, succeeded, failure=None):
+        """
+        Record how a call went, and on failure, which stat it counts towards.
+        """
+        with self.lock:
+            self.probing = False
+            if failure is not None:
+                self.stats[failure] += 1
+            if succeeded:
+                self.failures = 0
+                if self.state != CLOSED:
+                    self.state = CLOSED
+                    self.stats['closed'] += 1
+                    log.warning("Page cache circuit closed again.")
+                return
+
+            self.failures += 1
+            threshold = get_app_settings().get('CACHE_FAILURE_THRESHOLD',
+                                               FAILURE_THRESHOLD)
+            if self.state == HALF_OPEN or self.failures >= threshold:
+                if self.state == CLOSED:
+                    self.stats['opened'] += 1
+                    log.error("Page cache circuit opened after %d failed or "
+                              "slow calls.", self.failures)
+                self.state = OPEN
+                self.opened_at = time.time()
+
+    def call(self, fallback, function, *args, **kwargs):
+        """
+        Call the function through the breaker. If the breaker's open, or the
+        call fails, return the fallback instead.
+        """
+        if not self.allow():
+            return fallback
+
+        started = time.time()
+        try:
+            result = function(*args, **kwargs)
+        except Exception:
+            log.exception("Page cache call failed.")
+            self.record(False, 'errors')
+            return fallback
+
+        budget = get_app_settings().get('CACHE_LATENCY_BUDGET', LATENCY_BUDGET)
+        if time.time() - started > budget:
+            # The answer's still good, but a backend this slow is costing
+            # every request more than a trip to the database would.
+            self.record(False, 'slow')
+        else:
+            self.record(True)
+        return result
+
+    def format_report(self):
+        lines = ['Page cache circuit: {}'.format(self.state)]
+        lines.extend('    {:<10} {}'.format(name, self.stats[name])
+                     for name in sorted(self.stats))
+        return '\n'.join(lines)
+
+
+class GuardedCache(object):
+    """
+    The subset of Django's cache API that pages uses, through a breaker.
+    """
+
+    def __init__(self, cache, breaker):
+        self.cache = cache
+        self.breaker = breaker
+
+    def get(self, key, default=None):
+        return self.breaker.call(default, self.cache.get, key, default)
+
+    def get_many(self, keys):
+        return self.breaker.call({}, self.cache.get_many, keys)
+
+    def set(self, key, value, timeout=None):
+        self.breaker.call(None, self.cache.set, key, value, timeout)
+
+    def set_many(self, data, timeout=None):
+        self.breaker.call(None, self.cache.set_many, data, timeout)
+
+    def add(self, key, value, timeout=None):
+        return self.breaker.call(False, self.cache.add, key, value, timeout)
+
+    # Invalidations skip the breaker: they're rare, and skipping one would
+    # leave something stale behind once the cache recovers.
+
+    def delete_many(self, keys):
+        try:
+            self.cache.delete_many(keys)
+        except Exception:
+            log.exception("Couldn't delete page cache keys: %s", keys)
+
+    def invalidate(self, key, value, timeout=None):
+        """
+        Set a key that marks other keys as stale (like a generation).
+        """
+        try:
+            self.cache.set(key, value, timeout)
+        except Exception:
+            log.exception("Couldn't set page cache key: %s", key)
+
+
+breaker = CircuitBreaker()
+page_cache = GuardedCache(cache, breaker)
+
+_db_slots = None
+_db_slots_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def database_slot():
+    """
+    While the cache is out, limit how many page lookups hit the database at
+    once. Otherwise, do nothing.
+    """
+    global _db_slots
+
+    if breaker.is_closed:
+        yield
+        return
+
+    with _db_slots_lock:
+        if _db_slots is None:
+            _db_slots = threading.BoundedSemaphore(get_app_settings().get(
+                'DEGRADED_DB_CONCURRENCY', DEGRADED_DB_CONCURRENCY))
+    with _db_slots:
+        yield
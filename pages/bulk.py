@@ -0,0 +1,264 @@
+"""
+Import (and update) lots of pages at once.
+
+Saving pages one at a time runs full_clean() on each (a uniqueness query, plus
+importing its view) and clears the cache for each. That's fine in the admin,
+but far too slow when migrating tens of thousands of pages. PageImporter
+instead reads rows as a stream and validates and writes them in batches:
+
+  - one query per batch finds which URLs already exist,
+  - views and templates are each checked once per distinct name,
+  - new pages go in with bulk_create, existing ones with per-row updates,
+    and each batch is its own transaction,
+  - each batch's pages are added to the search index together,
+  - caches and indexes are brought up to date once, at the end. A large
+    import retires its site's whole cache namespace (see pages.sites) rather
+    than deleting keys path by path, and rebuilds the URL index rather than
+    journaling each path; other sites' cached pages are untouched.
+
+Rows are dictionaries with any of these keys (url and title are required):
+title, url, summary, view, template, match_prefix. Every row goes to the same
+site, the default one unless another is given.
+"""
+import codecs
+import csv
+import json
+import re
+
+from django.db import transaction
+from django.db.models import F
+from django.template import TemplateDoesNotExist
+from django.template.loader import find_template
+
+from . import sites, validators
+from .breaker import page_cache
+from .purge import enqueue_purge
+from .search import index_pages
+from .url_index import (build_index, get_index_key, get_index_path,
+                        update_index)
+from .utils import get_view_callable
+
+
+FIELDS = ('title', 'url', 'summary', 'view', 'template', 'match_prefix')
+TEXT_FIELDS = ('title', 'url', 'summary', 'view', 'template')
+TRUE_STRINGS = ('1', 'true', 'yes', 'y', 'on')
+# Only new pages get these; an update leaves out what its row leaves out.
+NEW_PAGE_DEFAULTS = {'summary': '', 'view': '', 'template': ''}
+
+# Past this many changed paths, it's cheaper to retire the site's namespace.
+NAMESPACE_BUMP_THRESHOLD = 1000
+
+BETWEEN_OBJECTS_RE = re.compile(r'[\s,\[\]]*')
+
+
+def read_json(f, chunk_size=64*1024):
+    """
+    Yield objects from a JSON array (or from JSON Lines), without loading the
+    whole file.
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    buf, pos, eof = u'', 0, False
+
+    while True:
+        # Skip over anything between objects.
+        pos = BETWEEN_OBJECTS_RE.match(buf, pos).end()
+
+        if pos < len(buf):
+            try:
+                obj, pos = decoder.raw_decode(buf, pos)
+            except ValueError:
+                # Probably a partial object; read more, unless there isn't any.
+                if eof:
+                    raise
+            else:
+                yield obj
+                continue
+        elif eof:
+            return
+
+        chunk = f.read(chunk_size)
+        eof = not chunk
+        buf = buf[pos:] + (utf8.decode(chunk, final=eof)
+                           if isinstance(chunk, str) else chunk)
+        pos = 0
+
+
+def read_csv(f):
+    """
+    Yield rows from a CSV file with a header line naming the fields. A short
+    row leaves out the fields it doesn't reach.
+    """
+    for row in csv.DictReader(f):
+        # Extra values go under None; missing ones are None.
+        yield dict((key, value.decode('utf-8'))
+                   for key, value in row.items()
+                   if key is not None and value is not None)
+
+
+class PageImporter(object):
+    def __init__(self, batch_size=500, dry_run=False, site_id=None):
+        from .models import Page
+        self.model = Page
+        self.batch_size = batch_size
+        self.dry_run = dry_run
+        self.site_id = sites.resolve_site_id(site_id)
+
+        self.created = 0
+        self.updated = 0
+        # (row number, URL, message) for each row we couldn't import.
+        self.errors = []
+        self.touched_paths = set()
+        self.updated_pks = []
+
+        # Each distinct view and template is only checked once.
+        self.template_cache = {}
+
+    # VALIDATION --------------------------------------------------------------
+
+    def template_exists(self, name):
+        if name not in self.template_cache:
+            try:
+                find_template(name)
+            except TemplateDoesNotExist:
+                self.template_cache[name] = False
+            else:
+                self.template_cache[name] = True
+        return self.template_cache[name]
+
+    def clean_row(self, row):
+        """
+        Return a dictionary of the model field values the row gives, or raise
+        ValueError.
+        """
+        values = {}
+        for field in FIELDS:
+            if field in row and row[field] is not None:
+                values[field] = row[field]
+
+        for field in TEXT_FIELDS:
+            if field in values and not isinstance(values[field], basestring):
+                raise ValueError("The {} should be text, not {!r}.".format(
+                    field, values[field]))
+        if 'match_prefix' in values:
+            match_prefix = values['match_prefix']
+            if isinstance(match_prefix, basestring):
+                match_prefix = match_prefix.strip().lower() in TRUE_STRINGS
+            elif not isinstance(match_prefix, (bool, int, long)):
+                raise ValueError("match_prefix should be true or false, not "
+                                 "{!r}.".format(match_prefix))
+            values['match_prefix'] = bool(match_prefix)
+
+        if not values.get('url'):
+            raise ValueError("A URL is required.")
+        if not validators.is_root_relative_url(values['url']):
+            raise ValueError("The URL must start and end with a slash, and it "
+                             "can only contain letters, numbers, and hyphens.")
+        if not values.get('title'):
+            raise ValueError("A title is required.")
+
+        for field in TEXT_FIELDS:
+            max_length = self.model._meta.get_field(field).max_length
+            if len(values.get(field, '')) > max_length:
+                raise ValueError("The {} is longer than {} characters.".format(
+                    field, max_length))
+
+        if values.get('view') and get_view_callable(values['view']) is None:
+            raise ValueError("Custom view couldn't be loaded: {}".format(
+                values['view']))
+        if (values.get('template') and
+                not self.template_exists(values['template'])):
+            raise ValueError("Template couldn't be found: {}".format(
+                values['template']))
+
+        return values
+
+    # IMPORTING ---------------------------------------------------------------
+
+    def import_batch(self, numbered_rows):
+        cleaned = []
+        seen = set()
+        for number, row in numbered_rows:
+            try:
+                values = self.clean_row(row)
+            except ValueError as e:
+                self.errors.append((number, row.get('url'), unicode(e)))
+                continue
+            if values['url'] in seen:
+                self.errors.append((number, values['url'],
+                                    u"That URL appears twice in one batch."))
+                continue
+            seen.add(values['url'])
+            cleaned.append(values)
+
+        if not cleaned:
+            return
+
+        # One query tells us which of these are updates.
+        site_pages = self.model.objects.filter(site=self.site_id)
+        existing = dict(site_pages
+                        .filter(url__in=[v['url'] for v in cleaned])
+                        .values_list('url', 'pk'))
+        new_pages = [self.model(site_id=self.site_id, revision=1,
+                                **dict(NEW_PAGE_DEFAULTS, **v))
+                     for v in cleaned if v['url'] not in existing]
+        updates = [(existing[v['url']], v) for v in cleaned
+                   if v['url'] in existing]
+
+        if not self.dry_run:
+            with transaction.commit_on_success():
+                self.model.objects.bulk_create(new_pages)
+                for pk, values in updates:
+                    self.model.objects.filter(pk=pk).update(
+                        revision=F('revision') + 1, **values)
+                index_pages(site_pages.filter(
+                    url__in=[v['url'] for v in cleaned]))
+
+        self.created += len(new_pages)
+        self.updated += len(updates)
+        self.touched_paths.update(v['url'] for v in cleaned)
+        self.updated_pks.extend(pk for pk, values in updates)
+
+    def import_rows(self, rows):
+        """
+        Import an iterable of row dictionaries, a batch at a time.
+        """
+        batch = []
+        for number, row in enumerate(rows, 1):
+            batch.append((number, row))
+            if len(batch) >= self.batch_size:
+                self.import_batch(batch)
+                batch = []
+        if batch:
+            self.import_batch(batch)
+
+        if not self.dry_run:
+            self.finish()
+        return self
+
+    def finish(self):
+        """
+        Bring caches and indexes up to date, once, after everything's in.
+        """
+        paths = list(self.touched_paths)
+        if len(paths) > NAMESPACE_BUMP_THRESHOLD:
+            sites.bump_namespace(self.site_id)
+        else:
+            keys = []
+            for path in paths:
+                keys.extend(self.model.get_cache_keys_for_path(path,
+                                                               self.site_id))
+            page_cache.delete_many(keys)
+
+        self.model.objects.bump_prefix_generation(self.site_id)
+        if get_index_path():
+            if len(paths) > NAMESPACE_BUMP_THRESHOLD:
+                build_index(get_index_path())
+            else:
+                pages = self.model.objects.filter(site=self.site_id,
+                                                  url__in=paths)
+                update_index(get_index_path(), dict(
+                    (get_index_key(url, self.site_id), pk)
+                    for url, pk in pages.values_list('url', 'pk')))
+        enqueue_purge([self.model(pk=pk).get_surrogate_key()
+                       for pk in self.updated_pks])
@@ -0,0 +1,86 @@
+import threading
+import time
+from optparse import make_option
+
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+
+from ...managers import PageManager
+from ...models import Page
+from ...utils import get_app_settings
+
+
+class Command(BaseCommand):
+    help = ("Look pages up from many threads at once, with cache misses "
+            "coalesced and without, and compare lookups per second and how "
+            "many database queries each way needed.")
+    option_list = BaseCommand.option_list + (
+        make_option('--threads', type='int', default=32,
+                    help="How many threads look pages up at once."),
+        make_option('--rounds', type='int', default=50,
+                    help="How many times to empty the cache and look every "
+                         "page up again."),
+        make_option('--pages', type='int', default=10,
+                    help="How many pages to look up."),
+    )
+
+    def handle(self, *args, **options):
+        paths = list(Page.objects.order_by('pk')
+                     .values_list('url', flat=True)[:options['pages']])
+        if not paths:
+            raise CommandError("There aren't any pages to look up.")
+
+        for coalesce in (False, True):
+            app_settings = dict(get_app_settings(), COALESCE_MISSES=coalesce)
+            with override_settings(FLEXIBLE_PAGES=app_settings):
+                lookups, queries, elapsed = self.run(paths, **options)
+            self.stdout.write(
+                "{:<13} {:>9.0f} lookups/s, {:>6} database queries for "
+                "{} lookups".format(
+                    "Coalesced:" if coalesce else "Uncoalesced:",
+                    lookups / elapsed, queries, lookups))
+
+    def run(self, paths, threads, rounds, **options):
+        queries = [0]
+        lock = threading.Lock()
+        get_from_db = PageManager.get_from_db
+
+        def counting_get_from_db(manager, *args, **kwargs):
+            with lock:
+                queries[0] += 1
+            return get_from_db(manager, *args, **kwargs)
+
+        def look_up(barrier):
+            barrier.wait()
+            try:
+                for path in paths:
+                    try:
+                        Page.objects.get_for_url(path)
+                    except Page.DoesNotExist:
+                        pass
+            finally:
+                connection.close()
+
+        PageManager.get_from_db = counting_get_from_db
+        elapsed = 0.0
+        try:
+            for _ in range(rounds):
+                cache.delete_many([Page.get_key_for_path(path)
+                                   for path in paths])
+                # Every thread starts at once, so they all miss together.
+                barrier = threading.Event()
+                workers = [threading.Thread(target=look_up, args=(barrier,))
+                           for _ in range(threads)]
+                for worker in workers:
+                    worker.start()
+                started = time.time()
+                barrier.set()
+                for worker in workers:
+                    worker.join()
+                elapsed += time.time() - started
+        finally:
+            PageManager.get_from_db = get_from_db
+
+        return threads * rounds * len(paths), queries[0], elapsed
@@ -0,0 +1,88 @@
+import random
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from ...models import Page
+from ...search import MIN_PREFIX_LENGTH, index_pages, search
+
+
+BATCH_SIZE = 500
+
+
+def make_vocabulary(rng, size):
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    words = set()
+    while len(words) < size:
+        words.add(''.join(rng.choice(letters)
+                          for _ in range(rng.randint(3, 10))))
+    return sorted(words)
+
+
+def percentile(timings, fraction):
+    return timings[min(len(timings) - 1, int(len(timings) * fraction))]
+
+
+class Command(BaseCommand):
+    help = ("Time pages.search against a large set of made-up pages. They're "
+            "created inside a transaction that's rolled back afterwards, so "
+            "nothing is left behind.")
+    option_list = BaseCommand.option_list + (
+        make_option('--pages', type='int', default=100000,
+                    help="How many pages to search through."),
+        make_option('--queries', type='int', default=500,
+                    help="How many searches to time."),
+        make_option('--seed', type='int', default=0,
+                    help="Seed for the made-up text, for repeatable runs."),
+    )
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        vocabulary = make_vocabulary(rng, 20000)
+
+        def words(count):
+            # Favor the start of the list, so some words are much more
+            # common than others, like real text.
+            return u' '.join(vocabulary[int(len(vocabulary) *
+                                            rng.random() ** 3)]
+                             for _ in range(count))
+
+        with transaction.commit_manually():
+            try:
+                started = time.time()
+                for start in range(0, options['pages'], BATCH_SIZE):
+                    stop = min(start + BATCH_SIZE, options['pages'])
+                    urls = [u'/search-benchmark-{}/'.format(i)
+                            for i in range(start, stop)]
+                    Page.objects.bulk_create([
+                        Page(title=words(5), summary=words(25), url=url)
+                        for url in urls])
+                    index_pages(Page.objects.filter(url__in=urls))
+                self.stdout.write("Created and indexed {} pages in "
+                                  "{:.1f}s.".format(options['pages'],
+                                                    time.time() - started))
+
+                timings = []
+                results = 0
+                for _ in range(options['queries']):
+                    query = words(rng.randint(1, 2))
+                    if rng.random() < 0.5:
+                        # Half of the searches are prefixes of words.
+                        query = query[:max(MIN_PREFIX_LENGTH,
+                                           len(query) - 3)]
+                    started = time.time()
+                    results += len(search(query))
+                    timings.append((time.time() - started) * 1000)
+            finally:
+                transaction.rollback()
+
+        timings.sort()
+        self.stdout.write(
+            "{} searches, {:.1f} results each on average.\n"
+            "Latency (ms): min {:.2f}, median {:.2f}, 95th {:.2f}, "
+            "99th {:.2f}, max {:.2f}".format(
+                len(timings), float(results) / len(timings), timings[0],
+                percentile(timings, 0.5), percentile(timings, 0.95),
+                percentile(timings, 0.99), timings[-1]))
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from ...url_index import build_index, get_index_path
+
+
+class Command(BaseCommand):
+    args = '[index path]'
+    help = ("Rebuild the shared URL index of every page from the database. "
+            "Defaults to URL_INDEX_PATH in FLEXIBLE_PAGES.")
+
+    def handle(self, *args, **options):
+        if len(args) > 1:
+            raise CommandError("Give at most one index path.")
+        path = args[0] if args else get_index_path()
+        if not path:
+            raise CommandError("Give an index path, or set URL_INDEX_PATH in "
+                               "FLEXIBLE_PAGES.")
+
+        count = build_index(path)
+        self.stdout.write("Indexed {} page URLs in {}.".format(count, path))
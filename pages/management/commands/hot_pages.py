@@ -0,0 +1,50 @@
+import csv
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from ...popularity import decay_access_counts, get_hot_paths
+from ...warmup import warm_page_cache
+
+
+class Command(BaseCommand):
+    help = ("List the most requested page paths, as counted by "
+            "pages.popularity, hottest first. Can also fade old counts, and "
+            "load the hottest pages into the cache.")
+    option_list = BaseCommand.option_list + (
+        make_option('--limit', type='int', default=50,
+                    help="How many paths to list (or warm)."),
+        make_option('--site', type='int', default=None,
+                    help="Only list paths on the site with this id."),
+        make_option('--csv', action='store_true', default=False,
+                    help="Write rank, hits, site id and path as CSV."),
+        make_option('--decay', type='int', default=None, metavar='DIVISOR',
+                    help="First divide every count by this, so older "
+                         "traffic counts for less. Run it from cron."),
+        make_option('--warm', action='store_true', default=False,
+                    help="Look the hottest pages up, so they're cached."),
+    )
+
+    def handle(self, *args, **options):
+        if options['decay']:
+            dropped = decay_access_counts(options['decay'])
+            self.stderr.write("Divided counts by {}; dropped {} paths.".format(
+                options['decay'], dropped))
+
+        if options['warm']:
+            found = warm_page_cache(options['limit'], options['site'])
+            self.stderr.write("Warmed {} pages.".format(found))
+
+        hot_paths = get_hot_paths(options['limit'], options['site'])
+        if options['csv']:
+            writer = csv.writer(self.stdout)
+            writer.writerow(['rank', 'hits', 'site', 'path'])
+            for rank, (site_id, path, hits) in enumerate(hot_paths, 1):
+                writer.writerow([rank, hits, site_id, path.encode('utf-8')])
+            return
+
+        if not hot_paths:
+            self.stdout.write("No page requests have been counted yet.")
+        for rank, (site_id, path, hits) in enumerate(hot_paths, 1):
+            self.stdout.write(u"{:>4}. {:>10}  site {:<4} {}".format(
+                rank, hits, site_id, path))
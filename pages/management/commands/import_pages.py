@@ -0,0 +1,49 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...bulk import PageImporter, read_csv, read_json
+
+
+class Command(BaseCommand):
+    args = '<file>'
+    help = ("Create or update pages from a JSON (array or JSON Lines) or CSV "
+            "file, in batches.")
+    option_list = BaseCommand.option_list + (
+        make_option('--format', choices=('json', 'csv'), default=None,
+                    help="The file's format. Defaults to guessing from its "
+                         "extension."),
+        make_option('--batch-size', type='int', default=500,
+                    help="How many rows to validate and write at a time."),
+        make_option('--dry-run', action='store_true', default=False,
+                    help="Validate everything, but don't save anything."),
+        make_option('--site', type='int', default=None,
+                    help="The id of the site the pages belong to. Defaults "
+                         "to SITE_ID."),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Give exactly one file to import.")
+        path = args[0]
+
+        file_format = options['format']
+        if file_format is None:
+            file_format = 'csv' if path.lower().endswith('.csv') else 'json'
+        read_rows = read_csv if file_format == 'csv' else read_json
+
+        importer = PageImporter(batch_size=options['batch_size'],
+                                dry_run=options['dry_run'],
+                                site_id=options['site'])
+        with open(path, 'rb') as f:
+            try:
+                importer.import_rows(read_rows(f))
+            except ValueError as e:
+                raise CommandError("Couldn't read {}: {}".format(path, e))
+
+        for number, url, message in importer.errors:
+            self.stderr.write(u"Row {} ({}): {}".format(number, url, message))
+        self.stdout.write(
+            "{}Created {}, updated {}, skipped {} invalid.".format(
+                "(Dry run) " if options['dry_run'] else "",
+                importer.created, importer.updated, len(importer.errors)))
@@ -0,0 +1,36 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...prerender import prerender_pages
+from ...utils import get_app_settings
+
+
+class Command(BaseCommand):
+    args = '[output directory]'
+    help = ("Render every page to a static HTML file, skipping pages that "
+            "haven't changed since the last build.")
+    option_list = BaseCommand.option_list + (
+        make_option('--processes', type='int', default=None,
+                    help="How many worker processes to render with. Defaults "
+                         "to the number of CPUs."),
+        make_option('--force', action='store_true', default=False,
+                    help="Re-render every page, changed or not."),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) > 1:
+            raise CommandError("Give at most one output directory.")
+        output_dir = args[0] if args else get_app_settings().get(
+            'PRERENDER_DIR')
+        if not output_dir:
+            raise CommandError("Give an output directory, or set "
+                               "PRERENDER_DIR in FLEXIBLE_PAGES.")
+
+        counts = prerender_pages(output_dir,
+                                 processes=options['processes'],
+                                 force=options['force'])
+
+        self.stdout.write("Rendered {rendered}, skipped {skipped} unchanged, "
+                          "removed {removed}, failed {failed}.".format(
+                              **counts))
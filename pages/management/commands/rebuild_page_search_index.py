@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from ...search import rebuild_index
+
+
+class Command(BaseCommand):
+    help = ("Index the text of every page for pages.search. Saving a page "
+            "keeps its own entries up to date, so this is only needed for "
+            "pages that were loaded some other way (like fixtures).")
+
+    def handle(self, *args, **options):
+        count = rebuild_index()
+        self.stdout.write("Indexed {} pages.".format(count))
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from ...warmup import warm_page_views
+
+
+class Command(BaseCommand):
+    help = ("Import every custom view referenced by a page, and report how "
+            "long each one took (or whether it failed).")
+
+    def handle(self, *args, **options):
+        report = warm_page_views(close_connections=False)
+
+        if not report:
+            self.stdout.write("No pages use a custom view.")
+
+        # Slowest first, since those are the ones worth looking into.
+        for view_string, elapsed, view in sorted(report, key=lambda r: -r[1]):
+            status = "ok" if view is not None else "FAILED"
+            self.stdout.write("{:>9.4f}s  {:<6}  {}".format(elapsed, status,
+                                                         view_string))
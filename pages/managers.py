@@ -1,52 +1,134 @@
 import logging
+import time
+import uuid
 
-from django.core.cache import cache
 from django.db import models
 
-from . import validators
+from . import popularity, routers, sites, timing, validators
+from .breaker import breaker, database_slot, page_cache
+from .radix import RadixTree
+from .singleflight import SingleFlight
+from .url_index import get_index_key, get_url_index
+from .utils import get_app_settings
 
 
 log = logging.getLogger('pages.cache')
 
+# This process's tree of prefix pages for each site:
+# {site id: (generation, tree, last checked)}.
+_prefix_state = {}
+
+# Database lookups for paths that missed the cache, shared between threads
+# that miss on the same path at the same time.
+_misses = SingleFlight()
+
 
 class PageManager(models.Manager):
     # This is what we'll put in the cache, to mark a non-existent page.
     CACHE_404_VALUE = -1
     CACHE_TIMEOUT = 2*60
 
-    def get_from_db(self, path, path_key):
+    # Prefix pages are kept in a tree per site in each process. When one
+    # changes, its site's generation in the cache changes, and each process
+    # rebuilds that site's tree the next time it checks.
+    PREFIX_GENERATION_KEY = 'flexible_page_prefix_generation_{}'
+    PREFIX_GENERATION_TIMEOUT = 30*24*60*60
+    PREFIX_CHECK_INTERVAL = 1
+
+    def set_in_cache(self, path, path_key, value, site_id=None):
+        """
+        Cache a database lookup's result (a page or 404 marker, or a prefix
+        page's route), for as long as the path's popularity earns it (see
+        pages.popularity).
+        """
+        timeout = popularity.get_cache_timeout(site_id, path,
+                                               self.CACHE_TIMEOUT, path_key)
+        if timeout is None:
+            log.debug("Not caching this path until it's looked up again: %s",
+                      path_key)
+            return
+        page_cache.set(path_key, value, timeout)
+        log.debug("Set in cache: %s = %s", path_key, value)
+
+    def get_from_db(self, path, path_key, site_id=None):
         """
         Hit the database, cache the result, and return/raise when done.
         """
+        site_id = sites.resolve_site_id(site_id)
+        # If this page was just saved, a replica might not have it yet.
+        pinned = routers.is_path_pinned(path, site_id)
+
         # This is our actual query!
         try:
-            page = self.get_query_set().filter(url=path)[:1][0]
+            with timing.stage('db'), routers.pinned_reads(pinned):
+                with database_slot():
+                    page = self.get_query_set().filter(site=site_id,
+                                                       url=path)[:1][0]
         # If it's not in the DB, update the cache with that.
         except IndexError:
-            cache.set(path_key, self.CACHE_404_VALUE, self.CACHE_TIMEOUT)
-            log.debug("Set in cache: %s = %s",
-                      path_key,
-                      cache.get(path_key, 'not found in cache'))
+            self.set_in_cache(path, path_key, self.CACHE_404_VALUE, site_id)
             raise self.model.DoesNotExist("That path couldn't be found in the "
                                           "cache, nor in the database.")
         # If nothing went wrong, store the page in the cache.
         else:
-            cache.set(path_key, page, self.CACHE_TIMEOUT)
-            log.debug("Set in cache: %s = %s",
-                      path_key,
-                      cache.get(path_key, 'not found in cache'))
+            if pinned:
+                routers.mark_pinned(page)
+            self.set_in_cache(path, path_key, page, site_id)
             return page
 
-    def get_from_cache(self, path):
+    def get_prefix_generation_key(self, site_id=None):
+        return self.PREFIX_GENERATION_KEY.format(
+            sites.resolve_site_id(site_id))
+
+    def prefetch(self, path, site_id=None, response=False):
+        """
+        Fetch everything a lookup of this path might need from the cache, in
+        one round trip: its page (or 404 marker), the prefix page that last
+        covered it, and the site's prefix generation, plus its cached
+        response if asked. Pass the result to get_for_request_path().
+
+        Every key asked for is in the result, with None for a miss, so later
+        lookups can tell a miss from a key that wasn't fetched.
+        """
+        site_id = sites.resolve_site_id(site_id)
+        namespace_key = sites.get_namespace_key(site_id)
+        namespace = sites.get_local_namespace(site_id)
+        if namespace is None:
+            namespace = sites.get_namespace(site_id)
+
+        # The keys depend on the site's namespace, which comes back with
+        # them. Only if it just changed do we need to go back for the rest.
+        for attempt in range(2):
+            keys = [self.model.get_key_for_path(path, site_id, namespace),
+                    self.model.get_route_key_for_path(path, site_id,
+                                                      namespace),
+                    self.get_prefix_generation_key(site_id)]
+            if response:
+                keys.append(self.model.get_response_key_for_path(
+                    path, site_id, namespace))
+            with timing.stage('cache'):
+                values = page_cache.get_many(keys + [namespace_key])
+            current = sites.note_namespace(site_id, values.get(namespace_key))
+            if current == namespace:
+                break
+            namespace = current
+        return dict((key, values.get(key)) for key in keys)
+
+    def get_from_cache(self, path, prefetched=None, site_id=None):
         """
         Hit the cache for a URL, and if it's not there, hit the database.
         """
+        site_id = sites.resolve_site_id(site_id)
         # This is the cache key for the given path - safer than putting the
         # path in directly.
-        path_key = self.model.get_key_for_path(path)
+        path_key = self.model.get_key_for_path(path, site_id)
 
-        # Hit the cache!
-        cache_value = cache.get(path_key, None)
+        # Hit the cache (unless we already have)!
+        if prefetched is not None and path_key in prefetched:
+            cache_value = prefetched[path_key]
+        else:
+            with timing.stage('cache'):
+                cache_value = page_cache.get(path_key, None)
 
         # If a 404 was cached, RAISE that.
         if cache_value == self.CACHE_404_VALUE:
@@ -59,7 +141,7 @@ class PageManager(models.Manager):
         # If a page was cached:
         if isinstance(cache_value, self.model):
             # Just to be safe, make sure the URL matches. If it does, RETURN.
-            if cache_value.url == path:
+            if cache_value.url == path and cache_value.site_id == site_id:
                 log.debug("Hit the cache and found the Page:         %s %s",
                           path.ljust(30),
                           path_key)
@@ -80,8 +162,16 @@ class PageManager(models.Manager):
 
         # If it wasn't cached, hit the DB (caching it as well), and return the
         # result. Let any errors be raised: they should be handled higher up.
+        # Other threads that miss on this path meanwhile (reading from the
+        # same database) wait for this lookup, rather than repeating it,
+        # unless COALESCE_MISSES is turned off.
         try:
-            db_value = self.get_from_db(path, path_key)
+            if get_app_settings().get('COALESCE_MISSES', True):
+                key = (path_key, routers.reading_from_replica())
+                db_value = _misses.do(key, self.get_from_db, path, path_key,
+                                      site_id)
+            else:
+                db_value = self.get_from_db(path, path_key, site_id)
         except self.model.DoesNotExist as e:
             log.debug("Hit the database, and didn't find a Page: %s %s",
                       path.ljust(30),
@@ -93,7 +183,7 @@ class PageManager(models.Manager):
                       path_key)
             return db_value
 
-    def get_for_url(self, path):
+    def get_for_url(self, path, prefetched=None, site_id=None):
         """
         Validate a path, then go through the cache to get it.
         """
@@ -103,6 +193,128 @@ class PageManager(models.Manager):
                                           "exist, because our system wouldn't "
                                           "allow one of that format.")
 
+        # If there's a URL index, it can tell us about missing pages without
+        # a trip to the cache. Pages can be added without a save, though (see
+        # pages.url_index), so a miss is only final if the index is trusted
+        # to have every page, or while the cache is out and the database
+        # needs sparing.
+        index = get_url_index()
+        if index is not None:
+            with timing.stage('index'):
+                page_id = index.lookup(get_index_key(path, site_id))
+            if page_id is None and (
+                    get_app_settings().get('URL_INDEX_AUTHORITATIVE', False) or
+                    not breaker.is_closed):
+                raise self.model.DoesNotExist("That URL isn't in the page URL "
+                                              "index.")
+
         # If so, hit the cache! Let any exceptions rise up for their callers
         # to handle.
-        return self.get_from_cache(path)
+        return self.get_from_cache(path, prefetched, site_id)
+
+    def get_id_for_url(self, path, site_id=None):
+        """
+        Return the id of the page at a URL, or None, preferring the URL index.
+        """
+        # The index might not have a page that was created without a save,
+        # so only trust what it does have.
+        index = get_url_index()
+        if index is not None:
+            page_id = index.lookup(get_index_key(path, site_id))
+            if page_id is not None:
+                return page_id
+        ids = (self.get_query_set()
+               .filter(site=sites.resolve_site_id(site_id), url=path)
+               .values_list('pk', flat=True))
+        return ids[0] if ids else None
+
+    # PREFIX PAGES ------------------------------------------------------------
+
+    def bump_prefix_generation(self, site_id=None):
+        """
+        Tell every process to rebuild its tree of a site's prefix pages.
+        """
+        site_id = sites.resolve_site_id(site_id)
+        # This process should see the change right away.
+        _prefix_state.pop(site_id, None)
+        generation = uuid.uuid4().hex
+        page_cache.invalidate(self.get_prefix_generation_key(site_id),
+                              generation, self.PREFIX_GENERATION_TIMEOUT)
+        return generation
+
+    def get_prefix_tree(self, prefetched=None, site_id=None):
+        """
+        Return a radix tree mapping each of a site's prefix pages' URLs to its
+        own URL.
+        """
+        site_id = sites.resolve_site_id(site_id)
+        state = _prefix_state.get(site_id)
+
+        now = time.time()
+        if state is not None and now - state[2] < self.PREFIX_CHECK_INTERVAL:
+            return state[1]
+
+        generation_key = self.get_prefix_generation_key(site_id)
+        if prefetched is not None and generation_key in prefetched:
+            generation = prefetched[generation_key]
+        else:
+            generation = page_cache.get(generation_key)
+        if generation is None:
+            if not breaker.is_closed and state is not None:
+                # The cache is out, not empty; keep the tree we have.
+                generation = state[0]
+            else:
+                generation = self.bump_prefix_generation(site_id)
+
+        if state is not None and state[0] == generation:
+            tree = state[1]
+        else:
+            with timing.stage('db'):
+                urls = list(self.get_query_set()
+                            .filter(site=site_id, match_prefix=True)
+                            .values_list('url', flat=True))
+            tree = RadixTree((url, url) for url in urls)
+
+        _prefix_state[site_id] = (generation, tree, now)
+        return tree
+
+    def get_for_prefix(self, path, prefetched=None, site_id=None):
+        """
+        Return the prefix page with the longest URL that starts the path.
+        """
+        site_id = sites.resolve_site_id(site_id)
+        with timing.stage('prefix'):
+            tree = self.get_prefix_tree(prefetched, site_id)
+            url = tree.longest_prefix(path)
+        if url is None:
+            raise self.model.DoesNotExist("No prefix page covers that path.")
+        generation = _prefix_state[site_id][0]
+
+        # Which page covered this path last time? That's only still true if
+        # no prefix page has changed since (which includes their content).
+        route_key = self.model.get_route_key_for_path(path, site_id)
+        if prefetched is not None and route_key in prefetched:
+            route = prefetched[route_key]
+            if route is not None and route[0] == generation:
+                return route[1]
+
+        page = self.get_for_url(url, site_id=site_id)
+        # The tree may be a moment behind; don't trust a page that's since
+        # stopped claiming its prefix.
+        if not page.match_prefix:
+            raise self.model.DoesNotExist("No prefix page covers that path.")
+
+        self.set_in_cache(path, route_key, (generation, page), site_id)
+        return page
+
+    def get_for_request_path(self, path, prefetched=None, site_id=None):
+        """
+        Find the page for a request: one at that exact URL on the site if
+        there is one, or else the prefix page that covers it. If the cache
+        values for the path were already fetched (see prefetch()), pass them
+        in.
+        """
+        try:
+            return self.get_for_url(path, prefetched, site_id)
+        except self.model.DoesNotExist:
+            return self.get_for_prefix(path, prefetched, site_id)
@@ -1,4 +1,51 @@
+from django.core.urlresolvers import resolve
+from django.http import Http404
+
+from . import popularity, routers, sites, timing, validators
 from .models import Page
+from .response_cache import cache_response, get_cached_response, get_timeout
+from .utils import get_app_settings
+
+
+def urlpattern_exists(path):
+    try:
+        with timing.stage('resolve'):
+            resolve(path)
+    except Http404:
+        return False
+    return True
+
+
+def get_page_response(page, request):
+    """
+    Render a page the way the middleware would, or return None if its
+    URLpattern view should handle the request instead.
+    """
+    # Should we just let the URLpattern view do its thing, or should we
+    # render here based on the custom (or default) view?
+    if not page.get_custom_view() and page.get_urlpattern_view():
+
+        # The URLpattern view should take precedence, so give up.
+        return None
+
+    # A prefix page doesn't get to override a URLpattern for a path beneath
+    # it, either.
+    if request.path != page.url and urlpattern_exists(request.path):
+        return None
+
+    # If there's a custom view, or if there's no URLpattern-driven view
+    # to pick up the slack, just let the page do what it wants.
+    with timing.stage('view'):
+        response = page.get_response(request)
+
+    # If it's a class-based view that isn't rendered yet (Django's resolver
+    # does that normally), do it ourselves. (A streaming response renders as
+    # it's sent.)
+    if not getattr(response, 'is_rendered', True):
+        with timing.stage('render'):
+            response.render()
+
+    return response
 
 
 class PageMiddleware(object):
@@ -6,28 +53,61 @@ class PageMiddleware(object):
         """
         Before even hitting URLs.py, see if a given URL is covered by a Page.
         """
-        # Check for this page in the CMS.
+        if get_app_settings().get('TIMING', False):
+            request._page_timer = timing.start()
+
+        # Which site is this for? Everything below is looked up within it.
+        site_id = sites.get_site_id(request)
+
+        # Everything a fully cached page needs comes back from the cache in
+        # one round trip: the page, the prefix routing for the path, and the
+        # rendered response (which carries its own validators).
+        prefetched = None
+        if validators.is_root_relative_url(request.path):
+            prefetched = Page.objects.prefetch(request.path, site_id,
+                                               response=bool(get_timeout()))
+
+        # Check for this page (or a prefix page covering it) in the CMS. (If
+        # replicas are set up, this can use one.)
         try:
-            cms_match = Page.objects.get_for_url(request.path)
+            with routers.replica_reads():
+                cms_match = Page.objects.get_for_request_path(
+                    request.path, prefetched, site_id)
         # If none was found, give up and leave it to URLpatterns.
         except Page.DoesNotExist:
             return
 
-        # Should we just let the URLpattern view do its thing, or should we
-        # render here based on the custom (or default) view?
-        if not cms_match.get_custom_view() and cms_match.get_urlpattern_view():
+        # Remember which page this was, for the timing stats, and count (a
+        # sample of) the requests each path gets.
+        request._flexible_page_url = cms_match.url
+        popularity.record_access(site_id, request.path)
 
-            # The URLpattern view should take precedence, so give up.
-            return
+        # If we've already rendered this page, and it's fit to share, use it.
+        with timing.stage('response-cache'):
+            response = get_cached_response(cms_match, request, prefetched)
+        if response is None:
+            with routers.reads_for_page(cms_match):
+                response = get_page_response(cms_match, request)
+            if response is not None:
+                with timing.stage('response-cache'):
+                    cache_response(cms_match, request, response)
+
+        return response
 
-        # If there's a custom view, or if there's no URLpattern-driven view
-        # to pick up the slack, just let the page do what it wants.
-        # would.
-        response = cms_match.get_response(request)
+    def process_response(self, request, response):
+        """
+        If this request was timed, report and record how long it took.
+        """
+        timer = getattr(request, '_page_timer', None)
+        if timer is None:
+            return response
 
-        # If it's a class-based view that isn't rendered yet (Django's resolver
-        # does that normally), do it ourselves.
-        if not response.is_rendered:
-            response.render()
+        timing.stop()
+        timer.finish()
+        response['Server-Timing'] = timer.get_header()
+
+        url = getattr(request, '_flexible_page_url', None)
+        if url is not None:
+            timing.stats.record(url, timer)
 
         return response
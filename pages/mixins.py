@@ -1,4 +1,5 @@
 from .models import Page
+from .sites import get_site_id
 
 
 class FlexiblePageMixin(object):
@@ -49,8 +50,14 @@ class FlexiblePageMixin(object):
 
     def get_flexible_page(self):
         if self.flexible_page is None:
-            # Use the class-based view's request.path to find the page.
-            self.flexible_page = Page.objects.get_for_url(self.request.path)
+            # The middleware hands us the page it found, if it called us.
+            self.flexible_page = getattr(self, 'kwargs', {}).get(
+                'flexible_page')
+        if self.flexible_page is None:
+            # Use the class-based view's request.path to find the page (or a
+            # prefix page that covers it).
+            self.flexible_page = Page.objects.get_for_request_path(
+                self.request.path, site_id=get_site_id(self.request))
         return self.flexible_page
 
     def get_customized_template_names(self, base_template_names):
@@ -1,16 +1,26 @@
 import hashlib
 
-from django.core.cache import cache
-from django.core.exceptions import ValidationError, ViewDoesNotExist
-from django.core.urlresolvers import get_callable, resolve
+from django.contrib.contenttypes.models import ContentType
+from django.contrib.sites.models import Site
+from django.core.exceptions import ValidationError
+from django.core.urlresolvers import resolve
 from django.db import models
+from django.db.models import F
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.http import Http404
 from django.utils.translation import ugettext as _
 
-from flexible_content.models import ContentArea
+from flexible_content.models import BaseItem, ContentArea
 
-from . import validators
+from . import popularity, routers, sites, timing, validators
+from .breaker import page_cache
 from .managers import PageManager
+from .purge import enqueue_purge
+from .prerender import remove_prerendered, schedule_prerender
+from .search import index_page, index_pages
+from .url_index import get_index_key, get_index_path, update_index
+from .utils import get_view_callable
 
 
 class Page(ContentArea):
@@ -19,6 +29,8 @@ class Page(ContentArea):
     middleware, hence the URL field below.
     """
 
+    SITE_HELP_TEXT = _("The site (domain) this page belongs to. Different "
+                       "sites can each have a page at the same URL.")
     TITLE_HELP_TEXT = _("This will be shown on the site, and as a label "
                         "within this CMS.")
     URL_HELP_TEXT = _("This is a root-relative URL that the page should live "
@@ -30,6 +42,11 @@ class Page(ContentArea):
     SUMMARY_HELP_TEXT = _("This may be used on a list page (beneath the "
                           "title), or on search results, or in meta tags for "
                           "SEO purposes.")
+    MATCH_PREFIX_HELP_TEXT = _("If this is checked, this page will also be "
+                               "shown for any URL beneath its own (for "
+                               "example, /docs/ would also handle "
+                               "/docs/install/), unless another page or the "
+                               "site's code claims that URL.")
     VIEW_HELP_TEXT = _("This lets you change how a page functions by "
                        "specifying a different 'view', such as "
                        "'website.views.homepage'. If that doesn't make total "
@@ -42,12 +59,22 @@ class Page(ContentArea):
                            "directories, that could cause problems, so tread "
                            "carefully!")
 
+    site = models.ForeignKey('sites.Site', default=sites.get_default_site_id,
+                             related_name='flexible_pages',
+                             help_text=SITE_HELP_TEXT)
     title = models.CharField(max_length=150, help_text=TITLE_HELP_TEXT)
-    url = models.CharField(max_length=200, verbose_name="URL", unique=True,
+    url = models.CharField(max_length=200, verbose_name="URL",
                            validators=[validators.root_relative_url],
                            help_text=URL_HELP_TEXT)
     summary = models.CharField(max_length=250, blank=True,
                                help_text=SUMMARY_HELP_TEXT)
+    match_prefix = models.BooleanField(default=False,
+                                       verbose_name="Handle URLs beneath this",
+                                       help_text=MATCH_PREFIX_HELP_TEXT)
+
+    # This goes up by one every time the page is saved, so anything derived
+    # from the page (like a pre-rendered copy) can tell whether it's stale.
+    revision = models.PositiveIntegerField(default=0, editable=False)
 
     # These fields allow you to customize a page without messing up your
     # lovely code. :)
@@ -63,6 +90,9 @@ class Page(ContentArea):
     class Meta:
         ordering = ('url',)
         verbose_name = "Page"
+        # Pages are looked up by site and URL together, so this index (site
+        # first) is the one every lookup uses.
+        unique_together = (('site', 'url'),)
 
     def __unicode__(self):
         return self.title
@@ -71,30 +101,156 @@ class Page(ContentArea):
         return self.url
 
     def delete(self, *args, **kwargs):
-        # Store the URL for after we delete it.
+        # Store the URL and proxy keys for after we delete it.
         path_to_clear = unicode(self.url)
+        site_id = self.site_id
+        surrogate_keys = self.get_surrogate_keys()
 
         super(Page, self).delete(*args, **kwargs)
 
         # Delete this entry from the cache, to avoid confusion.
-        cache.delete(Page.get_key_for_path(path_to_clear))
+        routers.pin_path(path_to_clear, site_id)
+        page_cache.delete_many(Page.get_cache_keys_for_path(path_to_clear,
+                                                            site_id))
+        enqueue_purge(surrogate_keys)
+
+        if get_index_path():
+            update_index(get_index_path(),
+                         {get_index_key(path_to_clear, site_id): None})
+        remove_prerendered(site_id, path_to_clear)
+        if self.match_prefix:
+            Page.objects.bump_prefix_generation(site_id)
 
     def save(self, *args, **kwargs):
-        # Force validation and save.
-        self.full_clean()
+        # If the URL (or site) changed, the index needs to forget the old
+        # one, and if it was a prefix page, the prefix trees need rebuilding.
+        old_site_id, old_url, old_match_prefix = None, None, False
+        old_values = []
+        if self.pk is not None:
+            old_values = Page.objects.filter(pk=self.pk).values_list(
+                'site', 'url', 'match_prefix')
+            if old_values:
+                old_site_id, old_url, old_match_prefix = old_values[0]
+
+        # Force validation and save. Validation checks for duplicate URLs, so
+        # it mustn't use a lagging replica.
+        with routers.primary_reads():
+            self.full_clean()
+        if old_values:
+            # Count on from the database's revision, not this instance's:
+            # editing an item bumps it without touching this copy.
+            self.revision = F('revision') + 1
+        else:
+            self.revision += 1
         super(Page, self).save(*args, **kwargs)
+        if old_values:
+            self.revision = Page.objects.filter(pk=self.pk).values_list(
+                'revision', flat=True)[0]
+        index_page(self)
 
         # Delete this entry from the cache, to avoid confusion.
-        cache.delete(Page.get_key_for_path(self.url))
+        routers.pin_path(self.url, self.site_id)
+        page_cache.delete_many(Page.get_cache_keys_for_path(self.url,
+                                                            self.site_id))
+        enqueue_purge([self.get_surrogate_key()])
+
+        moved = old_url and (old_site_id, old_url) != (self.site_id, self.url)
+        if moved:
+            page_cache.delete_many(Page.get_cache_keys_for_path(old_url,
+                                                                old_site_id))
+            remove_prerendered(old_site_id, old_url)
+        if get_index_path():
+            changes = {get_index_key(self.url, self.site_id): self.pk}
+            if moved:
+                changes[get_index_key(old_url, old_site_id)] = None
+            update_index(get_index_path(), changes)
+        if self.match_prefix:
+            Page.objects.bump_prefix_generation(self.site_id)
+        if old_match_prefix and (old_site_id != self.site_id or
+                                 not self.match_prefix):
+            Page.objects.bump_prefix_generation(old_site_id)
+
+    @classmethod
+    def get_path_key(cls, kind, path, site_id=None, namespace=None):
+        """
+        This returns an ASCII-safe key for something cached about a path on a
+        site, in that site's current cache namespace (see pages.sites), unless
+        another namespace is given.
+        """
+        site_id = sites.resolve_site_id(site_id)
+        if namespace is None:
+            namespace = sites.get_namespace(site_id)
+        key = hashlib.sha224(path.encode('utf-8')).hexdigest()
+        return 'flexible_page_{}_{}_{}_{}'.format(kind, site_id, namespace,
+                                                  key)
+
+    @classmethod
+    def get_key_for_path(cls, path, site_id=None, namespace=None):
+        """
+        The key for the page (or 404 marker) at a path.
+        """
+        return cls.get_path_key('url', path, site_id, namespace)
+
+    @classmethod
+    def get_response_key_for_path(cls, path, site_id=None, namespace=None):
+        """
+        The key for a path's cached, rendered response (see response_cache).
+        """
+        return cls.get_path_key('response', path, site_id, namespace)
 
     @classmethod
-    def get_key_for_path(cls, path):
+    def get_route_key_for_path(cls, path, site_id=None, namespace=None):
+        """
+        The key for the prefix page that last covered a path (see
+        PageManager.get_for_prefix).
+        """
+        return cls.get_path_key('route', path, site_id, namespace)
+
+    @classmethod
+    def get_cache_keys_for_path(cls, path, site_id=None):
+        """
+        Every key cached for a path, which should all go when its page does.
+        """
+        return [cls.get_key_for_path(path, site_id),
+                cls.get_route_key_for_path(path, site_id),
+                cls.get_response_key_for_path(path, site_id)]
+
+    # FRAGMENT CACHING --------------------------------------------------------
+
+    def get_item_list_key(self):
+        """
+        The cache key for the ordered list of this revision's content items.
+        """
+        return 'flexible_page_items_{}_{}'.format(self.pk, self.revision)
+
+    def get_item_fragment_key(self, item_pk):
+        """
+        The cache key for one content item's rendered output. Items don't have
+        revisions of their own, so they share their page's: changing an item
+        bumps the page's revision (see touch_content_area).
+        """
+        return 'flexible_page_item_{}_{}'.format(item_pk, self.revision)
+
+    # PROXY CACHING -----------------------------------------------------------
+
+    @staticmethod
+    def get_item_surrogate_key(item_pk):
+        return 'fc-item-{}'.format(item_pk)
+
+    def get_surrogate_key(self):
+        return 'page-{}'.format(self.pk)
+
+    def get_surrogate_keys(self):
         """
-        This returns an ASCII-safe key specific to what we're caching here
-        (the path/url on a given page object).
+        Return the keys a proxy should tag this page's responses with: one for
+        the page itself, and one for each of its content items.
         """
-        key = hashlib.sha224(path).hexdigest()
-        return 'flexible_page_url_{}'.format(key)
+        item_pks = (BaseItem.objects
+                    .filter(content_area_ct=self.get_content_type(),
+                            content_area_id=self.pk)
+                    .values_list('pk', flat=True))
+        return ([self.get_surrogate_key()] +
+                [Page.get_item_surrogate_key(pk) for pk in item_pks])
 
     # VIEW RESOLUTION ---------------------------------------------------------
 
@@ -104,12 +260,10 @@ class Page(ContentArea):
         """
         view = None
 
-        # Try to load a custom view.
+        # Try to load a custom view. Imports are cached per process, and can
+        # be done up front with pages.warmup.warm_page_views().
         if self.view:
-            try:
-                view = get_callable(self.view)
-            except (ImportError, ViewDoesNotExist):
-                pass
+            view = get_view_callable(self.view)
 
         return view
 
@@ -120,7 +274,8 @@ class Page(ContentArea):
 
         # Use Django's built-in to resolve this path.
         try:
-            urlpattern_match = resolve(self.url)
+            with timing.stage('resolve'):
+                urlpattern_match = resolve(self.url)
         # If no match was found, that's cool. If we return None, it'll indicate
         # that there was no URLpattern view.
         except Http404:
@@ -166,3 +321,105 @@ class Page(ContentArea):
 
     def clean(self):
         self.validate_view()
+
+
+class PageSearchToken(models.Model):
+    """
+    One word found on a page, and how much weight it carries there. See
+    pages.search for how these are kept up to date and queried.
+    """
+    token = models.CharField(max_length=40)
+    page = models.ForeignKey(Page, related_name='search_tokens')
+    weight = models.PositiveIntegerField()
+
+    class Meta:
+        # Token first, so a prefix search is a range scan of these indexes,
+        # and a single word's best pages are at the end of the second one.
+        unique_together = (('token', 'page'),)
+        index_together = (('token', 'weight', 'page'),)
+
+
+class PageAccessCount(models.Model):
+    """
+    Roughly how many requests a path on a site has had. See pages.popularity
+    for how these are sampled and used.
+    """
+    site = models.ForeignKey('sites.Site', related_name='+')
+    path = models.CharField(max_length=popularity.MAX_PATH_LENGTH)
+    hits = models.PositiveIntegerField(default=0, db_index=True)
+    last_seen = models.DateTimeField()
+
+    class Meta:
+        unique_together = (('site', 'path'),)
+
+
+@receiver(post_save)
+@receiver(post_delete)
+def purge_content_item(sender, instance, **kwargs):
+    """
+    When a content item changes, have the proxy drop any page showing it.
+    """
+    if isinstance(instance, BaseItem):
+        enqueue_purge([Page.get_item_surrogate_key(instance.pk)])
+
+
+def content_changed(pages):
+    """
+    Bump the revision of pages whose content items changed, so cached
+    fragments and pre-rendered copies of them are considered stale, and bring
+    everything derived from their content up to date.
+    """
+    pages.update(revision=F('revision') + 1)
+    # The page's text changed too.
+    index_pages(pages)
+
+    # The cached page still has the old revision. Paths beneath a prefix
+    # page have cached copies of it too, which a new generation retires.
+    for site_id, url, match_prefix in pages.values_list('site', 'url',
+                                                        'match_prefix'):
+        routers.pin_path(url, site_id)
+        page_cache.delete_many(Page.get_cache_keys_for_path(url, site_id))
+        if match_prefix:
+            Page.objects.bump_prefix_generation(site_id)
+
+    # The index might not have them, if they were added without a save.
+    if get_index_path():
+        update_index(get_index_path(), dict(
+            (get_index_key(url, site_id), pk) for pk, site_id, url
+            in pages.values_list('pk', 'site', 'url')))
+
+    for pk in pages.values_list('pk', flat=True):
+        schedule_prerender(pk)
+
+
+@receiver(post_save)
+@receiver(post_delete)
+def touch_content_area(sender, instance, raw=False, **kwargs):
+    """
+    When a content item changes, so has its page.
+    """
+    if not isinstance(instance, BaseItem) or raw:
+        return
+    if instance.content_area_ct_id != (ContentType.objects
+                                       .get_for_model(Page).pk):
+        return
+
+    content_changed(Page.objects.filter(pk=instance.content_area_id))
+
+
+@receiver(post_save, sender=Site)
+@receiver(post_delete, sender=Site)
+def forget_site_domains(sender, **kwargs):
+    """
+    When a site's domain changes, match hosts against the new one.
+    """
+    sites.forget_domains()
+
+
+@receiver(post_save, sender=Page)
+def prerender_saved_page(sender, instance, raw=False, **kwargs):
+    """
+    If PRERENDER_ON_SAVE is set, re-render a page's static copy on edit.
+    """
+    if not raw:
+        schedule_prerender(instance.pk)
@@ -0,0 +1,312 @@
+"""
+Find out which pages are actually popular, and cache accordingly.
+
+PageMiddleware (and PageCacheApplication, for the requests it answers
+itself) counts a sample of the requests answered with a page. Each process
+adds its samples up in memory and, every ACCESS_FLUSH_INTERVAL seconds, adds
+the ACCESS_FLUSH_BATCH_SIZE most sampled paths to the PageAccessCount table
+(scaled up by the sample rate, so the counts are estimates of real hits). The
+rest wait for the next flush, so the request that happens to flush only pays
+for a batch; paths seen too rarely to make it into one are eventually
+dropped. `manage.py hot_pages` lists
+the hottest paths, halves the counts so old popularity fades, and can load
+the hottest pages into the cache ahead of traffic.
+
+What's counted can then decide what's cached, and for how long:
+
+  - With CACHE_ADMISSION on, a path missing from the cache is only stored
+    there once it's been looked up ADMISSION_MIN_LOOKUPS times recently (or
+    is one of the hot paths), so one-off paths, like a scanner's, don't
+    push popular pages out of the cache.
+  - With POPULAR_CACHE_TIMEOUTS, hot paths are cached for longer: each
+    (minimum hits, seconds) pair is a tier, and paths below every tier get
+    PageManager.CACHE_TIMEOUT.
+
+    FLEXIBLE_PAGES = {
+        'ACCESS_SAMPLE_RATE': 0.01,
+        'ACCESS_FLUSH_INTERVAL': 60,
+        'ACCESS_FLUSH_BATCH_SIZE': 100,
+        'CACHE_ADMISSION': True,
+        'ADMISSION_MIN_LOOKUPS': 2,
+        'POPULAR_CACHE_TIMEOUTS': [(10000, 30*60), (1000, 10*60)],
+    }
+
+Nothing is counted without an ACCESS_SAMPLE_RATE, and caching works as
+before unless the other two are set. Samples not yet flushed when a process
+exits are lost, which a sample can afford, and so are paths longer than a
+page URL can be.
+"""
+import logging
+import random
+import threading
+import time
+import zlib
+
+from django.db import DatabaseError, IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .sites import resolve_site_id
+from .utils import get_app_settings
+
+
+log = logging.getLogger('pages.popularity')
+
+FLUSH_INTERVAL = 60
+FLUSH_BATCH_SIZE = 100
+# How many batches' worth of paths can wait to be flushed; beyond that, paths
+# that haven't been sampled yet aren't counted.
+MAX_PENDING_BATCHES = 10
+# The longest path PageAccessCount can hold (the same as the longest URL).
+MAX_PATH_LENGTH = 200
+ADMISSION_MIN_LOOKUPS = 2
+# How many of the hottest paths each process keeps in memory.
+HOT_PATH_LIMIT = 1000
+
+
+def get_sample_rate():
+    return get_app_settings().get('ACCESS_SAMPLE_RATE') or 0
+
+
+def get_flush_interval():
+    return get_app_settings().get('ACCESS_FLUSH_INTERVAL', FLUSH_INTERVAL)
+
+
+def get_flush_batch_size():
+    return get_app_settings().get('ACCESS_FLUSH_BATCH_SIZE', FLUSH_BATCH_SIZE)
+
+
+# SAMPLING ----------------------------------------------------------------
+
+
+class AccessSampler(object):
+    """
+    Sampled access counts for this process, until they're flushed.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.flushed = time.time()
+
+    def record(self, site_id, path):
+        """
+        Maybe count a request for a path, and flush if it's time.
+        """
+        rate = get_sample_rate()
+        if not rate or random.random() >= rate:
+            return
+        if len(path) > MAX_PATH_LENGTH:
+            return
+
+        key = (resolve_site_id(site_id), path)
+        batch_size = get_flush_batch_size()
+        with self.lock:
+            if key in self.counts:
+                self.counts[key] += 1
+            elif len(self.counts) < batch_size * MAX_PENDING_BATCHES:
+                self.counts[key] = 1
+            now = time.time()
+            due = now - self.flushed >= get_flush_interval()
+            if due:
+                # Only one thread needs to flush.
+                self.flushed = now
+        if due:
+            self.flush(batch_size)
+
+    def take_counts(self, limit=None):
+        """
+        Take the counts of (up to) the limit most sampled paths.
+        """
+        with self.lock:
+            self.flushed = time.time()
+            if limit is None or len(self.counts) <= limit:
+                counts, self.counts = self.counts, {}
+            else:
+                keys = sorted(self.counts, key=self.counts.get,
+                              reverse=True)[:limit]
+                counts = dict((key, self.counts.pop(key)) for key in keys)
+        return counts
+
+    def flush(self, limit=None):
+        """
+        Add the counts so far (or those of the limit most sampled paths) to
+        the PageAccessCount table.
+        """
+        from .models import PageAccessCount
+
+        rate = get_sample_rate() or 1
+        counts = self.take_counts(limit)
+        if not counts:
+            return
+
+        now = timezone.now()
+        try:
+            with transaction.commit_on_success():
+                for (site_id, path), samples in counts.items():
+                    hits = int(round(samples / float(rate)))
+                    rows = PageAccessCount.objects.filter(site=site_id,
+                                                          path=path)
+                    if not rows.update(hits=F('hits') + hits, last_seen=now):
+                        # A failed insert would abort the whole transaction
+                        # on some databases, unless it's in a savepoint.
+                        savepoint = transaction.savepoint()
+                        try:
+                            PageAccessCount.objects.create(
+                                site_id=site_id, path=path, hits=hits,
+                                last_seen=now)
+                        except IntegrityError:
+                            # Another process got there first.
+                            transaction.savepoint_rollback(savepoint)
+                            rows.update(hits=F('hits') + hits, last_seen=now)
+                        else:
+                            transaction.savepoint_commit(savepoint)
+        except DatabaseError:
+            log.exception("Couldn't save %d page access counts.", len(counts))
+        # Anything that changed the rankings should show up here soon.
+        hot_paths.expire()
+
+
+sampler = AccessSampler()
+
+
+def record_access(site_id, path):
+    sampler.record(site_id, path)
+
+
+# HOT PATHS ---------------------------------------------------------------
+
+
+class HotPaths(object):
+    """
+    This process's copy of the hottest paths: {(site id, path): hits}.
+    """
+
+    def __init__(self):
+        self.paths = None
+        self.loaded = 0
+
+    def expire(self):
+        self.loaded = 0
+
+    def get(self):
+        if (self.paths is None or
+                time.time() - self.loaded >= get_flush_interval()):
+            self.paths = dict(((site_id, path), hits) for site_id, path, hits
+                              in get_hot_paths(HOT_PATH_LIMIT))
+            self.loaded = time.time()
+        return self.paths
+
+
+hot_paths = HotPaths()
+
+
+def get_hot_paths(limit, site_id=None):
+    """
+    Return (site id, path, hits) for the hottest paths, hottest first.
+    """
+    from .models import PageAccessCount
+
+    rows = PageAccessCount.objects.order_by('-hits', 'path')
+    if site_id is not None:
+        rows = rows.filter(site=site_id)
+    return list(rows.values_list('site', 'path', 'hits')[:limit])
+
+
+def decay_access_counts(divisor=2):
+    """
+    Divide every count, so that what was popular a while ago fades, and drop
+    the paths that fall to nothing. Returns how many were dropped.
+    """
+    from .models import PageAccessCount
+
+    PageAccessCount.objects.update(hits=F('hits') / divisor)
+    faded = PageAccessCount.objects.filter(hits=0)
+    count = faded.count()
+    faded.delete()
+    hot_paths.expire()
+    return count
+
+
+# ADMISSION ---------------------------------------------------------------
+
+
+class FrequencySketch(object):
+    """
+    Roughly how often each key was seen lately, in a fixed amount of memory.
+
+    A count-min sketch: each key bumps one counter in each of a few rows, and
+    its estimate is the smallest of those counters (collisions only ever
+    inflate them). Once enough keys have been added, every counter is
+    halved, so old lookups stop counting for much.
+    """
+
+    def __init__(self, width=4096, depth=4):
+        self.width = width
+        self.depth = depth
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.rows = [[0] * self.width for _ in range(self.depth)]
+            self.additions = 0
+
+    def get_indexes(self, key):
+        # crc32 is stable across processes, unlike hash().
+        return [zlib.crc32('{}:{}'.format(row, key)) % self.width
+                for row in range(self.depth)]
+
+    def add(self, key):
+        """
+        Count the key once more, and return its new estimate.
+        """
+        indexes = self.get_indexes(key)
+        with self.lock:
+            estimate = None
+            for row, index in zip(self.rows, indexes):
+                row[index] += 1
+                if estimate is None or row[index] < estimate:
+                    estimate = row[index]
+
+            self.additions += 1
+            if self.additions >= self.width * 10:
+                for row in self.rows:
+                    row[:] = [count // 2 for count in row]
+                self.additions //= 2
+        return estimate
+
+
+sketch = FrequencySketch()
+
+
+def get_cache_timeout(site_id, path, default, key=None):
+    """
+    Return how long to cache the page (or 404 marker) for a path that was
+    just looked up in the database, or None if it shouldn't be cached yet.
+    If a path has several cache keys, pass the one this is for, so each
+    is admitted on its own lookups.
+    """
+    app_settings = get_app_settings()
+    admission = app_settings.get('CACHE_ADMISSION', False)
+    tiers = app_settings.get('POPULAR_CACHE_TIMEOUTS')
+    if not admission and not tiers:
+        return default
+
+    try:
+        hits = hot_paths.get().get((resolve_site_id(site_id), path))
+    except DatabaseError:
+        log.exception("Couldn't load the hot page paths.")
+        hits = None
+
+    if admission and hits is None:
+        lookups = sketch.add(key or u'{}{}'.format(resolve_site_id(site_id),
+                                                   path))
+        if lookups < app_settings.get('ADMISSION_MIN_LOOKUPS',
+                                      ADMISSION_MIN_LOOKUPS):
+            return None
+
+    for min_hits, timeout in sorted(tiers or [], reverse=True):
+        if hits is not None and hits >= min_hits:
+            return timeout
+    return default
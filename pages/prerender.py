@@ -0,0 +1,329 @@
+"""
+Render pages to static HTML files, so a web server can serve them directly.
+
+Each page is written to <output dir><page URL>index.html, which nginx can pick
+up with something like `try_files $uri/index.html @django;`. A manifest in the
+output directory remembers which revision of each page was rendered, so later
+builds only redo the pages that changed. With MULTI_SITE on (see pages.sites),
+each site's pages go beneath a directory named for its domain instead:
+<output dir>/<domain><page URL>index.html.
+
+    FLEXIBLE_PAGES = {
+        'PRERENDER_DIR': '/var/www/prerendered/',
+        # Re-render a page as soon as it (or one of its items) is saved.
+        'PRERENDER_ON_SAVE': True,
+    }
+
+Saving a page in the admin changes the page and its items one after another,
+so the admin re-renders once, after it's saved everything (see
+deferred_prerendering). A page is only recorded as built at a revision if
+that's still its revision once it's been written; otherwise the next build
+renders it again. Deleting a page, or moving it to another URL or site,
+deletes the copy at its old location.
+"""
+import contextlib
+import fcntl
+import json
+import logging
+import multiprocessing
+import os
+import tempfile
+import threading
+
+from django.contrib.auth.models import AnonymousUser
+from django.core.urlresolvers import resolve
+from django.db import connections
+from django.test.client import RequestFactory
+
+from . import sites
+from .utils import get_app_settings
+
+
+log = logging.getLogger('pages.prerender')
+
+MANIFEST_NAME = '.prerender-manifest.json'
+INDEX_NAME = 'index.html'
+
+_local = threading.local()
+
+
+def get_prerender_dir():
+    """
+    Return the directory pages should be re-rendered into on save, if any.
+    """
+    app_settings = get_app_settings()
+    if app_settings.get('PRERENDER_ON_SAVE', False):
+        return app_settings.get('PRERENDER_DIR')
+    return None
+
+
+def get_output_path(output_dir, url):
+    return os.path.join(output_dir, url.lstrip('/'), INDEX_NAME)
+
+
+def get_page_location(site_id, url):
+    """
+    Where a page goes beneath the output directory (and its manifest key):
+    its URL, under its site's domain if there's more than one site.
+    """
+    if sites.is_enabled():
+        return sites.get_domain(site_id) + url
+    return url
+
+
+def write_atomically(path, content):
+    """
+    Write to a temporary file beside the target, then move it into place, so
+    the web server never sees a half-written file.
+    """
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.prerender-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        os.chmod(temp_path, 0644)
+        os.rename(temp_path, path)
+    except:
+        os.unlink(temp_path)
+        raise
+
+
+@contextlib.contextmanager
+def locked_manifest(output_dir):
+    """
+    Load the manifest, let the caller change it, then save it, all while
+    holding a lock so concurrent saves and builds don't clobber each other.
+    """
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    path = os.path.join(output_dir, MANIFEST_NAME)
+    with open(path + '.lock', 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            try:
+                with open(path) as f:
+                    manifest = json.load(f)
+            except (IOError, ValueError):
+                manifest = {}
+
+            yield manifest
+
+            write_atomically(path, json.dumps(manifest, indent=1,
+                                              sort_keys=True))
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def render_page_html(page):
+    """
+    Render a page through its view, the same way a request for it would be
+    dispatched, and return the response.
+    """
+    from .middleware import get_page_response
+
+    request = RequestFactory().get(page.url)
+    request.user = AnonymousUser()
+    request._flexible_page_site_id = page.site_id
+    if sites.is_enabled():
+        request.META['HTTP_HOST'] = sites.get_domain(page.site_id)
+
+    response = get_page_response(page, request)
+
+    # This page belongs to a URLpattern view, so call it like Django would.
+    if response is None:
+        match = resolve(page.url)
+        response = match.func(request, *match.args, **match.kwargs)
+        if not getattr(response, 'is_rendered', True):
+            response.render()
+
+    return response
+
+
+def write_page(page, output_dir):
+    """
+    Render one page to disk. Returns whether it was written.
+    """
+    response = render_page_html(page)
+    if response.status_code != 200:
+        log.warning("Not pre-rendering %s: its view returned a %d.",
+                    page.url, response.status_code)
+        return False
+
+    if response.streaming:
+        content = ''.join(response.streaming_content)
+    else:
+        content = response.content
+    location = get_page_location(page.site_id, page.url)
+    write_atomically(get_output_path(output_dir, location), content)
+    return True
+
+
+def prerender_page(page, output_dir):
+    """
+    Re-render a single page and record it in the manifest.
+    """
+    from .models import Page
+
+    location = get_page_location(page.site_id, page.url)
+    with locked_manifest(output_dir) as manifest:
+        written = write_page(page, output_dir)
+        # If the page changed while it was rendering, what's on disk might
+        # not be this revision; leave it for the next build.
+        current = list(Page.objects.filter(pk=page.pk)
+                                   .values_list('revision', flat=True))
+        if written and current == [page.revision]:
+            manifest[location] = page.revision
+        else:
+            manifest.pop(location, None)
+
+
+def remove_location(output_dir, manifest, location):
+    """
+    Delete what was rendered at a location, and forget it in the manifest.
+    """
+    try:
+        os.unlink(get_output_path(output_dir, location))
+    except OSError:
+        pass
+    manifest.pop(location, None)
+
+
+def remove_prerendered(site_id, url):
+    """
+    If PRERENDER_ON_SAVE is set, delete the rendered copy of a page that was
+    just deleted or moved away from a URL, so the web server stops serving
+    it.
+    """
+    from .models import Page
+
+    output_dir = get_prerender_dir()
+    if not output_dir:
+        return
+    with locked_manifest(output_dir) as manifest:
+        # Another page might have taken the URL since.
+        if not Page.objects.filter(site=site_id, url=url).exists():
+            remove_location(output_dir, manifest,
+                            get_page_location(site_id, url))
+
+
+def schedule_prerender(page_pk):
+    """
+    If PRERENDER_ON_SAVE is set, re-render a page: right away, or once at the
+    end of the deferred_prerendering() block we're in.
+    """
+    from .models import Page
+
+    output_dir = get_prerender_dir()
+    if not output_dir:
+        return
+    pending = getattr(_local, 'pending', None)
+    if pending is not None:
+        pending.add(page_pk)
+        return
+    for page in Page.objects.filter(pk=page_pk):
+        prerender_page(page, output_dir)
+
+
+@contextlib.contextmanager
+def deferred_prerendering():
+    """
+    Collect the pages saved inside this block, and re-render each of them
+    once, as it stands at the end (unless the block fails).
+    """
+    if getattr(_local, 'pending', None) is not None:
+        yield
+        return
+
+    _local.pending = pending = set()
+    try:
+        yield
+    finally:
+        _local.pending = None
+    for page_pk in pending:
+        schedule_prerender(page_pk)
+
+
+def render_chunk(args):
+    """
+    Render a list of pages in a worker process.
+
+    Returns a list of (location, revision, written) tuples.
+    """
+    from .models import Page
+
+    page_pks, output_dir = args
+    results = []
+    for page in Page.objects.filter(pk__in=page_pks):
+        try:
+            written = write_page(page, output_dir)
+        except Exception:
+            log.exception("Couldn't pre-render %s.", page.url)
+            written = False
+        results.append((get_page_location(page.site_id, page.url),
+                        page.revision, written))
+    return results
+
+
+def close_connections():
+    # Forked workers mustn't share the parent's database connections.
+    for connection in connections.all():
+        connection.close()
+
+
+def prerender_pages(output_dir, processes=None, force=False, chunk_size=50):
+    """
+    Render every page that changed since the last build into output_dir.
+
+    Returns a dictionary of counts: rendered, skipped, failed and removed.
+    """
+    from .models import Page
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+
+    with locked_manifest(output_dir) as manifest:
+        current = dict((get_page_location(site_id, url), (pk, revision))
+                       for pk, site_id, url, revision in
+                       Page.objects.values_list('pk', 'site', 'url',
+                                                'revision'))
+
+        # Only render pages that are new, changed, or missing from disk.
+        stale_pks = [pk for location, (pk, revision) in current.items()
+                     if force or manifest.get(location) != revision or
+                     not os.path.exists(get_output_path(output_dir, location))]
+        chunks = [(stale_pks[i:i + chunk_size], output_dir)
+                  for i in range(0, len(stale_pks), chunk_size)]
+
+        if processes > 1 and len(chunks) > 1:
+            close_connections()
+            pool = multiprocessing.Pool(processes,
+                                        initializer=close_connections)
+            try:
+                chunk_results = pool.map(render_chunk, chunks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            chunk_results = map(render_chunk, chunks)
+
+        counts = {'rendered': 0, 'failed': 0, 'removed': 0,
+                  'skipped': len(current) - len(stale_pks)}
+        for results in chunk_results:
+            for location, revision, written in results:
+                if written:
+                    manifest[location] = revision
+                    counts['rendered'] += 1
+                else:
+                    manifest.pop(location, None)
+                    counts['failed'] += 1
+
+        # Clean up after pages that were deleted (or moved) since last time.
+        for location in [l for l in manifest if l not in current]:
+            remove_location(output_dir, manifest, location)
+            counts['removed'] += 1
+
+    return counts
@@ -0,0 +1,161 @@
+"""
+Tell a reverse proxy or CDN (Varnish, Fastly, etc.) to forget about pages.
+
+Page responses are tagged with surrogate keys (see Page.get_surrogate_keys),
+and when a page or one of its content items changes, we enqueue its keys here.
+A background thread coalesces those keys and sends them in batches to the
+purge endpoint, as a space-separated Surrogate-Key header:
+
+    FLEXIBLE_PAGES = {
+        'PURGE_URL': 'http://varnish.internal/purge/',
+        'PURGE_METHOD': 'PURGE',      # Defaults to POST.
+        'PURGE_BATCH_SIZE': 100,      # Keys per request.
+        'PURGE_INTERVAL': 1.0,        # Seconds to wait for more keys.
+        'PURGE_RETRIES': 3,
+        'PURGE_TIMEOUT': 5.0,
+    }
+
+If there's no PURGE_URL, nothing is enqueued.
+"""
+import logging
+import os
+import threading
+import time
+import urllib2
+
+from .utils import get_app_settings
+
+
+log = logging.getLogger('pages.purge')
+
+
+class PurgeRequest(urllib2.Request):
+    """
+    A urllib2 request that can use methods like PURGE or BAN.
+    """
+    def __init__(self, url, method, **kwargs):
+        urllib2.Request.__init__(self, url, **kwargs)
+        self.method = method
+
+    def get_method(self):
+        return self.method
+
+
+class PurgeQueue(object):
+    """
+    Collect surrogate keys and purge them in batches from a background thread.
+    """
+
+    def __init__(self, url, method='POST', batch_size=100, interval=1.0,
+                 retries=3, timeout=5.0, backoff=0.5):
+        self.url = url
+        self.method = method
+        self.batch_size = batch_size
+        self.interval = interval
+        self.retries = retries
+        self.timeout = timeout
+        self.backoff = backoff
+
+        # Keys are kept in a set, so purging the same page several times in
+        # quick succession only sends its key once.
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.pid = None
+
+    def enqueue(self, keys):
+        with self.lock:
+            self.pending.update(keys)
+        self.ensure_worker()
+        self.wakeup.set()
+
+    def ensure_worker(self):
+        # Threads don't survive a fork, so each process needs its own.
+        if self.thread is not None and self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.thread is None or self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.thread = threading.Thread(target=self.run,
+                                               name='pages-purge')
+                self.thread.daemon = True
+                self.thread.start()
+
+    def take_batch(self):
+        with self.lock:
+            batch = sorted(self.pending)[:self.batch_size]
+            self.pending.difference_update(batch)
+        return batch
+
+    def run(self):
+        while True:
+            self.wakeup.wait()
+            # Give other saves a moment to pile their keys on.
+            time.sleep(self.interval)
+            self.wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        """
+        Send everything that's pending right now, in batches.
+        """
+        batch = self.take_batch()
+        while batch:
+            self.send(batch)
+            batch = self.take_batch()
+
+    def send(self, keys):
+        """
+        Purge one batch of keys, retrying with backoff. Returns success.
+        """
+        request = PurgeRequest(self.url, self.method, data='',
+                               headers={'Surrogate-Key': ' '.join(keys)})
+
+        for attempt in range(self.retries + 1):
+            try:
+                urllib2.urlopen(request, timeout=self.timeout).close()
+            except Exception as e:
+                log.warning("Purge attempt %d of %d failed for %d keys: %s",
+                            attempt + 1, self.retries + 1, len(keys), e)
+                if attempt < self.retries:
+                    time.sleep(self.backoff * (2 ** attempt))
+            else:
+                log.debug("Purged surrogate keys: %s", ' '.join(keys))
+                return True
+
+        log.error("Gave up purging surrogate keys: %s", ' '.join(keys))
+        return False
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_purge_queue():
+    """
+    Return the process's purge queue, or None if purging isn't configured.
+    """
+    global _queue
+
+    app_settings = get_app_settings()
+    url = app_settings.get('PURGE_URL')
+    if not url:
+        return None
+
+    with _queue_lock:
+        if _queue is None or _queue.url != url:
+            _queue = PurgeQueue(
+                url,
+                method=app_settings.get('PURGE_METHOD', 'POST'),
+                batch_size=app_settings.get('PURGE_BATCH_SIZE', 100),
+                interval=app_settings.get('PURGE_INTERVAL', 1.0),
+                retries=app_settings.get('PURGE_RETRIES', 3),
+                timeout=app_settings.get('PURGE_TIMEOUT', 5.0))
+    return _queue
+
+
+def enqueue_purge(keys):
+    queue = get_purge_queue()
+    if queue is not None and keys:
+        queue.enqueue(keys)
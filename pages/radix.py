@@ -0,0 +1,84 @@
+"""
+A radix tree (compressed trie) for finding the longest matching URL prefix.
+
+Lookups walk the path one edge at a time, so they take time proportional to
+the length of the path, no matter how many prefixes are stored.
+"""
+
+
+class Node(object):
+    __slots__ = ('edges', 'value', 'has_value')
+
+    def __init__(self):
+        # First character of each edge -> (edge label, child node).
+        self.edges = {}
+        self.value = None
+        self.has_value = False
+
+
+def common_prefix_length(a, b):
+    length = min(len(a), len(b))
+    for i in range(length):
+        if a[i] != b[i]:
+            return i
+    return length
+
+
+class RadixTree(object):
+    def __init__(self, items=()):
+        self.root = Node()
+        self.size = 0
+        for key, value in items:
+            self.insert(key, value)
+
+    def __len__(self):
+        return self.size
+
+    def insert(self, key, value):
+        node = self.root
+        while key:
+            edge = node.edges.get(key[0])
+            if edge is None:
+                # Nothing shares this first character, so hang it all here.
+                child = Node()
+                node.edges[key[0]] = (key, child)
+                node = child
+                key = ''
+                break
+
+            label, child = edge
+            shared = common_prefix_length(label, key)
+            if shared < len(label):
+                # Split the edge where the new key diverges from it.
+                middle = Node()
+                middle.edges[label[shared]] = (label[shared:], child)
+                node.edges[key[0]] = (label[:shared], middle)
+                child = middle
+
+            node = child
+            key = key[shared:]
+
+        if not node.has_value:
+            self.size += 1
+        node.value = value
+        node.has_value = True
+
+    def longest_prefix(self, path, default=None):
+        """
+        Return the value stored for the longest key that prefixes the path.
+        """
+        node = self.root
+        best = node.value if node.has_value else default
+        position = 0
+        while position < len(path):
+            edge = node.edges.get(path[position])
+            if edge is None:
+                break
+            label, child = edge
+            if not path.startswith(label, position):
+                break
+            position += len(label)
+            node = child
+            if node.has_value:
+                best = node.value
+        return best
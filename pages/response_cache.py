@@ -0,0 +1,278 @@
+"""
+Cache whole rendered page responses, with their compressed variants.
+
+When RESPONSE_CACHE_TIMEOUT is set in FLEXIBLE_PAGES, PageMiddleware stores
+the responses it renders (when it's safe to share them), and serves them back
+until the page is saved again. Each body is compressed once, when it's cached,
+with every content coding the standard library offers, so serving a cached
+page never costs any compression CPU. Each entry also has an ETag, so a client
+that already has the page gets a 304.
+"""
+import gzip
+import hashlib
+import re
+import zlib
+from io import BytesIO
+
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.http import quote_etag
+
+from .breaker import page_cache
+from .utils import get_app_settings
+
+
+# Content codings we can produce, in the order we'd prefer to serve them.
+ENCODINGS = ('gzip', 'deflate')
+
+# It's not worth compressing tiny responses (GZipMiddleware agrees).
+MIN_COMPRESS_LENGTH = 200
+
+# Vary headers we know how to honor when serving a cached response.
+SUPPORTED_VARY = set(['accept-encoding', 'cookie'])
+
+# Headers a 304 Not Modified response repeats from the full one.
+NOT_MODIFIED_HEADERS = set(['cache-control', 'content-location', 'date',
+                            'etag', 'expires', 'surrogate-key', 'vary'])
+
+accept_encoding_re = re.compile(r'^\s*([^\s;]+)\s*(?:;\s*q\s*=\s*([0-9.]+))?')
+
+
+def compress_gzip(content):
+    buf = BytesIO()
+    # A fixed mtime keeps the output identical from one fill to the next.
+    with gzip.GzipFile(mode='wb', compresslevel=9, fileobj=buf,
+                       mtime=0) as f:
+        f.write(content)
+    return buf.getvalue()
+
+
+def compress_deflate(content):
+    # HTTP's "deflate" coding is actually the zlib format.
+    return zlib.compress(content, 9)
+
+COMPRESSORS = {
+    'gzip': compress_gzip,
+    'deflate': compress_deflate,
+}
+
+
+def parse_accept_encoding(header):
+    """
+    Return a dictionary of content coding to quality value.
+    """
+    accepted = {}
+    for part in header.split(','):
+        match = accept_encoding_re.match(part)
+        if match is None:
+            continue
+        coding, quality = match.groups()
+        try:
+            accepted[coding.lower()] = float(quality) if quality else 1.0
+        except ValueError:
+            pass
+    return accepted
+
+
+def get_vary(response):
+    if not response.has_header('Vary'):
+        return set()
+    return set(v.strip().lower() for v in response['Vary'].split(','))
+
+
+class CachedPageResponse(object):
+    """
+    A picklable copy of a page response, with its body in every encoding.
+    """
+
+    def __init__(self, url, revision, response, varies_on_cookie=False):
+        self.url = url
+        self.revision = revision
+        self.status_code = response.status_code
+        self.headers = [(k, v) for k, v in response.items()
+                        if k.lower() not in ('content-length', 'vary', 'etag')]
+        self.varies_on_cookie = varies_on_cookie
+
+        self.vary = [v.strip() for v in response.get('Vary', '').split(',')
+                     if v.strip()]
+
+        # The conditional GET validator. A weak one, since each encoding has
+        # different bytes but the same meaning.
+        self.etag = response.get('ETag') or 'W/{}'.format(
+            quote_etag(hashlib.md5(response.content).hexdigest()))
+
+        self.bodies = {'identity': response.content}
+        if len(response.content) >= MIN_COMPRESS_LENGTH:
+            for encoding in ENCODINGS:
+                compressed = COMPRESSORS[encoding](response.content)
+                # Only keep variants that are actually smaller.
+                if len(compressed) < len(response.content):
+                    self.bodies[encoding] = compressed
+
+    def is_fresh_for(self, page):
+        return self.url == page.url and self.revision == page.revision
+
+    def can_serve(self, has_cookies):
+        return not (self.varies_on_cookie and has_cookies)
+
+    def choose_encoding(self, accept_encoding):
+        """
+        Pick the best variant we have for an Accept-Encoding header.
+        """
+        accepted = parse_accept_encoding(accept_encoding or '')
+        wildcard = accepted.get('*', 0)
+        for encoding in ENCODINGS:
+            if (encoding in self.bodies and
+                    accepted.get(encoding, wildcard) > 0):
+                return encoding
+        return 'identity'
+
+    def is_not_modified(self, if_none_match):
+        """
+        Does the client's copy (per If-None-Match) match this one?
+        """
+        if not if_none_match:
+            return False
+        if if_none_match.strip() == '*':
+            return True
+        # Weak comparison: W/"x" matches "x".
+        ours = self.etag[2:] if self.etag.startswith('W/') else self.etag
+        theirs = [tag[2:] if tag.startswith('W/') else tag
+                  for tag in if_none_match.split(',')]
+        return ours in [tag.strip() for tag in theirs]
+
+    def get_header_items(self, encoding):
+        """
+        Return the response's headers for a given variant, as a list of pairs.
+        """
+        items = list(self.headers)
+        items.append(('ETag', self.etag))
+        items.append(('Content-Length', str(len(self.bodies[encoding]))))
+        # Whatever else it varies on, the variants make it vary on encoding.
+        vary = list(self.vary)
+        required = ['Accept-Encoding'] + (['Cookie'] if self.varies_on_cookie
+                                          else [])
+        for header in required:
+            if header.lower() not in [v.lower() for v in vary]:
+                vary.append(header)
+        items.append(('Vary', ', '.join(vary)))
+        if encoding != 'identity':
+            items.append(('Content-Encoding', encoding))
+        return items
+
+    def get_not_modified_header_items(self, encoding):
+        # A 304 repeats the headers that describe the variant, but no body.
+        return [(key, value) for key, value in self.get_header_items(encoding)
+                if key.lower() in NOT_MODIFIED_HEADERS]
+
+    def to_response(self, accept_encoding, if_none_match=None):
+        encoding = self.choose_encoding(accept_encoding)
+        if self.is_not_modified(if_none_match):
+            response = HttpResponseNotModified()
+            for key, value in self.get_not_modified_header_items(encoding):
+                response[key] = value
+            return response
+
+        response = HttpResponse(self.bodies[encoding],
+                                status=self.status_code)
+        for key, value in self.get_header_items(encoding):
+            response[key] = value
+        return response
+
+
+def get_timeout():
+    return get_app_settings().get('RESPONSE_CACHE_TIMEOUT')
+
+
+def request_has_cookies(request):
+    return bool(request.META.get('HTTP_COOKIE'))
+
+
+def get_cached_response(page, request, prefetched=None):
+    """
+    Return a cached response for the page, if there's a usable one. If the
+    response key was fetched already (see PageManager.prefetch), pass the
+    fetched values in.
+    """
+    if (not get_timeout() or request.method not in ('GET', 'HEAD') or
+            request.META.get('QUERY_STRING')):
+        return None
+
+    # Prefix pages answer for many paths, so this is keyed by the path.
+    key = page.get_response_key_for_path(request.path, page.site_id)
+    if prefetched is not None and key in prefetched:
+        entry = prefetched[key]
+    else:
+        entry = page_cache.get(key)
+    if (not isinstance(entry, CachedPageResponse) or
+            not entry.is_fresh_for(page) or
+            not entry.can_serve(request_has_cookies(request))):
+        return None
+
+    return entry.to_response(request.META.get('HTTP_ACCEPT_ENCODING'),
+                             request.META.get('HTTP_IF_NONE_MATCH'))
+
+
+def is_cacheable(request, response):
+    """
+    Could this response be served to anyone else who asks for the page?
+    """
+    if request.method != 'GET' or response.status_code != 200:
+        return False
+    # The view might have used the query string; we don't key on it.
+    if request.META.get('QUERY_STRING'):
+        return False
+    if getattr(response, 'streaming', False) or response.cookies:
+        return False
+    # A CSRF token in the page is specific to whoever asked for it.
+    if request.META.get('CSRF_COOKIE_USED'):
+        return False
+    if response.has_header('Content-Encoding'):
+        return False
+
+    cache_control = response.get('Cache-Control', '').lower()
+    if 'private' in cache_control or 'no-store' in cache_control:
+        return False
+
+    return get_vary(response) <= SUPPORTED_VARY
+
+
+def cache_response(page, request, response):
+    """
+    Store a freshly rendered response for the page, if it's safe to share.
+    """
+    timeout = get_timeout()
+    if not timeout or not is_cacheable(request, response):
+        return None
+
+    # If the view looked at the session, the response might depend on who's
+    # asking; it's only safe for others who don't have cookies either. (The
+    # session middleware will add Vary: Cookie on the way out.)
+    session = getattr(request, 'session', None)
+    varies_on_cookie = ('cookie' in get_vary(response) or
+                        getattr(session, 'accessed', False))
+    if varies_on_cookie and request_has_cookies(request):
+        return None
+
+    entry = CachedPageResponse(page.url, page.revision, response,
+                               varies_on_cookie=varies_on_cookie)
+    page_cache.set(page.get_response_key_for_path(request.path, page.site_id),
+                   entry, timeout)
+    # The copies we serve later carry this validator, so this one should too.
+    response['ETag'] = entry.etag
+    return entry
+
+
+def get_fresh_entry_for_path(path, site_id=None):
+    """
+    Fetch a path's cached page and response together, and return the response
+    entry if it's still current for that page. This doesn't need a request.
+    """
+    from .models import Page
+
+    values = Page.objects.prefetch(path, site_id, response=True)
+    page = values.get(Page.get_key_for_path(path, site_id))
+    entry = values.get(Page.get_response_key_for_path(path, site_id))
+    if (isinstance(page, Page) and isinstance(entry, CachedPageResponse) and
+            entry.is_fresh_for(page)):
+        return entry
+    return None
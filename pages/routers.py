@@ -0,0 +1,141 @@
+"""
+Send the reads that serve pages to read replicas.
+
+    DATABASE_ROUTERS = ['pages.routers.PageReplicaRouter']
+    FLEXIBLE_PAGES = {
+        'READ_REPLICAS': ['replica1', 'replica2'],
+        # How long (in seconds) a replica might lag behind the primary.
+        'REPLICA_LAG': 5,
+    }
+
+Only reads made while serving a page (looking it up and rendering it) use
+the replicas; the admin and everything else keep reading from the primary.
+Right after a page is saved, a replica might still have the old row, and
+we mustn't let that get cached. So for REPLICA_LAG seconds, reads for that
+page's URL are pinned to the primary, and so are the cache fills that follow
+them.
+"""
+import contextlib
+import hashlib
+import random
+import threading
+import time
+
+from django.db import DEFAULT_DB_ALIAS
+
+from .breaker import page_cache
+from .sites import resolve_site_id
+from .utils import get_app_settings
+
+
+REPLICA_LAG = 5
+
+_local = threading.local()
+
+
+def get_replicas():
+    return get_app_settings().get('READ_REPLICAS') or []
+
+
+def get_replica_lag():
+    return get_app_settings().get('REPLICA_LAG', REPLICA_LAG)
+
+
+@contextlib.contextmanager
+def _reading_from(replica):
+    previous = getattr(_local, 'replica', False)
+    _local.replica = replica
+    try:
+        yield
+    finally:
+        _local.replica = previous
+
+
+def replica_reads():
+    """
+    Let page reads inside this block go to a replica.
+    """
+    return _reading_from(True)
+
+
+def primary_reads():
+    """
+    Make sure page reads inside this block go to the primary.
+    """
+    return _reading_from(False)
+
+
+def reading_from_replica():
+    """
+    Whether page reads here may go to a replica.
+    """
+    return getattr(_local, 'replica', False)
+
+
+def get_pin_key(path, site_id=None):
+    key = hashlib.sha224(path.encode('utf-8')).hexdigest()
+    return 'flexible_page_pin_{}_{}'.format(resolve_site_id(site_id), key)
+
+
+def pin_path(path, site_id=None):
+    """
+    Read this path's page from the primary until the replicas catch up.
+    """
+    if get_replicas():
+        page_cache.invalidate(get_pin_key(path, site_id), True,
+                              get_replica_lag())
+
+
+def is_path_pinned(path, site_id=None):
+    return (bool(get_replicas()) and
+            bool(page_cache.get(get_pin_key(path, site_id))))
+
+
+def pinned_reads(pinned):
+    """
+    Read from the primary if pinned; otherwise, carry on as we were.
+    """
+    if pinned:
+        return primary_reads()
+    return _reading_from(reading_from_replica())
+
+
+def mark_pinned(page):
+    """
+    Note on a page loaded from the primary that it should be rendered from
+    the primary too. This travels with the page into the cache.
+    """
+    page._read_from_primary_until = time.time() + get_replica_lag()
+
+
+def reads_for_page(page):
+    """
+    Render from a replica, unless the page was loaded while it was pinned.
+    """
+    if getattr(page, '_read_from_primary_until', 0) > time.time():
+        return primary_reads()
+    return replica_reads()
+
+
+class PageReplicaRouter(object):
+    def is_page_model(self, model):
+        from flexible_content.models import BaseItem
+        from .models import Page
+        return issubclass(model, (Page, BaseItem))
+
+    def db_for_read(self, model, **hints):
+        if not getattr(_local, 'replica', False):
+            return None
+        replicas = get_replicas()
+        if not replicas or not self.is_page_model(model):
+            return None
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS if self.is_page_model(model) else None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same data as the primary.
+        if self.is_page_model(type(obj1)) or self.is_page_model(type(obj2)):
+            return True
+        return None
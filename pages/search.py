@@ -0,0 +1,257 @@
+"""
+Full-text search over pages, without a separate search service.
+
+Every page's title, summary and content items are split into lowercase words
+(tokens), and each distinct token is stored as one PageSearchToken row with a
+weight: how often it appears, with title words counting for more than summary
+words, which count for more than body text. Saving a page (or one of its
+items) only rewrites the rows that changed.
+
+    from pages.search import search
+    page_ids = search(u"install guide")
+
+Every word in the query has to match, and words of MIN_PREFIX_LENGTH or more
+letters also match longer words ("inst" finds "install"). Since the tokens are
+indexed, each word is a range scan on that index, however many pages there
+are, and the rarest word is looked up first so the others only need checking
+against its pages. Pages come back best match first.
+
+`manage.py benchmark_page_search` times searches over 100,000 made-up pages.
+
+Set 'SEARCH_INDEX': False in FLEXIBLE_PAGES to stop maintaining the index.
+"""
+import heapq
+import re
+from collections import defaultdict
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import models
+from django.db.models import Sum
+from django.utils.html import strip_tags
+
+from flexible_content.models import BaseItem
+
+from .utils import get_app_settings
+
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+MIN_TOKEN_LENGTH = 2
+MAX_TOKEN_LENGTH = 40
+MIN_PREFIX_LENGTH = 3
+MAX_QUERY_TERMS = 8
+# Once this few pages are left, later words only look at those pages.
+CANDIDATE_LIMIT = 500
+# Counting stops here when finding the rarest word; past this, a word is
+# just common, and counting exactly how common costs more than it tells us.
+RARITY_COUNT_LIMIT = 5000
+
+TITLE_WEIGHT = 10
+SUMMARY_WEIGHT = 3
+CONTENT_WEIGHT = 1
+
+# Sorts after any character a token could end with.
+PREFIX_UPPER_BOUND = u'\uffff'
+
+
+def is_enabled():
+    return get_app_settings().get('SEARCH_INDEX', True)
+
+
+def tokenize(text):
+    """
+    Split text into lowercase words, in order (repeats included).
+    """
+    if not text:
+        return []
+    return [token[:MAX_TOKEN_LENGTH]
+            for token in TOKEN_RE.findall(text.lower())
+            if len(token) >= MIN_TOKEN_LENGTH]
+
+
+def get_item_text(item):
+    """
+    Return the text a content item shows: the values of its own text fields,
+    with any HTML stripped out.
+    """
+    base_fields = set(field.name for field in BaseItem._meta.fields)
+    text = []
+    for field in item._meta.fields:
+        if (field.name not in base_fields and
+                isinstance(field, models.TextField)):
+            text.append(strip_tags(getattr(item, field.attname) or u''))
+    return u' '.join(text)
+
+
+def get_page_weights(page, items):
+    weights = defaultdict(int)
+    for text, weight in ((page.title, TITLE_WEIGHT),
+                         (page.summary, SUMMARY_WEIGHT)):
+        for token in tokenize(text):
+            weights[token] += weight
+    for item in items:
+        for token in tokenize(get_item_text(item)):
+            weights[token] += CONTENT_WEIGHT
+    return weights
+
+
+def index_pages(pages):
+    """
+    Bring the search index up to date for some saved pages, touching only
+    the rows that changed.
+    """
+    from .models import Page, PageSearchToken
+
+    pages = [page for page in pages if page.pk is not None]
+    if not pages or not is_enabled():
+        return
+    pks = [page.pk for page in pages]
+
+    items = defaultdict(list)
+    for item in (BaseItem.objects
+                 .filter(content_area_ct=ContentType.objects
+                         .get_for_model(Page),
+                         content_area_id__in=pks)
+                 .select_subclasses()):
+        items[item.content_area_id].append(item)
+
+    wanted = {}
+    for page in pages:
+        for token, weight in get_page_weights(page, items[page.pk]).items():
+            wanted[page.pk, token] = weight
+
+    existing = {}
+    for row_pk, page_id, token, weight in (PageSearchToken.objects
+                                           .filter(page__in=pks)
+                                           .values_list('pk', 'page', 'token',
+                                                        'weight')):
+        existing[page_id, token] = (row_pk, weight)
+
+    stale = [row_pk for key, (row_pk, weight) in existing.items()
+             if key not in wanted]
+    # Rows whose weight changed are updated together, one query per weight.
+    reweighted = defaultdict(list)
+    new_rows = []
+    for (page_id, token), weight in wanted.items():
+        if (page_id, token) not in existing:
+            new_rows.append(PageSearchToken(page_id=page_id, token=token,
+                                            weight=weight))
+        elif existing[page_id, token][1] != weight:
+            reweighted[weight].append(existing[page_id, token][0])
+
+    if stale:
+        PageSearchToken.objects.filter(pk__in=stale).delete()
+    for weight, row_pks in reweighted.items():
+        PageSearchToken.objects.filter(pk__in=row_pks).update(weight=weight)
+    if new_rows:
+        PageSearchToken.objects.bulk_create(new_rows)
+
+
+def index_page(page):
+    index_pages([page])
+
+
+def rebuild_index(batch_size=500):
+    """
+    Index every page, a batch at a time. Returns how many there were.
+    """
+    from .models import Page
+
+    pks = list(Page.objects.order_by('pk').values_list('pk', flat=True))
+    for i in range(0, len(pks), batch_size):
+        index_pages(Page.objects.filter(pk__in=pks[i:i + batch_size]))
+    return len(pks)
+
+
+def get_term_rows(term):
+    """
+    The index rows for the term (or, if it's long enough, for any word
+    starting with it).
+    """
+    from .models import PageSearchToken
+
+    if len(term) >= MIN_PREFIX_LENGTH:
+        return PageSearchToken.objects.filter(
+            token__gte=term, token__lt=term + PREFIX_UPPER_BOUND)
+    return PageSearchToken.objects.filter(token=term)
+
+
+def get_term_scores(term, page_ids=None):
+    """
+    Return {page id: summed weight} for pages matching the term, optionally
+    only among the given pages.
+    """
+    rows = get_term_rows(term)
+    if page_ids is None:
+        chunks = [rows]
+    else:
+        page_ids = list(page_ids)
+        chunks = [rows.filter(page__in=page_ids[i:i + CANDIDATE_LIMIT])
+                  for i in range(0, len(page_ids), CANDIDATE_LIMIT)]
+
+    scores = {}
+    for chunk in chunks:
+        scores.update(chunk.values('page').order_by()
+                           .annotate(score=Sum('weight'))
+                           .values_list('page', 'score'))
+    return scores
+
+
+def get_top_pages(term, limit):
+    """
+    The best pages for a single term, ranked by the database, so only the
+    winners are sent back.
+    """
+    rows = get_term_rows(term)
+    if len(term) < MIN_PREFIX_LENGTH:
+        # An exact term has at most one row per page, so this is just a walk
+        # down the (token, weight) index.
+        return list(rows.order_by('-weight', 'page__id')
+                        .values_list('page', flat=True)[:limit])
+    return [page_id for page_id, score in
+            rows.values('page').order_by()
+                .annotate(score=Sum('weight'))
+                .order_by('-score', 'page__id')
+                .values_list('page', 'score')[:limit]]
+
+
+def search(query, limit=20):
+    """
+    Return the ids of the pages matching every word of the query, best first.
+    """
+    terms = []
+    for term in tokenize(query):
+        if term not in terms:
+            terms.append(term)
+    terms = terms[:MAX_QUERY_TERMS]
+    if not terms:
+        return []
+    if len(terms) == 1:
+        return get_top_pages(terms[0], limit)
+
+    # Start with the rarest word, so that the more common ones only have to
+    # be checked against its pages. Index entries are fetched (a sliced
+    # count() would still count them all) only up to a point.
+    counts = dict((term, len(get_term_rows(term)
+                             .values_list('pk', flat=True)
+                             [:RARITY_COUNT_LIMIT]))
+                  for term in terms)
+    terms.sort(key=counts.get)
+    if not counts[terms[0]]:
+        return []
+
+    scores = None
+    for term in terms:
+        if scores is None:
+            scores = get_term_scores(term)
+        else:
+            candidates = scores if len(scores) <= CANDIDATE_LIMIT else None
+            term_scores = get_term_scores(term, candidates)
+            scores = dict((page_id, score + term_scores[page_id])
+                          for page_id, score in scores.items()
+                          if page_id in term_scores)
+        if not scores:
+            return []
+
+    best = heapq.nsmallest(limit, scores.items(),
+                           key=lambda item: (-item[1], item[0]))
+    return [page_id for page_id, score in best]
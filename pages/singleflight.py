@@ -0,0 +1,58 @@
+"""
+Let concurrent callers share one call's result, instead of each making it.
+
+When a popular page falls out of the cache, every thread serving it misses at
+once, and each would run the same database query and fill the same cache key.
+With SingleFlight, the first thread to miss does the work, and the others that
+arrive while it's running wait for it and get a copy of what it got (or the
+exception it raised). Callers that would have made different calls, like one
+reading from the primary and one from a replica, must use different keys.
+"""
+import copy
+import sys
+import threading
+
+
+class Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exc_info = None
+
+
+class SingleFlight(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, function, *args, **kwargs):
+        """
+        Call the function, unless a call for the same key is already running,
+        in which case wait for that one and return (a copy of) its result.
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Call()
+
+        if leader:
+            try:
+                call.result = function(*args, **kwargs)
+            except:
+                call.exc_info = sys.exc_info()
+            finally:
+                with self.lock:
+                    del self.calls[key]
+                call.done.set()
+            if call.exc_info is not None:
+                raise call.exc_info[0], call.exc_info[1], call.exc_info[2]
+            return call.result
+
+        call.done.wait()
+        if call.exc_info is not None:
+            raise call.exc_info[0], call.exc_info[1], call.exc_info[2]
+        # Each caller gets its own copy, since callers tend to modify what
+        # they get (pages cache their rendered content, and related objects,
+        # on themselves). A deep one, like a copy from the cache would be.
+        return copy.deepcopy(call.result)
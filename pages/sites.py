@@ -0,0 +1,194 @@
+"""
+Serve different pages for different hostnames from one deployment.
+
+Every page belongs to a site (django.contrib.sites, which must be installed),
+and is looked up by its site and URL together, so two sites can each have
+their own /about/. With MULTI_SITE on, the site is chosen by the request's
+host, matched against each Site's domain; hosts that don't match any (and
+every request, with MULTI_SITE off) get SITE_ID's site.
+
+    FLEXIBLE_PAGES = {
+        'MULTI_SITE': True,
+    }
+
+Each site's cache keys also carry a namespace of its own. Bumping it (as a
+large bulk import does) retires every key that site has cached at once,
+without deleting them one by one, and without touching any other site's.
+Processes remember each site's namespace, and check it again with the next
+prefetch (or, failing that, after NAMESPACE_CHECK_INTERVAL seconds). If the
+namespace drops out of the cache, the first process to notice puts back the
+one it knows (or a new one, if it has none), and the rest follow it.
+
+The sites' domains are kept in the cache too, so that each process can reload
+them every DOMAIN_CHECK_INTERVAL seconds without a query.
+"""
+import re
+import time
+import uuid
+
+from django.conf import settings
+
+from .breaker import breaker, page_cache
+from .utils import get_app_settings
+
+
+PORT_RE = re.compile(r':\d+$')
+
+# How often (in seconds) to reload the domains of the sites.
+DOMAIN_CHECK_INTERVAL = 60
+DOMAINS_KEY = 'flexible_page_site_domains'
+DOMAINS_TIMEOUT = 24*60*60
+
+NAMESPACE_TIMEOUT = 30*24*60*60
+NAMESPACE_CHECK_INTERVAL = 1
+
+# This process's map of sites: ({domain: id}, {id: domain}, last loaded).
+_domains = None
+
+# This process's namespace for each site: {site id: (namespace, checked)}.
+_namespaces = {}
+
+
+def is_enabled():
+    return get_app_settings().get('MULTI_SITE', False)
+
+
+def get_default_site_id():
+    return getattr(settings, 'SITE_ID', 1)
+
+
+def resolve_site_id(site_id):
+    """
+    Treat a missing site as the default one.
+    """
+    return get_default_site_id() if site_id is None else site_id
+
+
+# HOSTS -------------------------------------------------------------------
+
+
+def get_domains():
+    from django.contrib.sites.models import Site
+    global _domains
+
+    now = time.time()
+    if _domains is None or now - _domains[2] >= DOMAIN_CHECK_INTERVAL:
+        domains = page_cache.get(DOMAINS_KEY)
+        if domains is None:
+            domains = list(Site.objects.values_list('id', 'domain'))
+            page_cache.set(DOMAINS_KEY, domains, DOMAINS_TIMEOUT)
+        by_id = dict(domains)
+        by_domain = dict((domain.lower(), site_id)
+                         for site_id, domain in by_id.items())
+        _domains = (by_domain, by_id, now)
+    return _domains
+
+
+def forget_domains():
+    # Other processes catch up within DOMAIN_CHECK_INTERVAL.
+    global _domains
+    _domains = None
+    page_cache.delete_many([DOMAINS_KEY])
+
+
+def get_site_id_for_host(host):
+    """
+    Return the id of the site whose domain is the host (with or without its
+    port), or the default site's.
+    """
+    if not is_enabled() or not host:
+        return get_default_site_id()
+
+    by_domain = get_domains()[0]
+    host = host.lower().rstrip('.')
+    site_id = by_domain.get(host)
+    if site_id is None:
+        site_id = by_domain.get(PORT_RE.sub('', host))
+    return resolve_site_id(site_id)
+
+
+def get_site_id(request):
+    """
+    Return the id of the site a request is for. It's only worked out once
+    per request.
+    """
+    site_id = getattr(request, '_flexible_page_site_id', None)
+    if site_id is None:
+        site_id = get_site_id_for_host(request.META.get('HTTP_HOST') or
+                                       request.META.get('SERVER_NAME'))
+        request._flexible_page_site_id = site_id
+    return site_id
+
+
+def get_domain(site_id):
+    """
+    Return a site's domain, or its id (as a string) if it doesn't have one.
+    """
+    return get_domains()[1].get(site_id) or unicode(site_id)
+
+
+# CACHE NAMESPACES --------------------------------------------------------
+
+
+def get_namespace_key(site_id):
+    return 'flexible_page_namespace_{}'.format(site_id)
+
+
+def bump_namespace(site_id=None):
+    """
+    Retire every key cached for a site's pages, in every process.
+    """
+    site_id = resolve_site_id(site_id)
+    namespace = uuid.uuid4().hex
+    # This process should see the change right away.
+    _namespaces[site_id] = (namespace, time.time())
+    page_cache.invalidate(get_namespace_key(site_id), namespace,
+                          NAMESPACE_TIMEOUT)
+    return namespace
+
+
+def note_namespace(site_id, namespace):
+    """
+    Record a site's namespace as just fetched from the cache (None if it
+    wasn't there), and return the one to use.
+    """
+    site_id = resolve_site_id(site_id)
+    if namespace is None:
+        state = _namespaces.get(site_id)
+        if state is not None:
+            # Either the cache is out, not empty, or the key was evicted;
+            # keys cached under the namespace we have are still good.
+            namespace = state[0]
+        else:
+            namespace = uuid.uuid4().hex
+        if breaker.is_closed:
+            # Another process might be putting one back too; use theirs if
+            # they got there first.
+            key = get_namespace_key(site_id)
+            if not page_cache.add(key, namespace, NAMESPACE_TIMEOUT):
+                namespace = page_cache.get(key) or namespace
+    _namespaces[site_id] = (namespace, time.time())
+    return namespace
+
+
+def get_local_namespace(site_id=None):
+    """
+    Return the namespace this process last saw for a site, however old, or
+    None if it hasn't seen one.
+    """
+    state = _namespaces.get(resolve_site_id(site_id))
+    return state[0] if state is not None else None
+
+
+def get_namespace(site_id=None):
+    """
+    Return a site's current namespace, checking the cache for it at most
+    once every NAMESPACE_CHECK_INTERVAL seconds.
+    """
+    site_id = resolve_site_id(site_id)
+    state = _namespaces.get(site_id)
+    if (state is not None and
+            time.time() - state[1] < NAMESPACE_CHECK_INTERVAL):
+        return state[0]
+    return note_namespace(site_id,
+                          page_cache.get(get_namespace_key(site_id)))
@@ -0,0 +1,99 @@
+from django import template
+from django.utils.safestring import mark_safe
+
+from flexible_content.models import BaseItem
+
+from ..breaker import page_cache
+from ..utils import get_app_settings
+
+
+register = template.Library()
+
+FRAGMENT_CACHE_TIMEOUT = 60*60
+
+
+def render_items(items):
+    return dict((item.pk, item.get_rendered_content()) for item in items)
+
+
+def iter_page_content(page, chunk_size=None):
+    """
+    Yield a page's rendered content items in order, the same way page_content
+    joins them, caching each item's output.
+
+    Fragments are keyed by item and page revision. They're fetched with one
+    get_many per chunk of items (or just one, if there's no chunk_size), and
+    only the items that missed are queried and rendered.
+    """
+    timeout = get_app_settings().get('FRAGMENT_CACHE_TIMEOUT',
+                                     FRAGMENT_CACHE_TIMEOUT)
+    separator = None
+
+    # Which items does this revision of the page have, in order?
+    list_key = page.get_item_list_key()
+    item_pks = page_cache.get(list_key)
+
+    if item_pks is None:
+        # We have to query for the items anyway, so render them all, as they
+        # come out of the database.
+        item_pks = []
+        to_cache = {}
+        for item in page.items.iterator():
+            item_pks.append(item.pk)
+            rendered = item.get_rendered_content()
+            to_cache[page.get_item_fragment_key(item.pk)] = rendered
+            if chunk_size and len(to_cache) >= chunk_size:
+                page_cache.set_many(to_cache, timeout)
+                to_cache = {}
+            if separator is not None:
+                yield separator
+            separator = '\n\n'
+            yield rendered
+        if to_cache:
+            page_cache.set_many(to_cache, timeout)
+        page_cache.set(list_key, item_pks, timeout)
+        return
+
+    chunk_size = chunk_size or len(item_pks) or 1
+    for start in range(0, len(item_pks), chunk_size):
+        chunk = item_pks[start:start + chunk_size]
+
+        # Fetch these fragments in one go, and render whatever's left.
+        keys = [page.get_item_fragment_key(pk) for pk in chunk]
+        cached = page_cache.get_many(keys)
+        rendered = dict((pk, cached[key]) for pk, key in zip(chunk, keys)
+                        if key in cached)
+        missing = [pk for pk in chunk if pk not in rendered]
+        if missing:
+            items = (BaseItem.objects.filter(pk__in=missing)
+                                     .select_subclasses())
+            rendered.update(render_items(items))
+
+            # Cache what we rendered for next time.
+            to_cache = dict((page.get_item_fragment_key(pk), rendered[pk])
+                            for pk in missing if pk in rendered)
+            if to_cache:
+                page_cache.set_many(to_cache, timeout)
+
+        for pk in chunk:
+            if pk in rendered:
+                if separator is not None:
+                    yield separator
+                separator = '\n\n'
+                yield rendered[pk]
+
+
+@register.simple_tag
+def page_content(page):
+    """
+    Render a page's content items, caching each item's output (see
+    iter_page_content).
+
+    Use this in place of {{ page.get_rendered_content|safe }}:
+        {% load pages_tags %}
+        {% page_content object %}
+    """
+    # Something (like a streaming view) may have rendered this already.
+    if page.rendered_content is None:
+        page.rendered_content = ''.join(iter_page_content(page))
+    return mark_safe(page.rendered_content)
@@ -1,16 +1,53 @@
+import BaseHTTPServer
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import zlib
+from io import BytesIO
+from StringIO import StringIO
+
 from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.contrib.sites.models import Site
 from django.core.cache import cache
 from django.core.exceptions import ValidationError
+from django.core.management import call_command
 from django.db import connection
+from django.db.models import F
+from django.template import Context, Template
 from django.db.utils import IntegrityError
 from django.test import SimpleTestCase, TestCase
 from django.test.client import Client, RequestFactory
+from django.test.utils import override_settings
+from django.utils import timezone
 
 from flexible_content.default_item_types.models import PlainText
 from mock_project.test_app import views as test_app_views
+from mock_project.test_app.cache import CountingCache
 
-from .models import Page
-from .views import default_page_view
+from . import (admin_utils, popularity, routers, sites, timing, url_index,
+               utils)
+from . import search as search_module
+from .admin import PageAdmin
+from .breaker import breaker, page_cache
+from .bulk import PageImporter, read_csv, read_json
+from .managers import PageManager
+from .models import Page, PageAccessCount, PageSearchToken
+from .prerender import MANIFEST_NAME, get_page_location, prerender_pages
+from .purge import PurgeQueue
+from .radix import RadixTree
+from .search import rebuild_index, search
+from .singleflight import SingleFlight
+from .url_index import (URLIndex, build_index, get_index_key,
+                        get_journal_path, write_index)
+from .views import default_page_view, iter_for_page
+from .warmup import warm_page_views
+from .wsgi import PageCacheApplication
 
 VALID_PATHS = [
     '/',
@@ -344,6 +381,10 @@ class PageIntegrationTest(TestCase):
         response = client.get('/page-does-not-exist/')
         self.assertEquals(response.status_code, 404)
 
+    def test_nonexistent_non_ascii_page(self):
+        response = client.get('/caf%C3%A9/')
+        self.assertEquals(response.status_code, 404)
+
     def test_custom_template(self):
         """
         Make sure custom templates are honored, too.
@@ -361,3 +402,1582 @@ class PageIntegrationTest(TestCase):
                       response,
                       msg="Response didn't include text from the custom template.")
 
+
+
+class PageWarmupTest(TestCase):
+    fixtures = ['test-data.json']
+
+    def setUp(self):
+        utils._view_cache.clear()
+
+    def test_warm_imports_custom_views(self):
+        """
+        Every custom view used by a page should be imported and cached.
+        """
+        view_string = 'mock_project.test_app.views.custom_view'
+        Page.objects.filter(url='/test/').update(view=view_string)
+
+        report = warm_page_views(close_connections=False)
+
+        self.assertEqual([r[0] for r in report], [view_string])
+        self.assertEqual(utils._view_cache[view_string],
+                         test_app_views.custom_view)
+
+    def test_warm_reports_broken_views(self):
+        """
+        A view that can't be imported should be reported, not raised.
+        """
+        view_string = 'mock_project.test_app.views.nonexistent_view'
+        # Sneak past validation, as if the view had been deleted since.
+        Page.objects.filter(url='/test/').update(view=view_string)
+
+        report = warm_page_views(close_connections=False)
+
+        self.assertEqual(report[0][0], view_string)
+        self.assertIsNone(report[0][2])
+        self.assertIsNone(Page.objects.get(url='/test/').get_custom_view())
+        # It might be deployed later, so it's tried again next time.
+        self.assertNotIn(view_string, utils._view_cache)
+
+
+class PurgeServer(BaseHTTPServer.HTTPServer):
+    """
+    A stand-in for a proxy's purge endpoint, which records what it's sent.
+    """
+    def __init__(self, failures=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           PurgeRequestHandler)
+        self.failures = failures
+        self.received = []
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}/purge/'.format(self.server_address[1])
+
+    def wait_for(self, count, timeout=5):
+        deadline = time.time() + timeout
+        while len(self.received) < count and time.time() < deadline:
+            time.sleep(0.01)
+        return self.received
+
+
+class PurgeRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def handle_purge(self):
+        self.server.received.append((self.command,
+                                     self.headers.get('Surrogate-Key')))
+        if self.server.failures:
+            self.server.failures -= 1
+            self.send_response(503)
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+    do_POST = do_PURGE = handle_purge
+
+    def log_message(self, *args):
+        pass
+
+
+class PageProxyCachingTest(TestCase):
+    fixtures = ['test-data.json']
+
+    def setUp(self):
+        cache.clear()
+        self.server = PurgeServer()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_response_headers(self):
+        """
+        Pages should carry the configured Cache-Control and surrogate keys.
+        """
+        with override_settings(FLEXIBLE_PAGES={
+                'CACHE_CONTROL': {'public': True, 'max_age': 300},
+                'SURROGATE_KEYS': True}):
+            response = client.get('/test/')
+
+        self.assertIn('max-age=300', response['Cache-Control'])
+        self.assertIn('public', response['Cache-Control'])
+        self.assertEqual(response['Surrogate-Key'].split(),
+                         ['page-2', 'fc-item-2'])
+
+    def test_no_headers_by_default(self):
+        response = client.get('/test/')
+        self.assertFalse(response.has_header('Surrogate-Key'))
+        self.assertFalse(response.has_header('Cache-Control'))
+
+    def test_batches_coalesce_and_retry(self):
+        """
+        Repeated keys are sent once, batches are split, and failures retried.
+        """
+        self.server.failures = 1
+        queue = PurgeQueue(self.server.url, method='PURGE', batch_size=2,
+                           backoff=0)
+        queue.pending.update(['page-1', 'page-2', 'page-1', 'fc-item-3'])
+        queue.flush()
+
+        self.assertEqual(self.server.received, [
+            ('PURGE', 'fc-item-3 page-1'),
+            ('PURGE', 'fc-item-3 page-1'),
+            ('PURGE', 'page-2'),
+        ])
+
+    def test_save_enqueues_purge(self):
+        """
+        Saving a page should purge it in the background.
+        """
+        with override_settings(FLEXIBLE_PAGES={'PURGE_URL': self.server.url,
+                                               'PURGE_INTERVAL': 0}):
+            Page.objects.get(url='/test/').save()
+            received = self.server.wait_for(1)
+
+        self.assertEqual(received, [('POST', 'page-2')])
+
+
+class PagePrerenderTest(TestCase):
+    fixtures = ['test-data.json']
+
+    def setUp(self):
+        cache.clear()
+        self.output_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def read_output(self, url):
+        path = os.path.join(self.output_dir, url.lstrip('/'), 'index.html')
+        with open(path) as f:
+            return f.read()
+
+    def test_renders_every_page(self):
+        """
+        Both CMS-only and URLpattern-driven pages should end up on disk.
+        """
+        counts = prerender_pages(self.output_dir, processes=1)
+
+        self.assertEqual(counts['rendered'], 2)
+        self.assertIn("Text on a random page!", self.read_output('/test/'))
+        self.assertIn("This is our homepage's baked-in text.",
+                      self.read_output('/'))
+
+    def test_only_changed_pages_rerendered(self):
+        prerender_pages(self.output_dir, processes=1)
+
+        page = Page.objects.get(url='/test/')
+        page.title = "A new title!"
+        page.save()
+        counts = prerender_pages(self.output_dir, processes=1)
+
+        self.assertEqual((counts['rendered'], counts['skipped']), (1, 1))
+        self.assertIn("A new title!", self.read_output('/test/'))
+
+    def test_deleted_pages_removed(self):
+        prerender_pages(self.output_dir, processes=1)
+
+        Page.objects.get(url='/test/').delete()
+        counts = prerender_pages(self.output_dir, processes=1)
+
+        self.assertEqual(counts['removed'], 1)
+        self.assertRaises(IOError, self.read_output, '/test/')
+
+    def test_rerender_on_save(self):
+        with override_settings(FLEXIBLE_PAGES={
+                'PRERENDER_DIR': self.output_dir,
+                'PRERENDER_ON_SAVE': True}):
+            page = Page.objects.get(url='/test/')
+            page.title = "Saved and rendered!"
+            page.save()
+
+        self.assertIn("Saved and rendered!", self.read_output('/test/'))
+
+    def test_delete_and_move_remove_old_copies(self):
+        with override_settings(FLEXIBLE_PAGES={
+                'PRERENDER_DIR': self.output_dir,
+                'PRERENDER_ON_SAVE': True}):
+            page = Page.objects.get(url='/test/')
+            page.save()
+            page.url = '/moved/'
+            page.save()
+            self.assertRaises(IOError, self.read_output, '/test/')
+            self.assertIn("This is a random page!",
+                          self.read_output('/moved/'))
+
+            page.delete()
+            self.assertRaises(IOError, self.read_output, '/moved/')
+
+        with open(os.path.join(self.output_dir, MANIFEST_NAME)) as f:
+            manifest = json.load(f)
+        self.assertNotIn(get_page_location(1, '/test/'), manifest)
+        self.assertNotIn(get_page_location(1, '/moved/'), manifest)
+
+    def test_rerender_on_item_save(self):
+        with override_settings(FLEXIBLE_PAGES={
+                'PRERENDER_DIR': self.output_dir,
+                'PRERENDER_ON_SAVE': True}):
+            item = PlainText.objects.get(text="Text on a random page!")
+            item.text = "Edited and rendered!"
+            item.save()
+
+        self.assertIn("Edited and rendered!", self.read_output('/test/'))
+
+    def test_stale_save_still_bumps_revision(self):
+        page = Page.objects.get(url='/test/')
+        item = PlainText.objects.get(text="Text on a random page!")
+        item.text = "Edited text!"
+        item.save()
+        revision = Page.objects.get(pk=page.pk).revision
+
+        page.title = "Saved from a stale copy"
+        page.save()
+
+        self.assertEqual(page.revision, revision + 1)
+        self.assertEqual(Page.objects.get(pk=page.pk).revision, revision + 1)
+
+    def test_admin_add_renders_items(self):
+        """
+        A page added in the admin gets its items after it's saved; its static
+        copy and search index entry should have them, and it should be
+        recorded at its final revision.
+        """
+        User.objects.create_superuser('admin', 'admin@example.com', 'pw')
+        client = Client()
+        client.login(username='admin', password='pw')
+        text_type = ContentType.objects.get_for_model(PlainText)
+
+        with override_settings(FLEXIBLE_PAGES={
+                'PRERENDER_DIR': self.output_dir,
+                'PRERENDER_ON_SAVE': True}):
+            response = client.post('/admin/pages/page/add/', {
+                'url': '/added/',
+                'title': "Added in the admin",
+                'site': 1,
+                'fc-prefixes': 'fc-item-1',
+                'fc-item-1-ct': text_type.pk,
+                'fc-item-1-text': "Tagalong text, added with the page!",
+                'fc-item-1-ordering': 1,
+            })
+
+        self.assertEqual(response.status_code, 302)
+        page = Page.objects.get(url='/added/')
+        self.assertIn("Tagalong text, added with the page!",
+                      self.read_output('/added/'))
+        with open(os.path.join(self.output_dir, MANIFEST_NAME)) as f:
+            manifest = json.load(f)
+        self.assertEqual(manifest[get_page_location(1, '/added/')],
+                         page.revision)
+        # The items were indexed too, though they came after the page.
+        self.assertEqual(search(u"tagalong"), [page.pk])
+
+
+class PageFragmentCacheTest(TestCase):
+    fixtures = ['test-data.json']
+
+    def setUp(self):
+        settings.DEBUG = True
+        cache.clear()
+
+    def tearDown(self):
+        settings.DEBUG = False
+
+    def render(self, url):
+        # Fetch a fresh copy each time, like a new request would.
+        page = Page.objects.get(url=url)
+        template = Template("{% load pages_tags %}{% page_content page %}")
+        return template.render(Context({'page': page}))
+
+    def test_cached_blocks_need_no_queries(self):
+        first = self.render('/test/')
+
+        page = Page.objects.get(url='/test/')
+        connection.queries = []
+        template = Template("{% load pages_tags %}{% page_content page %}")
+        second = template.render(Context({'page': page}))
+
+        self.assertEqual(len(connection.queries), 0)
+        self.assertEqual(first, second)
+        self.assertIn("Text on a random page!", second)
+
+    def test_block_save_invalidates(self):
+        self.render('/test/')
+
+        item = PlainText.objects.get(text="Text on a random page!")
+        item.text = "Edited text!"
+        item.save()
+
+        self.assertIn("Edited text!", self.render('/test/'))
+
+    def test_page_save_invalidates(self):
+        self.render('/test/')
+
+        item = PlainText.objects.get(text="Text on a random page!")
+        # Sneak an edit past the signals; saving the page should still pick
+        # it up, since the page's revision changes.
+        PlainText.objects.filter(pk=item.pk).update(text="Sneaky text!")
+        Page.objects.get(url='/test/').save()
+
+        self.assertIn("Sneaky text!", self.render('/test/'))
+
+
+class CountingCacheMixin(object):
+    """
+    Put a CountingCache behind page_cache for each test, in place of the
+    project's cache.
+    """
+
+    def setUp(self):
+        self.project_cache = page_cache.cache
+        page_cache.cache = CountingCache('counting', {})
+        page_cache.cache.clear()
+
+    def tearDown(self):
+        page_cache.cache = self.project_cache
+        CountingCache.fail = False
+        CountingCache.delay = 0
+
+
+@override_settings(FLEXIBLE_PAGES={'RESPONSE_CACHE_TIMEOUT': 60})
+class PageSingleRoundTripTest(CountingCacheMixin, TestCase):
+    fixtures = ['test-data.json']
+
+    def setUp(self):
+        super(PageSingleRoundTripTest, self).setUp()
+        Page.objects.create(title="Documentation", url='/docs/',
+                            match_prefix=True)
+
+    def assertOneRoundTrip(self, path, **headers):
+        client.get(path)
+        client.get(path)
+        CountingCache.round_trips = 0
+        response = client.get(path, **headers)
+        self.assertEqual(CountingCache.round_trips, 1)
+        return response
+
+    def test_cached_page(self):
+        response = self.assertOneRoundTrip('/test/')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("Text on a random page!", response.content)
+
+    def test_cached_path_beneath_prefix_page(self):
+        response = self.assertOneRoundTrip('/docs/install/')
+        self.assertIn("Documentation", response.content)
+
+    def test_conditional_get(self):
+        etag = client.get('/test/')['ETag']
+        response = self.assertOneRoundTrip('/test/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, '')
+        self.assertEqual(response['ETag'], etag)
+
+    def test_prefix_page_content_change_reaches_paths_beneath(self):
+        client.get('/docs/install/')
+        docs = Page.objects.get(url='/docs/')
+        PlainText.objects.create(content_area=docs, text="New docs text")
+        self.assertIn("New docs text", client.get('/docs/install/').content)
+
+
+class PageSingleFlightTest(TestCase):
+    def run_together(self, function, count=8):
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(function()))
+                   for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_concurrent_calls_share_one(self):
+        flight = SingleFlight()
+        calls = []
+
+        def slow():
+            calls.append(1)
+            time.sleep(0.1)
+            return ['result']
+
+        results = self.run_together(lambda: flight.do('key', slow))
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [['result']] * 8)
+        # Everyone gets their own copy.
+        self.assertEqual(len(set(id(result) for result in results)), 8)
+
+    def test_exceptions_are_shared(self):
+        flight = SingleFlight()
+
+        def fail():
+            time.sleep(0.1)
+            raise Page.DoesNotExist()
+
+        def call():
+            try:
+                flight.do('key', fail)
+            except Page.DoesNotExist:
+                return 'raised'
+
+        self.assertEqual(self.run_together(call), ['raised'] * 8)
+
+    def test_concurrent_misses_hit_database_once(self):
+        cache.clear()
+        lookups = []
+
+        def get_from_db(manager, path, path_key, site_id=None):
+            lookups.append(path)
+            time.sleep(0.2)
+            return Page(title="Shared", url=path)
+
+        original = PageManager.get_from_db
+        PageManager.get_from_db = get_from_db
+        try:
+            pages = self.run_together(
+                lambda: Page.objects.get_for_url('/shared/'))
+        finally:
+            PageManager.get_from_db = original
+
+        self.assertEqual(lookups, ['/shared/'])
+        self.assertEqual([page.title for page in pages], ["Shared"] * 8)
+
+    def test_copies_share_nothing(self):
+        flight = SingleFlight()
+
+        def slow():
+            time.sleep(0.1)
+            return {'related': {}}
+
+        results = self.run_together(lambda: flight.do('key', slow))
+        self.assertEqual(len(set(id(result['related'])
+                                 for result in results)), 8)
+
+    def test_misses_only_shared_with_same_database(self):
+        cache.clear()
+        lookups = []
+
+        def get_from_db(manager, path, path_key, site_id=None):
+            lookups.append(routers.reading_from_replica())
+            time.sleep(0.2)
+            return Page(title="Shared", url=path)
+
+        def get_for_url(replica):
+            reads = routers.replica_reads if replica else routers.primary_reads
+            with reads():
+                return Page.objects.get_for_url('/shared/')
+
+        original = PageManager.get_from_db
+        PageManager.get_from_db = get_from_db
+        try:
+            results = [[], []]
+            threads = [threading.Thread(
+                target=lambda replica=i % 2: results[replica].append(
+                    get_for_url(replica))) for i in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            PageManager.get_from_db = original
+
+        self.assertEqual(sorted(lookups), [False, True])
+        self.assertEqual(map(len, results), [4, 4])
+
+
+@override_settings(FLEXIBLE_PAGES={'CACHE_FAILURE_THRESHOLD': 2,
+                                   'CACHE_RETRY_AFTER': 0.2,
+                                   'CACHE_LATENCY_BUDGET': 0.02})
+class PageCacheBreakerTest(CountingCacheMixin, TestCase):
+    fixtures = ['test-data.json']
+
+    def setUp(self):
+        super(PageCacheBreakerTest, self).setUp()
+        breaker.reset()
+
+    def tearDown(self):
+        super(PageCacheBreakerTest, self).tearDown()
+        breaker.reset()
+
+    def test_failing_cache_opens_breaker(self):
+        CountingCache.fail = True
+        for i in range(3):
+            self.assertEqual(client.get('/test/').status_code, 200)
+        self.assertEqual(breaker.state, 'open')
+
+        # Pages are still served, without waiting on the cache at all.
+        CountingCache.round_trips = 0
+        response = client.get('/test/')
+        self.assertIn("Text on a random page!", response.content)
+        self.assertEqual(CountingCache.round_trips, 0)
+
+    def test_slow_cache_opens_breaker(self):
+        CountingCache.delay = 0.03
+        client.get('/test/')
+        client.get('/test/')
+        self.assertEqual(breaker.state, 'open')
+        self.assertGreater(breaker.stats['slow'], 0)
+
+    def test_breaker_recovers(self):
+        CountingCache.fail = True
+        client.get('/test/')
+        client.get('/test/')
+        self.assertEqual(breaker.state, 'open')
+
+        # Still broken when the probe goes through: stay open.
+        time.sleep(0.25)
+        client.get('/test/')
+        self.assertEqual(breaker.state, 'open')
+
+        CountingCache.fail = False
+        time.sleep(0.25)
+        client.get('/test/')
+        self.assertEqual(breaker.state, 'closed')
+        self.assertEqual(breaker.stats['closed'], 1)
+
+    def test_caching_a_lookup_is_one_trip(self):
+        CountingCache.round_trips = 0
+        Page.objects.set_in_cache('/test/', Page.get_key_for_path('/test/'),
+                                  PageManager.CACHE_404_VALUE)
+        self.assertEqual(CountingCache.round_trips, 1)
+        self.assertEqual(breaker.stats['calls'], 1)
+
+    def test_saving_page_with_cache_down(self):
+        CountingCache.fail = True
+        page = Page.objects.get(url='/test/')
+        page.title = "Saved anyway"
+        page.save()
+        self.assertEqual(Page.objects.get(url='/test/').title, "Saved anyway")
+
+
+@override_settings(FLEXIBLE_PAGES={'STREAM_PAGES': True})
+class PageStreamingTest(TestCase):
+    fixtures = ['test-data.json']
+
+    def setUp(self):
+        cache.clear()
+        page = Page.objects.get(url='/test/')
+        for i in range(5):
+            PlainText.objects.create(content_area=page, ordering=i + 2,
+                                     text="Streamed block {}".format(i))
+
+    def test_head_goes_out_before_content_is_rendered(self):
+        response = client.get('/test/')
+        self.assertTrue(response.streaming)
+
+        chunks = iter(response.streaming_content)
+        with self.assertNumQueries(0):
+            head = next(chunks)
+        self.assertIn("<h1>", head)
+        self.assertNotIn("Streamed block", head)
+
+        rest = ''.join(chunks)
+        self.assertIn("Text on a random page!", rest)
+        self.assertLess(rest.index("Streamed block 0"),
+                        rest.index("Streamed block 4"))
+
+    def test_streamed_matches_rendered(self):
+        streamed = ''.join(client.get('/test/').streaming_content)
+        with self.settings(FLEXIBLE_PAGES={}):
+            cache.clear()
+            self.assertEqual(streamed, client.get('/test/').content)
+
+    def test_custom_template_streams(self):
+        Page.objects.filter(url='/test/').update(
+            template='pages/custom.html')
+        cache.clear()
+        content = ''.join(client.get('/test/').streaming_content)
+        self.assertIn("NOT the default template", content)
+        self.assertIn("Streamed block 4", content)
+
+    def test_streamed_content_read_like_the_page(self):
+        page = Page.objects.get(url='/test/')
+        databases = []
+
+        def chunks():
+            databases.append(routers.PageReplicaRouter().db_for_read(Page))
+            yield "Chunk"
+
+        with self.settings(FLEXIBLE_PAGES={'READ_REPLICAS': ['replica']}):
+            streamed = iter_for_page(page, chunks(),
+                                     RequestFactory().get('/test/'))
+            self.assertEqual(list(streamed), ["Chunk"])
+        self.assertEqual(databases, ['replica'])
+
+    def test_streamed_content_is_timed(self):
+        timing.stats.clear()
+        with self.settings(FLEXIBLE_PAGES={'STREAM_PAGES': True,
+                                           'TIMING': True}):
+            ''.join(client.get('/test/').streaming_content)
+        stages = dict(timing.stats.get_slowest())['/test/']
+        self.assertEqual(stages['stream'].count, 1)
+
+    def test_template_without_content_isnt_streamed(self):
+        Page.objects.filter(url='/test/').update(
+            template='pages/title-only.html')
+        cache.clear()
+        response = client.get('/test/')
+        self.assertFalse(response.streaming)
+        self.assertEqual(response.status_code, 200)
+
+
+@override_settings(FLEXIBLE_PAGES={'RESPONSE_CACHE_TIMEOUT': 60})
+class PageResponseCacheTest(TestCase):
+    fixtures = ['test-data.json']
+
+    def setUp(self):
+        settings.DEBUG = True
+        cache.clear()
+        # Make the page long enough to be worth compressing.
+        PlainText.objects.filter(text="Text on a random page!").update(
+            text="Text on a random page! " * 20)
+
+    def tearDown(self):
+        settings.DEBUG = False
+
+    def test_second_hit_served_from_cache(self):
+        first = client.get('/test/')
+        connection.queries = []
+        second = client.get('/test/')
+
+        self.assertEqual(len(connection.queries), 0)
+        self.assertEqual(first.content, second.content)
+        self.assertEqual(second['Content-Length'], str(len(second.content)))
+        self.assertIn('Accept-Encoding', second['Vary'])
+
+    def test_gzip_variant(self):
+        identity = client.get('/test/')
+        response = client.get('/test/', HTTP_ACCEPT_ENCODING='gzip, deflate')
+
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response['Content-Length'], str(len(response.content)))
+        body = gzip.GzipFile(fileobj=BytesIO(response.content)).read()
+        self.assertEqual(body, identity.content)
+
+    def test_deflate_variant(self):
+        identity = client.get('/test/')
+        response = client.get('/test/',
+                              HTTP_ACCEPT_ENCODING='gzip;q=0, deflate')
+
+        self.assertEqual(response['Content-Encoding'], 'deflate')
+        self.assertEqual(zlib.decompress(response.content), identity.content)
+
+    def test_save_invalidates(self):
+        client.get('/test/')
+        page = Page.objects.get(url='/test/')
+        page.title = "A brand new title"
+        page.save()
+
+        self.assertIn("A brand new title", client.get('/test/').content)
+
+    def test_cookie_dependent_responses_not_shared(self):
+        """
+        A response that depends on cookies is only reused without cookies.
+        """
+        client.get('/test/')
+        # Mark the cached copy, so we can tell when it's served.
+        entry = cache.get(Page.get_response_key_for_path('/test/'))
+        entry.varies_on_cookie = True
+        entry.bodies = {'identity': "From the cache"}
+        cache.set(Page.get_response_key_for_path('/test/'), entry)
+
+        self.assertEqual(client.get('/test/').content, "From the cache")
+        self.assertIn('Cookie', client.get('/test/')['Vary'])
+        cookie_client = Client(HTTP_COOKIE='sessionid=abc')
+        self.assertNotEqual(cookie_client.get('/test/').content,
+                            "From the cache")
+
+
+@override_settings(FLEXIBLE_PAGES={'RESPONSE_CACHE_TIMEOUT': 60})
+class PageWSGIFastPathTest(TestCase):
+    fixtures = ['test-data.json']
+
+    def setUp(self):
+        cache.clear()
+        PlainText.objects.filter(text="Text on a random page!").update(
+            text="Text on a random page! " * 20)
+        self.fallthrough_calls = []
+        self.application = PageCacheApplication(self.fallthrough)
+
+    def fallthrough(self, environ, start_response):
+        self.fallthrough_calls.append(environ)
+        start_response('200 OK', [])
+        return ['Django']
+
+    def call(self, path='/test/', **environ):
+        defaults = {
+            'REQUEST_METHOD': 'GET',
+            'PATH_INFO': path,
+            'SCRIPT_NAME': '',
+            'QUERY_STRING': '',
+        }
+        defaults.update(environ)
+        started = {}
+
+        def start_response(status, headers):
+            started['status'] = status
+            started['headers'] = dict(headers)
+        body = ''.join(self.application(defaults, start_response))
+        return started['status'], started['headers'], body
+
+    def test_cached_page_served(self):
+        rendered = client.get('/test/')
+        status, headers, body = self.call()
+
+        self.assertEqual(self.fallthrough_calls, [])
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(body, rendered.content)
+        self.assertEqual(headers['Content-Length'], str(len(body)))
+        self.assertIn('Accept-Encoding', headers['Vary'])
+
+    def test_compressed_variant(self):
+        rendered = client.get('/test/')
+        status, headers, body = self.call(HTTP_ACCEPT_ENCODING='gzip')
+
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.GzipFile(fileobj=BytesIO(body)).read(),
+                         rendered.content)
+
+    def test_head_has_no_body(self):
+        client.get('/test/')
+        status, headers, body = self.call(REQUEST_METHOD='HEAD')
+        self.assertEqual(body, '')
+        self.assertNotEqual(headers['Content-Length'], '0')
+
+    def test_uncached_page_falls_through(self):
+        self.call()
+        self.assertEqual(len(self.fallthrough_calls), 1)
+
+    def test_cookies_fall_through(self):
+        client.get('/test/')
+        self.call(HTTP_COOKIE='sessionid=abc')
+        self.assertEqual(len(self.fallthrough_calls), 1)
+
+    def test_post_and_query_strings_fall_through(self):
+        client.get('/test/')
+        self.call(REQUEST_METHOD='POST')
+        self.call(QUERY_STRING='page=2')
+        self.assertEqual(len(self.fallthrough_calls), 2)
+
+    def test_stale_response_falls_through(self):
+        client.get('/test/')
+        # Bump the revision behind the cache's back; the cached page and its
+        # response no longer agree once the page is re-cached.
+        Page.objects.filter(url='/test/').update(revision=F('revision') + 1)
+        cache.delete(Page.get_key_for_path('/test/'))
+        Page.objects.get_for_url('/test/')
+
+        self.call()
+        self.assertEqual(len(self.fallthrough_calls), 1)
+
+    def test_cookie_varying_response_served_without_cookies(self):
+        """
+        A response that varies on cookies is fine for cookieless requests,
+        and says so in its Vary header.
+        """
+        client.get('/test/')
+        key = Page.get_response_key_for_path('/test/')
+        entry = cache.get(key)
+        entry.varies_on_cookie = True
+        cache.set(key, entry)
+
+        status, headers, body = self.call()
+        self.assertEqual(self.fallthrough_calls, [])
+        self.assertIn('Cookie', headers['Vary'])
+
+    def test_disabled_without_response_cache(self):
+        client.get('/test/')
+        with override_settings(FLEXIBLE_PAGES={}):
+            self.call()
+        self.assertEqual(len(self.fallthrough_calls), 1)
+
+
+@override_settings(FLEXIBLE_PAGES={'TIMING': True})
+class PageTimingTest(TestCase):
+    fixtures = ['test-data.json']
+
+    def setUp(self):
+        cache.clear()
+        timing.stats.clear()
+
+    def test_server_timing_header(self):
+        response = client.get('/test/')
+        stages = [part.split(';')[0]
+                  for part in response['Server-Timing'].split(', ')]
+
+        for stage in ('cache', 'db', 'resolve', 'view', 'render', 'total'):
+            self.assertIn(stage, stages)
+
+    def test_no_header_unless_enabled(self):
+        with override_settings(FLEXIBLE_PAGES={}):
+            response = client.get('/test/')
+        self.assertFalse(response.has_header('Server-Timing'))
+
+    def test_stats_aggregated_per_page(self):
+        for i in range(3):
+            client.get('/test/')
+        client.get('/page-does-not-exist/')
+
+        slowest = timing.stats.get_slowest()
+        self.assertEqual([url for url, stages in slowest], ['/test/'])
+        self.assertEqual(slowest[0][1]['total'].count, 3)
+
+    def test_stats_view_staff_only(self):
+        from django.contrib.auth.models import User
+        client.get('/test/')
+        url = '/admin/pages/page/timings/'
+
+        self.assertNotIn('/test/', client.get(url).content)
+
+        User.objects.create_superuser('admin', 'admin@example.com', 'pw')
+        staff_client = Client()
+        staff_client.login(username='admin', password='pw')
+        self.assertIn('/test/', staff_client.get(url).content)
+
+
+@override_settings(FLEXIBLE_PAGES={'READ_REPLICAS': ['replica'],
+                                   'REPLICA_LAG': 60})
+class PageReplicaTest(TestCase):
+    """
+    The 'replica' database never receives writes here, so it behaves like a
+    replica that's lagging badly.
+    """
+    multi_db = True
+
+    def setUp(self):
+        cache.clear()
+
+    def get_for_url(self, path):
+        with routers.replica_reads():
+            return Page.objects.get_for_url(path)
+
+    def test_reads_go_to_replica(self):
+        Page.objects.using('replica').create(title="Only on the replica",
+                                             url='/replica/')
+        cache.delete(routers.get_pin_key('/replica/'))
+
+        self.assertEqual(self.get_for_url('/replica/').title,
+                         "Only on the replica")
+
+    def test_admin_reads_stay_on_primary(self):
+        Page.objects.create(title="New page", url='/new/')
+        # Outside of a page request, nothing is sent to the replica.
+        self.assertIsNone(routers.PageReplicaRouter().db_for_read(Page))
+
+        User.objects.create_superuser('admin', 'admin@example.com', 'pw')
+        staff_client = Client()
+        staff_client.login(username='admin', password='pw')
+        cl = staff_client.get('/admin/pages/page/').context['cl']
+        self.assertEqual(cl.query_set.db, 'default')
+        self.assertIn('/new/', [page.url for page in cl.result_list])
+
+    def test_recently_saved_page_pinned_to_primary(self):
+        Page.objects.create(title="New page", url='/new/')
+        page = self.get_for_url('/new/')
+
+        self.assertEqual(page.title, "New page")
+        # The cached copy should know to render from the primary, too.
+        cached = cache.get(Page.get_key_for_path('/new/'))
+        with routers.reads_for_page(cached):
+            self.assertEqual(routers.PageReplicaRouter().db_for_read(Page),
+                             None)
+
+    def test_pin_expires(self):
+        Page.objects.create(title="New page", url='/new/')
+        cache.delete(routers.get_pin_key('/new/'))
+        cache.delete(Page.get_key_for_path('/new/'))
+
+        # The lagging replica doesn't have it yet.
+        self.assertRaises(Page.DoesNotExist, self.get_for_url, '/new/')
+
+    def test_rendering_reads_from_primary_while_pinned(self):
+        page = Page.objects.create(title="New page", url='/new/')
+        PlainText.objects.create(content_area=page, text="Fresh text!")
+
+        self.assertIn("Fresh text!", client.get('/new/').content)
+
+
+class PageURLIndexTest(TestCase):
+    fixtures = ['test-data.json']
+
+    def setUp(self):
+        settings.DEBUG = True
+        cache.clear()
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'urls.idx')
+        build_index(self.path)
+        self.settings = override_settings(
+            FLEXIBLE_PAGES={'URL_INDEX_PATH': self.path})
+        self.settings.enable()
+
+    def tearDown(self):
+        self.settings.disable()
+        settings.DEBUG = False
+        shutil.rmtree(self.directory)
+
+    def test_lookups(self):
+        entries = [('/', 1), ('/a/', 5), ('/a/b/', 7), ('/z/', 9)]
+        write_index(self.path, reversed(entries))
+        index = URLIndex(self.path)
+
+        self.assertEqual(list(index), entries)
+        for url, page_id in entries:
+            self.assertEqual(index.lookup(url), page_id)
+        for url in ('/b/', '/a/b/c/', '/zz/', ''):
+            self.assertIsNone(index.lookup(url))
+
+    def test_indexed_ids_need_no_db(self):
+        connection.queries = []
+        self.assertEqual(Page.objects.get_id_for_url('/test/'), 2)
+        self.assertEqual(len(connection.queries), 0)
+
+    def test_pages_missing_from_index_still_found(self):
+        """
+        Pages created without a save aren't in the index, but they exist.
+        """
+        Page.objects.bulk_create([Page(title="Bulk page", url='/bulk/')])
+        page = Page.objects.get(url='/bulk/')
+
+        self.assertEqual(Page.objects.get_for_url('/bulk/'), page)
+        self.assertEqual(Page.objects.get_id_for_url('/bulk/'), page.pk)
+        self.assertRaises(Page.DoesNotExist, Page.objects.get_for_url,
+                          '/not-a-real-page/')
+
+    def test_index_misses_final_when_authoritative(self):
+        Page.objects.bulk_create([Page(title="Bulk page", url='/bulk/')])
+        with override_settings(FLEXIBLE_PAGES={
+                'URL_INDEX_PATH': self.path,
+                'URL_INDEX_AUTHORITATIVE': True}):
+            connection.queries = []
+            self.assertRaises(Page.DoesNotExist, Page.objects.get_for_url,
+                              '/bulk/')
+            self.assertEqual(len(connection.queries), 0)
+            self.assertEqual(Page.objects.get_for_url('/test/').pk, 2)
+
+    def test_index_answers_for_missing_pages_while_cache_out(self):
+        breaker.state, breaker.opened_at = 'open', time.time()
+        try:
+            # (The first request loads this process's prefix pages.)
+            client.get('/not-a-real-page/')
+            connection.queries = []
+            self.assertEqual(client.get('/not-a-real-page/').status_code,
+                             404)
+            self.assertEqual(len(connection.queries), 0)
+            self.assertIn("Text on a random page!",
+                          client.get('/test/').content)
+        finally:
+            breaker.reset()
+
+    def test_content_changes_add_missing_pages(self):
+        Page.objects.bulk_create([Page(title="Bulk page", url='/bulk/')])
+        page = Page.objects.get(url='/bulk/')
+        PlainText.objects.create(content_area=page, text="Bulk text.")
+        self.assertEqual(URLIndex(self.path).lookup(get_index_key('/bulk/')),
+                         page.pk)
+
+    def test_imports_update_index(self):
+        size = os.path.getsize(self.path)
+        PageImporter().import_rows([{'url': '/imported/',
+                                     'title': "Imported"}])
+        page = Page.objects.get(url='/imported/')
+        self.assertEqual(os.path.getsize(self.path), size)
+        self.assertEqual(
+            URLIndex(self.path).lookup(get_index_key('/imported/')), page.pk)
+
+    def test_saves_update_index(self):
+        page = Page.objects.create(title="New page", url='/new/')
+        self.assertEqual(Page.objects.get_for_url('/new/'), page)
+
+        page.url = '/moved/'
+        page.save()
+        self.assertRaises(Page.DoesNotExist, Page.objects.get_for_url,
+                          '/new/')
+        self.assertEqual(Page.objects.get_id_for_url('/moved/'), page.pk)
+
+        page.delete()
+        self.assertIsNone(Page.objects.get_id_for_url('/moved/'))
+
+    def test_other_processes_see_swapped_file(self):
+        """
+        Another worker's map should pick up a rebuilt file.
+        """
+        other_worker = URLIndex(self.path)
+        Page.objects.create(title="New page", url='/new/')
+
+        other_worker.refresh(force=True)
+        self.assertIsNotNone(other_worker.lookup(get_index_key('/new/')))
+
+    def test_saves_are_journaled_then_folded(self):
+        size = os.path.getsize(self.path)
+        page = Page.objects.create(title="New page", url='/new/')
+        # The index itself is only rewritten once the journal is full.
+        self.assertEqual(os.path.getsize(self.path), size)
+
+        with open(get_journal_path(self.path), 'ab') as f:
+            f.write('\0' * url_index.JOURNAL_LIMIT)
+        Page.objects.create(title="Another page", url='/another/')
+
+        self.assertFalse(os.path.exists(get_journal_path(self.path)))
+        self.assertEqual(URLIndex(self.path).lookup(get_index_key('/new/')),
+                         page.pk)
+        self.assertEqual(len(URLIndex(self.path)), 4)
+
+    def test_empty_or_truncated_files_ignored(self):
+        write_index(self.path, [('/a/', 1), ('/b/', 2)])
+        with open(self.path, 'rb') as f:
+            valid = f.read()
+
+        for data in ['', 'FP', valid[:-10]]:
+            with open(self.path, 'wb') as f:
+                f.write(data)
+            self.assertFalse(URLIndex(self.path).available)
+            self.assertEqual(Page.objects.get_id_for_url('/test/'), 2)
+
+
+class RadixTreeTest(SimpleTestCase):
+    def test_longest_prefix(self):
+        tree = RadixTree((p, p) for p in ['/docs/', '/docs/api/', '/d/',
+                                          '/download/'])
+
+        self.assertEqual(len(tree), 4)
+        self.assertEqual(tree.longest_prefix('/docs/'), '/docs/')
+        self.assertEqual(tree.longest_prefix('/docs/install/'), '/docs/')
+        self.assertEqual(tree.longest_prefix('/docs/api/v2/'), '/docs/api/')
+        self.assertEqual(tree.longest_prefix('/download/x/'), '/download/')
+        self.assertEqual(tree.longest_prefix('/d/x/'), '/d/')
+        self.assertIsNone(tree.longest_prefix('/doc/'))
+        self.assertIsNone(tree.longest_prefix('/'))
+
+    def test_root_prefix(self):
+        tree = RadixTree([('/', 'root'), ('/a/', 'a')])
+        self.assertEqual(tree.longest_prefix('/b/c/'), 'root')
+        self.assertEqual(tree.longest_prefix('/a/c/'), 'a')
+
+
+class PagePrefixTest(TestCase):
+    fixtures = ['test-data.json']
+
+    def setUp(self):
+        cache.clear()
+        self.docs = Page.objects.create(title="Documentation", url='/docs/',
+                                        match_prefix=True)
+
+    def test_prefix_page_covers_paths_beneath(self):
+        response = client.get('/docs/install/step-one/')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("Documentation", response.content)
+
+    def test_exact_page_takes_precedence(self):
+        Page.objects.create(title="Frequently Asked", url='/docs/faq/')
+        self.assertIn("Frequently Asked", client.get('/docs/faq/').content)
+        self.assertIn("Documentation", client.get('/docs/other/').content)
+
+    def test_non_ascii_path_beneath(self):
+        for attempt in range(2):
+            response = client.get('/docs/caf%C3%A9/')
+            self.assertEqual(response.status_code, 200)
+            self.assertIn("Documentation", response.content)
+
+    def test_ordinary_pages_dont_cover_paths_beneath(self):
+        self.assertEqual(client.get('/test/beneath/').status_code, 404)
+
+    def test_unclaiming_prefix(self):
+        self.docs.match_prefix = False
+        self.docs.save()
+        self.assertEqual(client.get('/docs/install/').status_code, 404)
+
+
+@override_settings(FLEXIBLE_PAGES={'MULTI_SITE': True})
+class PageMultiSiteTest(TestCase):
+    fixtures = ['test-data.json']
+
+    def setUp(self):
+        settings.DEBUG = True
+        cache.clear()
+        self.other_site = Site.objects.create(domain='other.example.com',
+                                              name="Other")
+        self.other_page = Page.objects.create(site=self.other_site,
+                                              title="Page on another site",
+                                              url='/test/')
+
+    def tearDown(self):
+        settings.DEBUG = False
+
+    def test_sites_share_paths(self):
+        response = client.get('/test/', HTTP_HOST='other.example.com:8000')
+        self.assertIn("Page on another site", response.content)
+
+        response = client.get('/test/', HTTP_HOST='example.com')
+        self.assertIn("This is a random page!", response.content)
+        # Hosts we don't know get the default site.
+        response = client.get('/test/', HTTP_HOST='unknown.example.com')
+        self.assertIn("This is a random page!", response.content)
+
+        self.assertRaises(ValidationError, Page.objects.create,
+                          site=self.other_site, title="Again", url='/test/')
+
+    def test_only_the_site_is_found(self):
+        Page.objects.create(title="Default only", url='/default-only/')
+        self.assertEqual(client.get('/default-only/',
+                                    HTTP_HOST='other.example.com')
+                         .status_code, 404)
+        self.assertEqual(client.get('/default-only/').status_code, 200)
+
+    def test_namespace_bump_keeps_other_sites_cached(self):
+        other_id = self.other_site.pk
+        Page.objects.get_for_url('/test/')
+        Page.objects.get_for_url('/test/', site_id=other_id)
+
+        sites.bump_namespace(other_id)
+
+        connection.queries = []
+        self.assertEqual(Page.objects.get_for_url('/test/').site_id,
+                         settings.SITE_ID)
+        self.assertEqual(len(connection.queries), 0)
+        self.assertEqual(Page.objects.get_for_url('/test/', site_id=other_id),
+                         self.other_page)
+        self.assertEqual(len(connection.queries), 1)
+
+    def test_evicted_namespace_is_put_back(self):
+        Page.objects.get_for_url('/test/')
+        namespace = sites.get_namespace()
+        cache.delete(sites.get_namespace_key(settings.SITE_ID))
+
+        self.assertEqual(sites.note_namespace(settings.SITE_ID, None),
+                         namespace)
+        self.assertEqual(cache.get(sites.get_namespace_key(settings.SITE_ID)),
+                         namespace)
+        connection.queries = []
+        Page.objects.get_for_url('/test/')
+        self.assertEqual(len(connection.queries), 0)
+
+    def test_first_namespace_put_back_wins(self):
+        """
+        A process with no namespace of its own should follow one that another
+        process has just put back.
+        """
+        other_id = self.other_site.pk
+        sites._namespaces.pop(other_id, None)
+        cache.add(sites.get_namespace_key(other_id), 'theirs')
+        self.assertEqual(sites.note_namespace(other_id, None), 'theirs')
+
+    def test_domains_shared_through_cache(self):
+        sites.forget_domains()
+        sites.get_domains()
+        # Another process, say, with no domains loaded yet.
+        sites._domains = None
+        connection.queries = []
+        self.assertEqual(sites.get_domain(self.other_site.pk),
+                         'other.example.com')
+        self.assertEqual(len(connection.queries), 0)
+
+        self.other_site.domain = 'renamed.example.com'
+        self.other_site.save()
+        self.assertEqual(sites.get_domain(self.other_site.pk),
+                         'renamed.example.com')
+
+    def test_prefix_pages_are_per_site(self):
+        Page.objects.create(site=self.other_site, title="Other docs",
+                            url='/docs/', match_prefix=True)
+        response = client.get('/docs/install/', HTTP_HOST='other.example.com')
+        self.assertIn("Other docs", response.content)
+        self.assertEqual(client.get('/docs/install/').status_code, 404)
+
+
+class PagePopularityTest(TestCase):
+    fixtures = ['test-data.json']
+
+    def setUp(self):
+        cache.clear()
+        popularity.sketch.clear()
+        popularity.hot_paths.expire()
+
+    def count(self, path, hits):
+        PageAccessCount.objects.create(site_id=settings.SITE_ID, path=path,
+                                       hits=hits, last_seen=timezone.now())
+
+    @override_settings(FLEXIBLE_PAGES={'ACCESS_SAMPLE_RATE': 1,
+                                       'ACCESS_FLUSH_INTERVAL': 0})
+    def test_requests_are_counted(self):
+        for i in range(3):
+            client.get('/test/')
+        client.get('/')
+        client.get('/not-a-real-page/')
+
+        self.assertEqual(popularity.get_hot_paths(10),
+                         [(settings.SITE_ID, '/test/', 3),
+                          (settings.SITE_ID, '/', 1)])
+
+        self.assertEqual(popularity.decay_access_counts(2), 1)
+        self.assertEqual(popularity.get_hot_paths(10),
+                         [(settings.SITE_ID, '/test/', 1)])
+
+    def test_nothing_counted_by_default(self):
+        client.get('/test/')
+        popularity.sampler.flush()
+        self.assertEqual(PageAccessCount.objects.count(), 0)
+
+    @override_settings(FLEXIBLE_PAGES={'ACCESS_SAMPLE_RATE': 1,
+                                       'ACCESS_FLUSH_INTERVAL': 60})
+    def test_flushes_are_batched(self):
+        for path in ['/test/', '/test/', '/']:
+            popularity.record_access(settings.SITE_ID, path)
+
+        # The most sampled path goes first; the rest wait their turn.
+        popularity.sampler.flush(1)
+        self.assertEqual(popularity.get_hot_paths(10),
+                         [(settings.SITE_ID, '/test/', 2)])
+        popularity.sampler.flush()
+        self.assertEqual(len(popularity.get_hot_paths(10)), 2)
+
+    @override_settings(FLEXIBLE_PAGES={'ACCESS_SAMPLE_RATE': 1,
+                                       'ACCESS_FLUSH_INTERVAL': 60})
+    def test_long_paths_arent_counted(self):
+        popularity.record_access(settings.SITE_ID, '/' + 'a' * 300)
+        popularity.sampler.flush()
+        self.assertEqual(PageAccessCount.objects.count(), 0)
+
+    @override_settings(FLEXIBLE_PAGES={'ACCESS_SAMPLE_RATE': 1,
+                                       'ACCESS_FLUSH_INTERVAL': 60})
+    def test_existing_counts_added_to(self):
+        self.count('/test/', 5)
+        popularity.record_access(settings.SITE_ID, '/test/')
+        popularity.sampler.flush()
+        self.assertEqual(popularity.get_hot_paths(10),
+                         [(settings.SITE_ID, '/test/', 6)])
+
+    @override_settings(FLEXIBLE_PAGES={'ACCESS_SAMPLE_RATE': 1,
+                                       'ACCESS_FLUSH_INTERVAL': 60,
+                                       'RESPONSE_CACHE_TIMEOUT': 60})
+    def test_wsgi_fast_path_is_counted(self):
+        client.get('/test/')
+        popularity.sampler.flush()
+        PageCacheApplication(None)({
+            'REQUEST_METHOD': 'GET',
+            'PATH_INFO': '/test/',
+            'SCRIPT_NAME': '',
+            'QUERY_STRING': '',
+        }, lambda status, headers: None)
+        popularity.sampler.flush()
+        self.assertEqual(popularity.get_hot_paths(10),
+                         [(settings.SITE_ID, '/test/', 2)])
+
+    @override_settings(FLEXIBLE_PAGES={'CACHE_ADMISSION': True})
+    def test_one_off_paths_arent_cached(self):
+        self.assertRaises(Page.DoesNotExist, Page.objects.get_for_url,
+                          '/not-a-real-page/')
+        self.assertIsNone(cache.get(Page.get_key_for_path(
+            '/not-a-real-page/')))
+
+        Page.objects.get_for_url('/test/')
+        self.assertIsNone(cache.get(Page.get_key_for_path('/test/')))
+        # Its second lookup earns it a place in the cache.
+        Page.objects.get_for_url('/test/')
+        self.assertIsNotNone(cache.get(Page.get_key_for_path('/test/')))
+
+    @override_settings(FLEXIBLE_PAGES={'CACHE_ADMISSION': True})
+    def test_one_off_routes_arent_cached(self):
+        Page.objects.create(title="Documentation", url='/docs/',
+                            match_prefix=True)
+        route_key = Page.get_route_key_for_path('/docs/install/')
+
+        Page.objects.get_for_request_path('/docs/install/')
+        self.assertIsNone(cache.get(route_key))
+        Page.objects.get_for_request_path('/docs/install/')
+        self.assertIsNotNone(cache.get(route_key))
+
+    @override_settings(FLEXIBLE_PAGES={'CACHE_ADMISSION': True})
+    def test_hot_paths_are_admitted_at_once(self):
+        self.count('/test/', 500)
+        Page.objects.get_for_url('/test/')
+        self.assertIsNotNone(cache.get(Page.get_key_for_path('/test/')))
+
+    @override_settings(FLEXIBLE_PAGES={
+        'POPULAR_CACHE_TIMEOUTS': [(100, 600), (1000, 3600)]})
+    def test_popular_paths_cached_longer(self):
+        self.count('/test/', 5000)
+        self.count('/', 200)
+
+        def timeout(path):
+            return popularity.get_cache_timeout(settings.SITE_ID, path, 120)
+        self.assertEqual(timeout('/test/'), 3600)
+        self.assertEqual(timeout('/'), 600)
+        self.assertEqual(timeout('/cold/'), 120)
+
+    def test_warming_and_listing(self):
+        self.count('/test/', 50)
+        self.count('/', 10)
+        stdout = StringIO()
+        call_command('hot_pages', warm=True, stdout=stdout, stderr=StringIO())
+
+        self.assertIsNotNone(cache.get(Page.get_key_for_path('/test/')))
+        lines = stdout.getvalue().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[0].endswith('/test/'))
+
+
+class PageBulkImportTest(TestCase):
+    fixtures = ['test-data.json']
+
+    def setUp(self):
+        cache.clear()
+
+    def test_reading_json_array_in_small_chunks(self):
+        data = (u'[{"url": "/one/", "title": "Caf\u00e9"},\n'
+                u' {"url": "/two/", "title": "Two"}]').encode('utf-8')
+        rows = list(read_json(BytesIO(data), chunk_size=3))
+        self.assertEqual([row['url'] for row in rows], ['/one/', '/two/'])
+        self.assertEqual(rows[0]['title'], u'Caf\u00e9')
+
+    def test_reading_json_lines(self):
+        data = '{"url": "/one/", "title": "One"}\n{"url": "/two/", "title": "Two"}\n'
+        self.assertEqual(len(list(read_json(BytesIO(data)))), 2)
+
+    def test_importing_csv(self):
+        data = ('url,title,match_prefix\n'
+                '/imported/,Imported,\n'
+                '/imported-docs/,Imported Docs,yes\n')
+        importer = PageImporter().import_rows(read_csv(BytesIO(data)))
+        self.assertEqual((importer.created, importer.errors), (2, []))
+        self.assertTrue(Page.objects.get(url='/imported-docs/').match_prefix)
+
+    def test_short_csv_rows(self):
+        data = ('url,title,summary\n'
+                '/short/,Short\n'
+                '/shorter/\n'
+                '/whole/,Whole,A summary.\n')
+        importer = PageImporter().import_rows(read_csv(BytesIO(data)))
+        self.assertEqual(importer.created, 2)
+        self.assertEqual([(number, url) for number, url, message
+                          in importer.errors], [(2, '/shorter/')])
+        self.assertEqual(Page.objects.get(url='/short/').summary, '')
+
+    def test_existing_pages_are_updated(self):
+        page = Page.objects.get(url='/test/')
+        importer = PageImporter().import_rows([
+            {'url': '/test/', 'title': "Retitled"},
+            {'url': '/brand-new/', 'title': "Brand New"},
+        ])
+        self.assertEqual((importer.created, importer.updated), (1, 1))
+        updated = Page.objects.get(pk=page.pk)
+        self.assertEqual(updated.title, "Retitled")
+        self.assertEqual(updated.revision, page.revision + 1)
+
+    def test_updates_keep_fields_the_row_leaves_out(self):
+        Page.objects.filter(url='/test/').update(
+            summary="Kept summary", template='title-only.html')
+        PageImporter().import_rows([{'url': '/test/', 'title': "Retitled"}])
+
+        updated = Page.objects.get(url='/test/')
+        self.assertEqual(updated.title, "Retitled")
+        self.assertEqual(updated.summary, "Kept summary")
+        self.assertEqual(updated.template, 'title-only.html')
+
+    def test_invalid_rows_are_reported(self):
+        importer = PageImporter().import_rows([
+            {'url': '/numeric-title/', 'title': 42},
+            {'url': 7, 'title': "Numeric URL"},
+            {'url': 'no-slashes', 'title': "Bad URL"},
+            {'url': '/no-title/'},
+            {'url': '/bad-view/', 'title': "Bad View",
+             'view': 'mock_project.test_app.views.nonexistent_view'},
+            {'url': '/bad-template/', 'title': "Bad Template",
+             'template': 'no/such/template.html'},
+            {'url': '/good/', 'title': "Good"},
+            {'url': '/good/', 'title': "Good Again"},
+        ])
+        self.assertEqual(importer.created, 1)
+        self.assertEqual([number for number, url, message in importer.errors],
+                         [1, 2, 3, 4, 5, 6, 8])
+        self.assertFalse(Page.objects.filter(url='/bad-view/').exists())
+
+    def test_one_uniqueness_query_per_batch(self):
+        rows = [{'url': '/bulk-{}/'.format(i), 'title': "Bulk {}".format(i),
+                 'view': 'mock_project.test_app.views.custom_view'}
+                for i in range(20)]
+        importer = PageImporter(batch_size=10, dry_run=True)
+        # Per batch: one query for existing URLs. Nothing else.
+        with self.assertNumQueries(2):
+            importer.import_rows(rows)
+        self.assertEqual(importer.created, 20)
+        self.assertFalse(Page.objects.filter(url='/bulk-0/').exists())
+
+    def test_cached_misses_cleared_at_end(self):
+        with self.assertRaises(Page.DoesNotExist):
+            Page.objects.get_for_url('/late-arrival/')
+        PageImporter().import_rows([{'url': '/late-arrival/',
+                                     'title': "Late Arrival"}])
+        self.assertEqual(Page.objects.get_for_url('/late-arrival/').title,
+                         "Late Arrival")
+
+
+class PageSearchTest(TestCase):
+    fixtures = ['test-data.json']
+
+    def setUp(self):
+        rebuild_index()
+        self.guide = Page.objects.create(
+            title="Installation Guide", url='/install/',
+            summary="How to install everything.")
+        self.faq = Page.objects.create(
+            title="Frequently Asked Questions", url='/faq/',
+            summary="Answers, including a few about installing.")
+
+    def test_title_matches_rank_first(self):
+        self.assertEqual(search(u"install"), [self.guide.pk, self.faq.pk])
+
+    def test_every_word_must_match(self):
+        self.assertEqual(search(u"installing answers"), [self.faq.pk])
+        self.assertEqual(search(u"install nonsense"), [])
+
+    def test_common_words_counted_up_to_a_point(self):
+        limit = search_module.RARITY_COUNT_LIMIT
+        search_module.RARITY_COUNT_LIMIT = 1
+        settings.DEBUG = True
+        connection.queries = []
+        try:
+            self.assertEqual(search(u"installing answers"), [self.faq.pk])
+        finally:
+            settings.DEBUG = False
+            search_module.RARITY_COUNT_LIMIT = limit
+
+        counts = [query['sql'] for query in connection.queries
+                  if 'pages_pagesearchtoken"."id" FROM' in query['sql']]
+        self.assertEqual(len(counts), 2)
+        self.assertTrue(all(sql.endswith('LIMIT 1') for sql in counts))
+        self.assertFalse([query for query in connection.queries
+                          if 'COUNT(' in query['sql']])
+
+    def test_short_words_must_match_exactly(self):
+        self.assertEqual(search(u"in"), [])
+
+    def test_content_items_are_indexed(self):
+        PlainText.objects.create(content_area=self.guide,
+                                 text="Unpack the tarball first.")
+        self.assertEqual(search(u"tarball"), [self.guide.pk])
+
+    def test_changes_only_touch_changed_rows(self):
+        unchanged = PageSearchToken.objects.get(page=self.guide,
+                                                token='everything')
+        self.guide.title = "Upgrade Guide"
+        self.guide.save()
+        self.assertEqual(search(u"upgrade"), [self.guide.pk])
+        self.assertEqual(search(u"installation"), [])
+        self.assertEqual(PageSearchToken.objects.get(
+            page=self.guide, token='everything').pk, unchanged.pk)
+
+    def test_deleted_pages_are_forgotten(self):
+        self.faq.delete()
+        self.assertEqual(search(u"install"), [self.guide.pk])
+
+
+class PageAdminChangeListTest(TestCase):
+    fixtures = ['test-data.json']
+    changelist_url = '/admin/pages/page/'
+
+    def setUp(self):
+        from django.contrib.auth.models import User
+        cache.clear()
+        for url in ['/docs/', '/docs/install/', '/docs/install/linux/',
+                    '/about/team/']:
+            Page.objects.create(title="Page at {}".format(url), url=url)
+        User.objects.create_superuser('admin', 'admin@example.com', 'pw')
+        self.staff_client = Client()
+        self.staff_client.login(username='admin', password='pw')
+
+    def get_results(self, **params):
+        response = self.staff_client.get(self.changelist_url, params)
+        self.assertEqual(response.status_code, 200)
+        return [page.url for page in response.context['cl'].result_list]
+
+    def test_url_prefix_search(self):
+        self.assertEqual(self.get_results(q='/docs/install/'),
+                         ['/docs/install/', '/docs/install/linux/'])
+
+    def test_word_search(self):
+        rebuild_index()
+        self.assertEqual(self.get_results(q='linux'),
+                         ['/docs/install/linux/'])
+
+    def test_section_filter(self):
+        self.assertEqual(self.get_results(section='/docs/'),
+                         ['/docs/', '/docs/install/', '/docs/install/linux/'])
+
+    def test_sections(self):
+        self.assertEqual(admin_utils.get_child_sections(),
+                         ['/about/', '/docs/', '/test/'])
+        self.assertEqual(admin_utils.get_child_sections(u'/docs/'),
+                         ['/docs/install/'])
+
+    def test_url_ordering_uses_site_and_url(self):
+        response = self.staff_client.get(self.changelist_url)
+        query_set = response.context['cl'].query_set
+        self.assertEqual(query_set.query.order_by, ['site', 'url'])
+        self.assertEqual([page.url for page in query_set],
+                         sorted(Page.objects.values_list('url', flat=True)))
+
+        response = self.staff_client.get(self.changelist_url, {'o': '-2'})
+        self.assertEqual(response.context['cl'].query_set.query.order_by,
+                         ['-site', '-url'])
+
+    def test_sections_per_site(self):
+        other = Site.objects.create(domain='other.example.com',
+                                    name="Other")
+        Page.objects.create(title="Elsewhere", url='/elsewhere/', site=other)
+        self.assertEqual(admin_utils.get_child_sections(site_id=1),
+                         ['/about/', '/docs/', '/test/'])
+        self.assertEqual(admin_utils.get_child_sections(site_id=other.pk),
+                         ['/elsewhere/'])
+
+        response = self.staff_client.get(self.changelist_url,
+                                         {'site__id__exact': other.pk})
+        self.assertIn('?section=%2Felsewhere%2F', response.content)
+        self.assertNotIn('?section=%2Fdocs%2F', response.content)
+
+    def test_rows_only_load_listed_fields(self):
+        response = self.staff_client.get(self.changelist_url)
+        page = list(response.context['cl'].result_list)[0]
+        self.assertTrue(page._deferred)
+        self.assertIn('url', page.__dict__)
+        self.assertNotIn('view', page.__dict__)
+
+    def test_large_counts_are_estimated(self):
+        queryset = Page.objects.all()
+        self.assertEqual(admin_utils.estimate_count(queryset),
+                         (queryset.count(), False))
+        highest = Page.objects.order_by('-pk')[0].pk
+        self.assertEqual(admin_utils.estimate_count(queryset, limit=2),
+                         (highest, True))
+        docs = queryset.filter(url__startswith='/docs/')
+        self.assertEqual(admin_utils.estimate_count(docs, limit=2), (2, True))
+        # Counting from further on reaches further.
+        self.assertEqual(admin_utils.estimate_count(docs, limit=1, offset=1),
+                         (2, True))
+        self.assertEqual(admin_utils.estimate_count(docs, limit=2, offset=1),
+                         (3, False))
+        self.assertEqual(admin_utils.estimate_count(docs, limit=2, offset=9),
+                         (2, True))
+
+    def test_filtered_lists_page_past_the_count_limit(self):
+        for i in range(6):
+            Page.objects.create(title="Guide", url='/docs/guide-{}/'.format(i))
+        limit = admin_utils.EXACT_COUNT_LIMIT
+        per_page = PageAdmin.list_per_page
+        admin_utils.EXACT_COUNT_LIMIT, PageAdmin.list_per_page = 2, 2
+        try:
+            # The fourth page of nine.
+            response = self.staff_client.get(self.changelist_url,
+                                             {'section': '/docs/', 'p': 3})
+        finally:
+            admin_utils.EXACT_COUNT_LIMIT = limit
+            PageAdmin.list_per_page = per_page
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['cl'].result_list), 2)
+        self.assertIn("rough guess", response.content)
+
+    def test_word_search_without_index(self):
+        # As if the index had never been kept.
+        PageSearchToken.objects.all().delete()
+        with override_settings(FLEXIBLE_PAGES={'SEARCH_INDEX': False}):
+            self.assertEqual(self.get_results(q='linux'),
+                             ['/docs/install/linux/'])
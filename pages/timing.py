@@ -0,0 +1,167 @@
+"""
+Time each stage of serving a page, for the Server-Timing header and stats.
+
+Turn this on with FLEXIBLE_PAGES = {'TIMING': True}. PageMiddleware then
+times the stages of each page request (cache lookups, the database fallback,
+URL resolution, the view, and rendering), reports them to the browser in a
+Server-Timing header, and adds them to per-page histograms kept in this
+process. Staff can see the slowest pages at the "timings/" URL of the Page
+admin.
+
+Code that wants to be timed wraps itself in `with timing.stage('name'):`,
+which does nothing at all when no request is being timed.
+"""
+import bisect
+import contextlib
+import threading
+import time
+
+
+# Histogram bucket upper bounds, in milliseconds. Anything slower goes in a
+# final overflow bucket.
+BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+_local = threading.local()
+
+
+class StageTimer(object):
+    """
+    Collect the durations of the stages of a single request.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.durations = {}
+        # Stage names in the order they first happened, for the header.
+        self.order = []
+
+    def add(self, name, seconds):
+        if name not in self.durations:
+            self.durations[name] = 0.0
+            self.order.append(name)
+        self.durations[name] += seconds
+
+    def finish(self):
+        self.add('total', time.time() - self.started)
+
+    def get_header(self):
+        return ', '.join('{};dur={:.2f}'.format(name,
+                                                self.durations[name] * 1000)
+                         for name in self.order)
+
+
+def start():
+    _local.timer = StageTimer()
+    return _local.timer
+
+
+def stop():
+    timer = getattr(_local, 'timer', None)
+    _local.timer = None
+    return timer
+
+
+@contextlib.contextmanager
+def stage(name):
+    timer = getattr(_local, 'timer', None)
+    if timer is None:
+        yield
+        return
+
+    started = time.time()
+    try:
+        yield
+    finally:
+        timer.add(name, time.time() - started)
+
+
+class Histogram(object):
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, milliseconds):
+        self.counts[bisect.bisect_left(BUCKETS, milliseconds)] += 1
+        self.count += 1
+        self.total += milliseconds
+        self.max = max(self.max, milliseconds)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, fraction):
+        """
+        Return the upper bound of the bucket holding the given percentile.
+        """
+        threshold = fraction * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS + (None,), self.counts):
+            seen += count
+            if seen >= threshold and count:
+                return bound if bound is not None else self.max
+        return 0.0
+
+
+class TimingStats(object):
+    """
+    Per-page, per-stage histograms for this process.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pages = {}
+
+    def add(self, url, name, seconds):
+        # Call with the lock held.
+        stages = self.pages.setdefault(url, {})
+        if name not in stages:
+            stages[name] = Histogram()
+        stages[name].add(seconds * 1000)
+
+    def record(self, url, timer):
+        with self.lock:
+            for name, seconds in timer.durations.items():
+                self.add(url, name, seconds)
+
+    def record_stage(self, url, name, seconds):
+        """
+        Add a stage that happened after the rest of the request was recorded.
+        """
+        with self.lock:
+            self.add(url, name, seconds)
+
+    def clear(self):
+        with self.lock:
+            self.pages = {}
+
+    def get_slowest(self, limit=20):
+        """
+        Return (url, {stage: histogram}) pairs, slowest mean total first.
+        """
+        with self.lock:
+            pages = self.pages.items()
+        pages = [(url, stages) for url, stages in pages if 'total' in stages]
+        pages.sort(key=lambda p: -p[1]['total'].mean)
+        return pages[:limit]
+
+    def format_report(self, limit=20):
+        lines = []
+        for url, stages in self.get_slowest(limit):
+            total = stages['total']
+            lines.append('{}  ({} requests, mean {:.1f}ms, p95 <= {}ms, '
+                         'max {:.1f}ms)'.format(url, total.count, total.mean,
+                                                total.percentile(0.95),
+                                                total.max))
+            for name in sorted(stages):
+                if name == 'total':
+                    continue
+                histogram = stages[name]
+                lines.append('    {:<16} mean {:8.2f}ms  max {:8.2f}ms'.format(
+                    name, histogram.mean, histogram.max))
+        return '\n'.join(lines) or 'No page timings recorded yet.'
+
+
+stats = TimingStats()
@@ -0,0 +1,383 @@
+"""
+A compact, sorted URL-to-page-id index, shared by every worker via mmap.
+
+    FLEXIBLE_PAGES = {
+        'URL_INDEX_PATH': '/var/lib/my-site/page-urls.idx',
+    }
+
+Build it with `manage.py build_page_url_index`. Once it exists,
+PageManager.get_for_url and get_id_for_url look paths up in it with a binary
+search, without touching the cache or the database, and every worker process
+shares the same pages of memory. One file covers every site: each URL is
+stored behind its page's site id (see get_index_key).
+
+Saving or deleting a page appends the change to a journal beside the index
+(its path plus '.journal'), rather than rewriting the whole index. Workers
+read the journal on top of the index, noticing changes to either within
+CHECK_INTERVAL seconds. Once the journal grows to JOURNAL_LIMIT bytes, its
+changes are folded into a new index file, which is swapped into place
+atomically.
+
+Page imports (see pages.bulk) and content changes keep the index up to date
+too, but pages can still come and go without any of those (a queryset
+update, bulk_create, loaddata...). So a URL missing from the index is only
+taken to be missing from the database while the page cache is out (see
+pages.breaker), or if URL_INDEX_AUTHORITATIVE is set, for sites that rebuild
+the index after changing pages any other way:
+
+    FLEXIBLE_PAGES = {
+        'URL_INDEX_PATH': '/var/lib/my-site/page-urls.idx',
+        'URL_INDEX_AUTHORITATIVE': True,
+    }
+
+Otherwise, a miss is looked up as usual, and only the pages the index does
+have are trusted.
+
+The file layout (all little-endian):
+    header:  magic 'FPUI', format version (uint32), entry count (uint32)
+    entries: one per key, sorted by key - offset into the key blob (uint32),
+             key length (uint16), padding (uint16), page id (uint32)
+    blob:    the keys, UTF-8 encoded, one after another
+
+The journal is a series of records: key length (uint16), page id (uint32, or
+0 for a removed key), then the key.
+"""
+import contextlib
+import fcntl
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+
+from .sites import resolve_site_id
+from .utils import get_app_settings
+
+
+log = logging.getLogger('pages.url_index')
+
+MAGIC = 'FPUI'
+VERSION = 2
+HEADER = struct.Struct('<4sII')
+ENTRY = struct.Struct('<IHHI')
+JOURNAL_RECORD = struct.Struct('<HI')
+
+# How big (in bytes) the journal can get before it's folded into the index.
+JOURNAL_LIMIT = 64 * 1024
+
+# How often (in seconds) to check whether the file was replaced.
+CHECK_INTERVAL = 1.0
+
+
+def get_index_key(url, site_id=None):
+    """
+    The index key for a URL on a site: the site id, then the URL. (URLs start
+    with a slash, so one site's keys can't run into another's.)
+    """
+    return u'{}{}'.format(resolve_site_id(site_id), url)
+
+
+def encode(url):
+    return url.encode('utf-8') if isinstance(url, unicode) else url
+
+
+def get_journal_path(path):
+    return path + '.journal'
+
+
+def get_identity(path):
+    """
+    Return something that changes when a file is replaced or written to, or
+    None if it doesn't exist.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_ino, stat.st_mtime, stat.st_size)
+
+
+def read_journal(path):
+    """
+    Return {key: page id, or None if removed} for a journal's changes, with
+    the later of any two for the same key, and where its last whole record
+    ends.
+    """
+    try:
+        with open(get_journal_path(path), 'rb') as f:
+            data = f.read()
+    except IOError:
+        return {}, 0
+
+    changes = {}
+    offset = 0
+    while offset + JOURNAL_RECORD.size <= len(data):
+        length, page_id = JOURNAL_RECORD.unpack_from(data, offset)
+        end = offset + JOURNAL_RECORD.size + length
+        # A torn write; the next update cuts it off.
+        if end > len(data):
+            break
+        changes[data[offset + JOURNAL_RECORD.size:end]] = page_id or None
+        offset = end
+    return changes, offset
+
+
+def write_index(path, entries):
+    """
+    Atomically write an index file from (key, page id) pairs.
+    """
+    entries = sorted((encode(url), page_id) for url, page_id in entries)
+
+    table = []
+    offset = 0
+    for url, page_id in entries:
+        table.append(ENTRY.pack(offset, len(url), 0, page_id))
+        offset += len(url)
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.url-index-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, len(entries)))
+            f.write(''.join(table))
+            f.write(''.join(url for url, page_id in entries))
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(temp_path, 0644)
+        # Readers either see the old file or the new one, never half of it.
+        os.rename(temp_path, path)
+    except:
+        os.unlink(temp_path)
+        raise
+
+
+class URLIndex(object):
+    """
+    A read-only view of an index file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # The map, its entry count and where its URLs start, swapped as one,
+        # so a lookup never mixes up two versions of the file.
+        self.state = None
+        self.identity = None
+        self.checked = 0
+        self.lock = threading.Lock()
+        self.refresh(force=True)
+
+    def refresh(self, force=False):
+        """
+        Remap the file if it's been replaced since we last looked.
+        """
+        now = time.time()
+        if not force and now - self.checked < CHECK_INTERVAL:
+            return
+        self.checked = now
+
+        identity = (get_identity(self.path),
+                    get_identity(get_journal_path(self.path)))
+        if identity[0] is None:
+            self.close()
+            return
+        if identity == self.identity:
+            return
+
+        with self.lock:
+            if self.identity is not None and identity[0] == self.identity[0]:
+                # Only the journal changed; keep the map we have.
+                new_map, count, blob_start = self.state[:3]
+            else:
+                loaded = self.load()
+                if loaded is None:
+                    self.close()
+                    return
+                new_map, count, blob_start = loaded
+
+            # Anyone mid-lookup on the old state keeps their reference to it;
+            # it goes away once they're done.
+            self.state = (new_map, count, blob_start,
+                          read_journal(self.path)[0])
+            self.identity = identity
+
+    def load(self):
+        """
+        Map the index file, and return (map, entry count, blob start), or
+        None if it's not an index we can read.
+        """
+        with open(self.path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            # An empty file can't be mapped at all.
+            if size < HEADER.size:
+                log.error("%s is too short to be a page URL index.",
+                          self.path)
+                return None
+            new_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, count = HEADER.unpack_from(new_map, 0)
+        if magic != MAGIC or version != VERSION:
+            new_map.close()
+            log.error("%s isn't a page URL index we can read.", self.path)
+            return None
+        blob_start = HEADER.size + ENTRY.size * count
+        if size < blob_start:
+            new_map.close()
+            log.error("%s is a truncated page URL index.", self.path)
+            return None
+        return new_map, count, blob_start
+
+    def close(self):
+        self.state, self.identity = None, None
+
+    @property
+    def available(self):
+        return self.state is not None
+
+    def get_entry(self, state, i):
+        mapped, count, blob_start = state[:3]
+        offset, length, _, page_id = ENTRY.unpack_from(
+            mapped, HEADER.size + ENTRY.size * i)
+        start = blob_start + offset
+        return mapped[start:start + length], page_id
+
+    def lookup(self, url):
+        """
+        Return the page id for a key (see get_index_key), or None if it's not
+        in the index.
+        """
+        self.refresh()
+        state = self.state
+        if state is None:
+            return None
+
+        url = encode(url)
+        if url in state[3]:
+            return state[3][url]
+        low, high = 0, state[1]
+        while low < high:
+            middle = (low + high) // 2
+            middle_url, page_id = self.get_entry(state, middle)
+            if middle_url < url:
+                low = middle + 1
+            elif middle_url > url:
+                high = middle
+            else:
+                return page_id
+        return None
+
+    def __contains__(self, url):
+        return self.lookup(url) is not None
+
+    def __len__(self):
+        return sum(1 for entry in self)
+
+    def __iter__(self):
+        """
+        Yield (key, page id) pairs, in key order.
+        """
+        self.refresh()
+        state = self.state
+        if state is None:
+            return
+        entries = {}
+        for i in range(state[1]):
+            url, page_id = self.get_entry(state, i)
+            entries[url] = page_id
+        entries.update(state[3])
+        for url in sorted(entries):
+            if entries[url] is not None:
+                yield url.decode('utf-8'), entries[url]
+
+
+@contextlib.contextmanager
+def locked(path):
+    """
+    Keep concurrent rebuilds (from different processes) from losing changes.
+    """
+    with open(path + '.lock', 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def build_index(path):
+    """
+    Write a fresh index of every page in the database. Returns its size.
+    """
+    from .models import Page
+    with locked(path):
+        entries = [(get_index_key(url, site_id), pk) for site_id, url, pk in
+                   Page.objects.order_by().values_list('site', 'url', 'pk')]
+        write_index(path, entries)
+        clear_journal(path)
+    refresh_local_index(path)
+    return len(entries)
+
+
+def clear_journal(path):
+    # The index has to be swapped in first: a reader that sees the new index
+    # with the old journal just applies some changes twice.
+    try:
+        os.unlink(get_journal_path(path))
+    except OSError:
+        pass
+
+
+def update_index(path, changes):
+    """
+    Apply a dictionary of {index key: page id, or None to remove} to the
+    index.
+    """
+    if not os.path.exists(path):
+        return
+    with locked(path):
+        records = []
+        for url, page_id in changes.items():
+            url = encode(url)
+            records.append(JOURNAL_RECORD.pack(len(url), page_id or 0) + url)
+        with open(get_journal_path(path), 'ab') as f:
+            # Don't append after half a record, or we'd never read past it.
+            f.truncate(read_journal(path)[1])
+            f.write(''.join(records))
+            f.flush()
+            os.fsync(f.fileno())
+
+        if os.path.getsize(get_journal_path(path)) >= JOURNAL_LIMIT:
+            index = URLIndex(path)
+            if index.available:
+                write_index(path, list(index))
+                clear_journal(path)
+    refresh_local_index(path)
+
+
+_index = None
+
+
+def refresh_local_index(path):
+    # Other processes can wait a moment to see a change, but the one that
+    # made it should see it right away.
+    if _index is not None and _index.path == path:
+        _index.refresh(force=True)
+
+
+def get_index_path():
+    return get_app_settings().get('URL_INDEX_PATH')
+
+
+def get_url_index():
+    """
+    Return this process's view of the index, or None if there isn't one.
+    """
+    global _index
+
+    path = get_index_path()
+    if not path:
+        return None
+    if _index is None or _index.path != path:
+        _index = URLIndex(path)
+    _index.refresh()
+    return _index if _index.available else None
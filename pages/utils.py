@@ -0,0 +1,50 @@
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured, ViewDoesNotExist
+from django.core.urlresolvers import get_callable
+from django.utils.translation import ugettext as _
+
+
+# Custom views we've already imported, keyed by their dotted path. Failed
+# imports aren't kept, so a view that's deployed later still gets picked up.
+_view_cache = {}
+
+
+def get_app_settings():
+    """
+    Load the settings and make sure it's not totally wrong.
+    """
+
+    app_settings = getattr(settings, 'FLEXIBLE_PAGES', None)
+    if app_settings is None:
+        app_settings = {}
+
+    # If the settings were defined as something other than None or a
+    # dictionary, raise a stink.
+    if not isinstance(app_settings, dict):
+        message = _("Setting FLEXIBLE_PAGES should be a dictionary; "
+                    "instead, it was of type {}.".format(type(app_settings)))
+        raise ImproperlyConfigured(message)
+
+    return app_settings
+
+
+def get_setting(name, default=None):
+    return get_app_settings().get(name, default)
+
+
+def get_view_callable(view_string):
+    """
+    Import a view from its dotted path once per process, or return None.
+    """
+    try:
+        return _view_cache[view_string]
+    except KeyError:
+        pass
+
+    try:
+        view = get_callable(view_string)
+    except (ImportError, ViewDoesNotExist):
+        return None
+
+    _view_cache[view_string] = view
+    return view
@@ -1,7 +1,50 @@
+import time
+import uuid
+from itertools import chain
+
+from django.http import StreamingHttpResponse
+from django.utils.cache import patch_cache_control
 from django.views.generic import DetailView
 
+from . import routers, timing
 from .mixins import FlexiblePageMixin
 from .models import Page
+from .templatetags.pages_tags import iter_page_content
+from .utils import get_app_settings
+
+
+# Stands in for a page's content while its template is rendered for
+# streaming. It's letters and numbers only, so escaping leaves it alone.
+CONTENT_PLACEHOLDER = 'flexible-page-content-{}'.format(uuid.uuid4().hex)
+
+# How many content items to fetch and render at a time when streaming.
+STREAM_CHUNK_SIZE = 20
+
+
+def iter_for_page(page, chunks, request):
+    """
+    Produce each chunk of a page's streamed content as the rest of the page
+    was rendered: from a replica, or the primary if it was pinned there.
+
+    It's sent after PageMiddleware has finished timing the request, so it
+    isn't in the Server-Timing header; its time is added to the stats as a
+    'stream' stage instead.
+    """
+    chunks = iter(chunks)
+    elapsed = 0.0
+    while True:
+        started = time.time()
+        try:
+            with routers.reads_for_page(page):
+                chunk = next(chunks)
+        except StopIteration:
+            break
+        finally:
+            elapsed += time.time() - started
+        yield chunk
+
+    if getattr(request, '_page_timer', None) is not None:
+        timing.stats.record_stage(page.url, 'stream', elapsed)
 
 
 class BasePageView(FlexiblePageMixin, DetailView):
@@ -21,7 +64,69 @@ class BasePageView(FlexiblePageMixin, DetailView):
         # Prepend with the custom template, if necessary.
         return self.get_customized_template_names(base_template_names)
 
+    def dispatch(self, request, *args, **kwargs):
+        response = super(BasePageView, self).dispatch(request, *args, **kwargs)
+        if request.method in ('GET', 'HEAD') and response.status_code == 200:
+            self.patch_proxy_headers(response)
+        return response
+
+    def patch_proxy_headers(self, response):
+        """
+        Add the Cache-Control and Surrogate-Key headers a proxy needs to cache
+        this page, per the CACHE_CONTROL and SURROGATE_KEYS settings.
+        """
+        app_settings = get_app_settings()
+
+        cache_control = app_settings.get('CACHE_CONTROL')
+        if cache_control:
+            patch_cache_control(response, **cache_control)
+
+        if app_settings.get('SURROGATE_KEYS', False):
+            page = self.get_flexible_page()
+            response['Surrogate-Key'] = ' '.join(page.get_surrogate_keys())
+
 
 class DefaultPageView(BasePageView):
-    pass
+    """
+    Set 'STREAM_PAGES': True in FLEXIBLE_PAGES (or stream = True on a
+    subclass) to send pages as a StreamingHttpResponse: everything in the
+    template before the content goes out first, then the content items as
+    they're rendered, then the rest of the template. Those responses aren't
+    kept in the response cache.
+    """
+    stream = None
+
+    def should_stream(self):
+        if self.stream is not None:
+            return self.stream
+        return get_app_settings().get('STREAM_PAGES', False)
+
+    def render_to_response(self, context, **response_kwargs):
+        response = super(DefaultPageView, self).render_to_response(
+            context, **response_kwargs)
+        if not self.should_stream() or self.request.method == 'HEAD':
+            return response
+
+        # Render the template around a placeholder, instead of the content.
+        page = self.get_flexible_page()
+        page.rendered_content = CONTENT_PLACEHOLDER
+        try:
+            response.render()
+        finally:
+            page.rendered_content = None
+
+        parts = response.content.split(CONTENT_PLACEHOLDER)
+        if len(parts) != 2:
+            # The template doesn't show the content exactly once, so we can't
+            # tell where to stream it; render it the usual way.
+            return super(DefaultPageView, self).render_to_response(
+                context, **response_kwargs)
+
+        head, tail = parts
+        content = iter_for_page(
+            page, iter_page_content(page, chunk_size=STREAM_CHUNK_SIZE),
+            self.request)
+        return StreamingHttpResponse(chain([head], content, [tail]),
+                                     status=response.status_code,
+                                     content_type=response['Content-Type'])
 default_page_view = DefaultPageView.as_view()
@@ -0,0 +1,97 @@
+"""
+Get a worker process ready to serve pages before its first request.
+
+Custom views are imported lazily the first time a page that uses them is
+rendered, and so is the URLconf. Call warm_page_views() from your WSGI module
+(before the server forks, if it preloads the application) so that workers
+start with everything already imported:
+
+my_project/wsgi.py:
+    application = get_wsgi_application()
+
+    from pages.warmup import warm_page_views
+    warm_page_views()
+
+Once pages.popularity has counted some traffic, warm_page_cache() loads the
+hottest pages into the cache, hottest first, so a cold cache (after a deploy
+or a restart) fills up with what's actually wanted before visitors ask.
+"""
+import logging
+import time
+
+from django.core.urlresolvers import get_resolver
+from django.db import connections, DatabaseError
+
+from .utils import get_view_callable
+
+
+log = logging.getLogger('pages.warmup')
+
+
+def get_page_view_strings():
+    """
+    Return the distinct, non-empty custom view paths used by any page.
+    """
+    from .models import Page
+    views = (Page.objects.exclude(view__isnull=True)
+                         .exclude(view='')
+                         .values_list('view', flat=True)
+                         .distinct())
+    return sorted(set(views))
+
+
+def warm_page_views(close_connections=True):
+    """
+    Import the URLconf and every custom view referenced by a page.
+
+    Returns a list of (view path, seconds to import, callable or None) tuples,
+    so callers can report on slow or broken views. Unless told otherwise, this
+    closes the database connections it opened when it's done.
+    """
+    # Importing the URLconf's views happens while populating the resolver.
+    get_resolver(None).reverse_dict
+
+    try:
+        view_strings = get_page_view_strings()
+    except DatabaseError:
+        log.exception("Couldn't load the list of page views to warm up.")
+        view_strings = []
+    finally:
+        # This is likely happening before the server forks, and workers
+        # mustn't share the parent's database connections.
+        if close_connections:
+            for connection in connections.all():
+                connection.close()
+
+    report = []
+    for view_string in view_strings:
+        started = time.time()
+        view = get_view_callable(view_string)
+        elapsed = time.time() - started
+
+        if view is None:
+            log.error("Couldn't import the custom page view %s.", view_string)
+        else:
+            log.debug("Imported page view %s in %.4fs.", view_string, elapsed)
+        report.append((view_string, elapsed, view))
+
+    return report
+
+
+def warm_page_cache(limit=100, site_id=None):
+    """
+    Look up the hottest paths (see pages.popularity), hottest first, so their
+    pages are cached. Returns how many pages were found.
+    """
+    from .models import Page
+    from .popularity import get_hot_paths
+
+    found = 0
+    for path_site_id, path, hits in get_hot_paths(limit, site_id):
+        try:
+            Page.objects.get_for_request_path(path, site_id=path_site_id)
+        except Page.DoesNotExist:
+            log.debug("Hot path %s no longer has a page.", path)
+        else:
+            found += 1
+    return found
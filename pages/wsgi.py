@@ -0,0 +1,89 @@
+"""
+Serve cached pages before Django builds a request or runs any middleware.
+
+PageMiddleware usually sits at the end of the middleware stack, so even a page
+it has cached costs a trip through sessions, CSRF and auth. Wrapping the WSGI
+application with PageCacheApplication lets anonymous GET and HEAD requests for
+cached pages skip all of that:
+
+my_project/wsgi.py:
+    application = get_wsgi_application()
+
+    from pages.wsgi import PageCacheApplication
+    application = PageCacheApplication(application)
+
+Only requests that the middleware would have answered with the very same
+cached response are handled here: no cookies, no query string, and a cached
+response that's still current for its page. Everything else falls through to
+the wrapped application.
+"""
+from django.conf import settings
+from django.core.handlers.base import get_path_info, get_script_name
+from django.core.handlers.wsgi import STATUS_CODE_TEXT
+from django.db import close_connection
+
+from . import popularity, validators
+from .response_cache import get_fresh_entry_for_path, get_timeout
+from .sites import get_site_id_for_host
+
+
+class PageCacheApplication(object):
+    def __init__(self, application):
+        self.application = application
+
+    def get_entry(self, environ):
+        """
+        Return the cached response entry for this request, if it's eligible.
+        """
+        if not get_timeout():
+            return None
+        if environ.get('REQUEST_METHOD', '').upper() not in ('GET', 'HEAD'):
+            return None
+        # Cookies might mean a session, and so a response specific to the
+        # user; leave those to Django.
+        if environ.get('HTTP_COOKIE') or environ.get('QUERY_STRING'):
+            return None
+        # CommonMiddleware would redirect these.
+        if getattr(settings, 'PREPEND_WWW', False):
+            return None
+
+        script_name = get_script_name(environ)
+        path_info = get_path_info(environ) or '/'
+        path = '%s/%s' % (script_name.rstrip('/'), path_info.lstrip('/'))
+        if not validators.is_root_relative_url(path):
+            return None
+
+        site_id = get_site_id_for_host(environ.get('HTTP_HOST') or
+                                       environ.get('SERVER_NAME'))
+        entry = get_fresh_entry_for_path(path, site_id)
+        if entry is not None:
+            # PageMiddleware won't see this request, so count it here.
+            popularity.record_access(site_id, path)
+        return entry
+
+    def __call__(self, environ, start_response):
+        entry = self.get_entry(environ)
+        if entry is None:
+            return self.application(environ, start_response)
+        # Django won't see this request, so it won't close any connection
+        # that finding the site (or counting the request) opened.
+        close_connection()
+
+        encoding = entry.choose_encoding(environ.get('HTTP_ACCEPT_ENCODING'))
+        if entry.is_not_modified(environ.get('HTTP_IF_NONE_MATCH')):
+            status_code = 304
+            header_items = entry.get_not_modified_header_items(encoding)
+        else:
+            status_code = entry.status_code
+            header_items = entry.get_header_items(encoding)
+        status = '%d %s' % (status_code,
+                            STATUS_CODE_TEXT.get(status_code, 'UNKNOWN'))
+        headers = [(str(k), str(v)) for k, v in header_items]
+        start_response(status, headers)
+
+        if status_code == 304:
+            return []
+
+        if environ['REQUEST_METHOD'].upper() == 'HEAD':
+            return []
+        return [entry.bodies[encoding]]